@@ -0,0 +1,121 @@
+import threading
+
+from binascii import hexlify, unhexlify
+from time import time
+
+from logger import log, log_event, log_block_event
+from prefetch import load_transaction, load_transactions
+
+
+class BackfillChunk(object):
+    def __init__(self, first_height, last_height):
+        self.first_height = first_height
+        self.last_height = last_height
+        self.next_height = first_height
+        self.first_prevhash = None
+        self.last_hash = None
+
+
+class Backfill(object):
+    def __init__(self, context, ranges, threads=4, chunk_size=100):
+        self.context = context
+        self.threads = threads
+        self.chunks = []
+        self.retries = []
+        self.lock = threading.Lock()
+        self.imported = 0
+
+        for first_height, last_height in ranges:
+            for start in range(first_height, last_height + 1, chunk_size):
+                self.chunks.append(BackfillChunk(start, min(start + chunk_size - 1, last_height)))
+        self.pending = list(self.chunks)
+
+    def run(self):
+        start_time = time()
+        log_event('Backfill', 'blk', '%d blocks' % sum([ c.last_height - c.first_height + 1 for c in self.chunks ]), {'chunks': len(self.chunks), 'threads': self.threads})
+
+        workers = [ threading.Thread(target=self.worker) for _ in range(min(self.threads, len(self.chunks))) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # Chunks that failed (usually because they spend outputs from a chunk
+        # that was not imported yet) are retried serially, in height order.
+        if len(self.retries) > 0:
+            log_event('Backfill', 'blk', 'retry', {'chunks': len(self.retries)})
+            self.pending = sorted(self.retries, key=lambda chunk: chunk.first_height)
+            self.retries = []
+            self.worker(serial=True)
+
+        self.link()
+
+        elapsed = max(time() - start_time, 0.001)
+        log_event('Backfill', 'blk', 'done', {'blocks': self.imported, 'blk/s': '%.1f' % (self.imported / elapsed)})
+
+    def next_chunk(self):
+        with self.lock:
+            return self.pending.pop(0) if len(self.pending) > 0 else None
+
+    def worker(self, serial=False):
+        rpc = self.context.batch_rpc
+        session = self.context.db.new_session(shared_caches=False)
+        session.defer_aggregates = True
+
+        batch_resolver = lambda txids: load_transactions(rpc, txids, batch_size=self.context.RPC_BATCH_SIZE)
+        tx_resolver = lambda txid: load_transaction(rpc, txid)
+
+        try:
+            while True:
+                chunk = self.next_chunk()
+                if chunk is None:
+                    return
+
+                try:
+                    while chunk.next_height <= chunk.last_height:
+                        blockinfo = rpc.getblock(rpc.getblockhash(chunk.next_height))
+                        block = session.import_blockinfo(blockinfo, tx_resolver=tx_resolver, batch_resolver=batch_resolver, commit=True)
+
+                        # Genesis has no previous block
+                        if chunk.next_height == chunk.first_height and blockinfo.get('previousblockhash') is not None:
+                            chunk.first_prevhash = unhexlify(blockinfo['previousblockhash'])
+                        chunk.last_hash = block.hash
+                        chunk.next_height += 1
+
+                        with self.lock:
+                            self.imported += 1
+                except Exception as e:
+                    if serial:
+                        raise
+                    log_block_event('%d' % chunk.next_height, 'Deferred', reason=type(e).__name__)
+                    session.reset_session()
+
+                    # Caches may hold ids from the rolled back transaction
+                    session.flush()
+                    session = self.context.db.new_session(shared_caches=False)
+                    session.defer_aggregates = True
+
+                    with self.lock:
+                        self.retries.append(chunk)
+        finally:
+            session.flush()
+
+    def link(self):
+        db = self.context.db
+        db.reset_session()
+
+        # Blocks around each chunk may have been imported from another chain
+        # than the chunk was (a reorg while backfilling), check both ends.
+        boundaries = db.block_hashes(heights=[ c.first_height - 1 for c in self.chunks ] + [ c.last_height + 1 for c in self.chunks ])
+        for chunk in self.chunks:
+            if chunk.first_height - 1 in boundaries and boundaries[chunk.first_height - 1] != chunk.first_prevhash:
+                raise Exception('Chain error: blocks %d and %d not chaining' % (chunk.first_height - 1, chunk.first_height))
+            if chunk.last_height + 1 in boundaries:
+                header = self.context.batch_rpc.getblockheader(hexlify(boundaries[chunk.last_height + 1]).decode('ascii'))
+                if unhexlify(header['previousblockhash']) != chunk.last_hash:
+                    raise Exception('Chain error: blocks %d and %d not chaining' % (chunk.last_height, chunk.last_height + 1))
+
+        # Balances of touched addresses were marked dirty and block/tx totals
+        # were not updated, let the regular recalculation take care of those.
+        db.cache.invalidate(commit=True)
+        log('Backfilled blocks linked into chain')
@@ -0,0 +1,521 @@
+import hashlib
+import mmap
+import struct
+
+from array import array
+from binascii import hexlify, unhexlify
+from decimal import Decimal
+from glob import glob
+from os import path
+from time import time
+
+from coinsupport.addresscodecs import encode_base58_address, encode_bech32_address
+
+from logger import log, log_event, log_block_event
+
+
+COIN = Decimal(100000000)
+
+NULL_HASH = b'\0' * 32
+
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+OP_1NEGATE = 0x4f
+OP_1 = 0x51
+OP_16 = 0x60
+OP_RETURN = 0x6a
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_HASH160 = 0xa9
+OP_CHECKSIG = 0xac
+OP_CHECKMULTISIG = 0xae
+
+OPCODE_NAMES = dict(list(zip(range(0x61, 0xba), [
+    'OP_NOP', 'OP_VER', 'OP_IF', 'OP_NOTIF', 'OP_VERIF', 'OP_VERNOTIF', 'OP_ELSE', 'OP_ENDIF',
+    'OP_VERIFY', 'OP_RETURN', 'OP_TOALTSTACK', 'OP_FROMALTSTACK', 'OP_2DROP', 'OP_2DUP', 'OP_3DUP', 'OP_2OVER',
+    'OP_2ROT', 'OP_2SWAP', 'OP_IFDUP', 'OP_DEPTH', 'OP_DROP', 'OP_DUP', 'OP_NIP', 'OP_OVER',
+    'OP_PICK', 'OP_ROLL', 'OP_ROT', 'OP_SWAP', 'OP_TUCK', 'OP_CAT', 'OP_SUBSTR', 'OP_LEFT',
+    'OP_RIGHT', 'OP_SIZE', 'OP_INVERT', 'OP_AND', 'OP_OR', 'OP_XOR', 'OP_EQUAL', 'OP_EQUALVERIFY',
+    'OP_RESERVED1', 'OP_RESERVED2', 'OP_1ADD', 'OP_1SUB', 'OP_2MUL', 'OP_2DIV', 'OP_NEGATE', 'OP_ABS',
+    'OP_NOT', 'OP_0NOTEQUAL', 'OP_ADD', 'OP_SUB', 'OP_MUL', 'OP_DIV', 'OP_MOD', 'OP_LSHIFT',
+    'OP_RSHIFT', 'OP_BOOLAND', 'OP_BOOLOR', 'OP_NUMEQUAL', 'OP_NUMEQUALVERIFY', 'OP_NUMNOTEQUAL', 'OP_LESSTHAN', 'OP_GREATERTHAN',
+    'OP_LESSTHANOREQUAL', 'OP_GREATERTHANOREQUAL', 'OP_MIN', 'OP_MAX', 'OP_WITHIN', 'OP_RIPEMD160', 'OP_SHA1', 'OP_SHA256',
+    'OP_HASH160', 'OP_HASH256', 'OP_CODESEPARATOR', 'OP_CHECKSIG', 'OP_CHECKSIGVERIFY', 'OP_CHECKMULTISIG', 'OP_CHECKMULTISIGVERIFY', 'OP_NOP1',
+    'OP_CHECKLOCKTIMEVERIFY', 'OP_CHECKSEQUENCEVERIFY', 'OP_NOP4', 'OP_NOP5', 'OP_NOP6', 'OP_NOP7', 'OP_NOP8', 'OP_NOP9',
+    'OP_NOP10'
+])) + [ (0x50, 'OP_RESERVED'), (0xff, 'OP_INVALIDOPCODE') ])
+
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def _ripemd160(data):
+    # Pure python fallback, OpenSSL builds without legacy digests lack ripemd160
+    def rol(x, n):
+        return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+    def f(j, x, y, z):
+        if j < 16:
+            return x ^ y ^ z
+        if j < 32:
+            return (x & y) | (~x & z)
+        if j < 48:
+            return (x | ~y) ^ z
+        if j < 64:
+            return (x & z) | (y & ~z)
+        return x ^ (y | ~z)
+
+    KL = [0x00000000, 0x5a827999, 0x6ed9eba1, 0x8f1bbcdc, 0xa953fd4e]
+    KR = [0x50a28be6, 0x5c4dd124, 0x6d703ef3, 0x7a6d76e9, 0x00000000]
+    ML = [
+        0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+        3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12, 1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+        4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13
+    ]
+    MR = [
+        5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12, 6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+        15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13, 8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+        12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11
+    ]
+    RL = [
+        11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8, 7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+        11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5, 11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+        9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6
+    ]
+    RR = [
+        8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6, 9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+        9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5, 15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+        8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11
+    ]
+
+    data = bytearray(data)
+    message = data + bytearray([0x80]) + bytearray((55 - len(data)) % 64) + bytearray(struct.pack('<Q', 8 * len(data)))
+    state = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0]
+
+    for block in range(0, len(message), 64):
+        x = struct.unpack('<16L', bytes(message[block:block+64]))
+        al, bl, cl, dl, el = state
+        ar, br, cr, dr, er = state
+        for j in range(80):
+            t = (rol((al + f(j, bl, cl, dl) + x[ML[j]] + KL[j // 16]) & 0xffffffff, RL[j]) + el) & 0xffffffff
+            al, bl, cl, dl, el = el, t, bl, rol(cl, 10), dl
+            t = (rol((ar + f(79 - j, br, cr, dr) + x[MR[j]] + KR[j // 16]) & 0xffffffff, RR[j]) + er) & 0xffffffff
+            ar, br, cr, dr, er = er, t, br, rol(cr, 10), dr
+        state = [
+            (state[1] + cl + dr) & 0xffffffff,
+            (state[2] + dl + er) & 0xffffffff,
+            (state[3] + el + ar) & 0xffffffff,
+            (state[4] + al + br) & 0xffffffff,
+            (state[0] + bl + cr) & 0xffffffff
+        ]
+    return struct.pack('<5L', *state)
+
+
+def hash160(data):
+    sha = hashlib.sha256(data).digest()
+    try:
+        return hashlib.new('ripemd160', sha).digest()
+    except ValueError:
+        return _ripemd160(sha)
+
+
+def hexstr(data):
+    return hexlify(bytes(data)).decode('ascii')
+
+
+def hash_hexstr(data):
+    return hexstr(bytearray(data)[::-1])
+
+
+def read_varint(data, offset):
+    prefix = data[offset]
+    if prefix < 0xfd:
+        return prefix, offset + 1
+    if prefix == 0xfd:
+        return struct.unpack_from('<H', data, offset + 1)[0], offset + 3
+    if prefix == 0xfe:
+        return struct.unpack_from('<I', data, offset + 1)[0], offset + 5
+    return struct.unpack_from('<Q', data, offset + 1)[0], offset + 9
+
+
+def bits_to_difficulty(bits):
+    shift = (bits >> 24) & 0xff
+    difficulty = float(0x0000ffff) / float(bits & 0x00ffffff)
+    while shift < 29:
+        difficulty *= 256.0
+        shift += 1
+    while shift > 29:
+        difficulty /= 256.0
+        shift -= 1
+    return difficulty
+
+
+def bits_to_work(bits):
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    if exponent <= 3:
+        target = mantissa >> (8 * (3 - exponent))
+    else:
+        target = mantissa << (8 * (exponent - 3))
+    if target == 0 or bits & 0x00800000:
+        return 0
+    return (1 << 256) // (target + 1)
+
+
+def script_ops(script):
+    offset = 0
+    while offset < len(script):
+        opcode = script[offset]
+        offset += 1
+        if opcode > OP_PUSHDATA4:
+            yield opcode, None
+            continue
+
+        if opcode < OP_PUSHDATA1:
+            size = opcode
+        elif opcode == OP_PUSHDATA1 and offset + 1 <= len(script):
+            size = script[offset]
+            offset += 1
+        elif opcode == OP_PUSHDATA2 and offset + 2 <= len(script):
+            size = struct.unpack_from('<H', script, offset)[0]
+            offset += 2
+        elif opcode == OP_PUSHDATA4 and offset + 4 <= len(script):
+            size = struct.unpack_from('<I', script, offset)[0]
+            offset += 4
+        else:
+            raise ValueError('Truncated push')
+
+        if offset + size > len(script):
+            raise ValueError('Truncated push')
+        yield opcode, script[offset:offset+size]
+        offset += size
+
+
+def script_num(data):
+    if len(data) == 0:
+        return 0
+    value = 0
+    for index, byte in enumerate(data):
+        value |= byte << (8 * index)
+    if data[-1] & 0x80:
+        return -(value & ~(0x80 << (8 * (len(data) - 1))))
+    return value
+
+
+def script_to_asm(script):
+    parts = []
+    try:
+        for opcode, pushdata in script_ops(script):
+            if pushdata is not None:
+                parts.append(str(script_num(pushdata)) if len(pushdata) <= 4 else hexstr(pushdata))
+            elif opcode == OP_1NEGATE:
+                parts.append('-1')
+            elif OP_1 <= opcode <= OP_16:
+                parts.append(str(opcode - OP_1 + 1))
+            else:
+                parts.append(OPCODE_NAMES.get(opcode, 'OP_UNKNOWN'))
+    except ValueError:
+        parts.append('[error]')
+    return ' '.join(parts)
+
+
+def classify_script(script):
+    size = len(script)
+
+    if size == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL:
+        return 'scripthash', [ ('p2sh', script[2:22]) ]
+
+    if 4 <= size <= 42 and (script[0] == OP_0 or OP_1 <= script[0] <= OP_16) and script[1] + 2 == size:
+        if script[0] == OP_0 and size == 22:
+            return 'witness_v0_keyhash', [ ('witness', script[2:]) ]
+        if script[0] == OP_0 and size == 34:
+            return 'witness_v0_scripthash', [ ('witness', script[2:]) ]
+        return 'witness_unknown', []
+
+    try:
+        ops = list(script_ops(script))
+    except ValueError:
+        return 'nonstandard', []
+
+    if size >= 1 and script[0] == OP_RETURN and all([ pushdata is not None or opcode <= OP_16 for opcode, pushdata in ops[1:] ]):
+        return 'nulldata', []
+
+    if len(ops) == 2 and ops[0][1] is not None and 33 <= len(ops[0][1]) <= 65 and ops[1][0] == OP_CHECKSIG:
+        return 'pubkey', [ ('p2pkh', hash160(bytes(ops[0][1]))) ]
+
+    if size == 25 and script[:3] == bytearray([OP_DUP, OP_HASH160, 20]) and script[23:] == bytearray([OP_EQUALVERIFY, OP_CHECKSIG]):
+        return 'pubkeyhash', [ ('p2pkh', script[3:23]) ]
+
+    if len(ops) >= 4 and ops[-1][0] == OP_CHECKMULTISIG and OP_1 <= ops[0][0] <= OP_16 and OP_1 <= ops[-2][0] <= OP_16:
+        pubkeys = ops[1:-2]
+        required = ops[0][0] - OP_1 + 1
+        if len(pubkeys) == ops[-2][0] - OP_1 + 1 and required <= len(pubkeys) and all([ p is not None and 33 <= len(p) <= 65 for _, p in pubkeys ]):
+            return 'multisig', [ ('p2pkh', hash160(bytes(p))) for _, p in pubkeys ]
+
+    return 'nonstandard', []
+
+
+class BlockParser(object):
+    def __init__(self, coin):
+        self.coin = coin
+
+    def encode_destination(self, kind, hash):
+        hash = bytes(hash)
+        if kind == 'p2pkh':
+            return encode_base58_address(self.coin['address_version'], hash)
+        if kind == 'p2sh':
+            return encode_base58_address(self.coin['p2sh_address_version'], hash)
+        if self.coin.get('bech32_prefix') is not None:
+            return encode_bech32_address(self.coin['bech32_prefix'], hash)
+        return None
+
+    def script_pubkey(self, script):
+        script_type, destinations = classify_script(script)
+        info = {
+            'asm': script_to_asm(script),
+            'hex': hexstr(script),
+            'type': script_type
+        }
+        addresses = [ self.encode_destination(kind, hash) for kind, hash in destinations ]
+        if len(addresses) > 0 and None not in addresses:
+            info['addresses'] = addresses
+        return info
+
+    def parse_transaction(self, data, offset):
+        start = offset
+        offset += 4
+
+        segwit = data[offset] == 0 and data[offset + 1] != 0
+        if segwit:
+            offset += 2
+        body_start = offset
+
+        vin = []
+        inputs, offset = read_varint(data, offset)
+        for _ in range(inputs):
+            prevout = data[offset:offset+32]
+            n = struct.unpack_from('<I', data, offset + 32)[0]
+            script_len, offset = read_varint(data, offset + 36)
+            script = data[offset:offset+script_len]
+            offset += script_len
+            sequence = struct.unpack_from('<I', data, offset)[0]
+            offset += 4
+
+            if prevout == NULL_HASH and n == 0xffffffff:
+                vin.append({'coinbase': hexstr(script), 'sequence': sequence})
+            else:
+                vin.append({'txid': hash_hexstr(prevout), 'vout': n, 'sequence': sequence})
+
+        vout = []
+        outputs, offset = read_varint(data, offset)
+        for n in range(outputs):
+            value = struct.unpack_from('<q', data, offset)[0]
+            script_len, offset = read_varint(data, offset + 8)
+            vout.append({
+                'value': Decimal(value) / COIN,
+                'n': n,
+                'scriptPubKey': self.script_pubkey(data[offset:offset+script_len])
+            })
+            offset += script_len
+        body_end = offset
+
+        if segwit:
+            for _ in range(inputs):
+                items, offset = read_varint(data, offset)
+                for _ in range(items):
+                    item_len, offset = read_varint(data, offset)
+                    offset += item_len
+
+        offset += 4
+        txid = hash_hexstr(sha256d(bytes(data[start:start+4] + data[body_start:body_end] + data[offset-4:offset])))
+
+        return {
+            'txid': txid,
+            'size': offset - start,
+            'vin': vin,
+            'vout': vout
+        }, offset
+
+    def parse_block(self, data, height):
+        data = bytearray(data)
+        version, prevhash, merkleroot, timestamp, bits, nonce = struct.unpack_from('<I32s32sIII', data, 0)
+
+        transactions = []
+        count, offset = read_varint(data, 80)
+        for _ in range(count):
+            txinfo, offset = self.parse_transaction(data, offset)
+            transactions.append(txinfo)
+
+        blockinfo = {
+            'hash': hash_hexstr(sha256d(bytes(data[:80]))),
+            'height': height,
+            'size': len(data),
+            'time': timestamp,
+            'difficulty': bits_to_difficulty(bits),
+            'previousblockhash': hash_hexstr(prevhash),
+            'tx': [ tx['txid'] for tx in transactions ]
+        }
+        return blockinfo, { tx['txid']: tx for tx in transactions }
+
+
+class BlockFileIndex(object):
+    def __init__(self, directory, magic=None, open_files=8):
+        self.files = sorted(glob(path.join(directory, 'blk*.dat')))
+        self.magic = magic
+        self.open_files = open_files
+        self.maps = {}
+
+        self.positions = {}
+        self.prevhashes = []
+        self.file_numbers = array('l')
+        self.offsets = array('l')
+        self.sizes = array('l')
+        self.bits = array('L')
+        self.chain = array('l')
+
+    def map(self, file_number):
+        if file_number not in self.maps:
+            if len(self.maps) >= self.open_files:
+                self.maps.pop(list(self.maps.keys())[0]).close()
+            with open(self.files[file_number], 'rb') as f:
+                self.maps[file_number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[file_number]
+
+    def close(self):
+        for data in self.maps.values():
+            data.close()
+        self.maps = {}
+
+    def check_obfuscation(self):
+        if len(self.files) == 0:
+            return
+        xorfile = path.join(path.dirname(self.files[0]), 'xor.dat')
+        if path.exists(xorfile):
+            with open(xorfile, 'rb') as f:
+                if f.read().strip(b'\0') != b'':
+                    raise Exception('Block files are obfuscated (%s), restart the daemon with -blocksxor=0 and reindex' % xorfile)
+
+    def scan(self):
+        start_time = time()
+        self.check_obfuscation()
+
+        for file_number, filename in enumerate(self.files):
+            if path.getsize(filename) < 8:
+                continue
+
+            data = self.map(file_number)
+            if self.magic is None:
+                self.magic = data[:4]
+
+            offset = 0
+            while offset + 8 + 80 <= len(data):
+                # Skip over preallocated zeroes and partially written blocks
+                # by resyncing on the next network magic.
+                size = struct.unpack_from('<I', data, offset + 4)[0]
+                if data[offset:offset+4] != self.magic or size < 80 or offset + 8 + size > len(data):
+                    offset = data.find(self.magic, offset + 1)
+                    if offset < 0:
+                        break
+                    continue
+
+                blockhash = sha256d(data[offset+8:offset+8+80])
+                if blockhash not in self.positions:
+                    self.positions[blockhash] = len(self.prevhashes)
+                    self.prevhashes.append(data[offset+12:offset+44])
+                    self.file_numbers.append(file_number)
+                    self.offsets.append(offset + 8)
+                    self.sizes.append(size)
+                    self.bits.append(struct.unpack_from('<I', data, offset + 8 + 72)[0])
+                offset += 8 + size
+
+        log_event('Scanned', 'blk', '%d files' % len(self.files), {'blocks': len(self.prevhashes), 'time': '%.1f sec' % (time() - start_time)})
+        self.build_chain()
+
+    def build_chain(self):
+        # Order by block index built from the headers: resolve parent links,
+        # then take the chain with the most cumulative work from nBits.
+        parents = array('l', [ self.positions.get(prevhash, -1) for prevhash in self.prevhashes ])
+        self.prevhashes = []
+
+        chainwork = [ None ] * len(parents)
+        for index in range(len(parents)):
+            walk = []
+            while index >= 0 and chainwork[index] is None:
+                walk.append(index)
+                index = parents[index]
+            work = chainwork[index] if index >= 0 else 0
+            for block in reversed(walk):
+                work += bits_to_work(self.bits[block])
+                chainwork[block] = work
+
+        self.chain = array('l')
+        if len(chainwork) == 0:
+            return
+
+        index = max(range(len(chainwork)), key=lambda i: chainwork[i])
+        while index >= 0:
+            self.chain.append(index)
+            index = parents[index]
+        self.chain.reverse()
+
+    @property
+    def height(self):
+        return len(self.chain) - 1
+
+    def blockhash(self, height):
+        index = self.chain[height]
+        data = self.map(self.file_numbers[index])
+        return sha256d(data[self.offsets[index]:self.offsets[index]+80])[::-1]
+
+    def read_block(self, height):
+        index = self.chain[height]
+        data = self.map(self.file_numbers[index])
+        return data[self.offsets[index]:self.offsets[index]+self.sizes[index]]
+
+
+class BlockFileImporter(object):
+    def __init__(self, db, directory, magic=None, tip_distance=10, daemon=None):
+        self.db = db
+        self.daemon = daemon
+        self.index = BlockFileIndex(path.expanduser(directory), magic=magic)
+        self.parser = BlockParser(db.coin)
+        self.tip_distance = tip_distance
+
+    def run(self):
+        self.index.scan()
+
+        chaintip = self.db.chaintip()
+        first_height = chaintip.height + 1 if chaintip is not None else 0
+        last_height = self.index.height - self.tip_distance
+
+        if chaintip is not None and (chaintip.height > self.index.height or self.index.blockhash(chaintip.height) != chaintip.hash):
+            raise Exception('Block files do not contain indexer chaintip %s' % hexlify(chaintip.hash))
+
+        if self.daemon is not None and last_height >= first_height:
+            blockhash = unhexlify(self.daemon.getblockhash(last_height))
+            if self.index.blockhash(last_height) != blockhash:
+                raise Exception('Block files chain at height %d does not match daemon block %s' % (last_height, hexlify(blockhash)))
+
+        log('\nImporting blocks %d to %d from block files...\n' % (first_height, last_height))
+
+        start_time = time()
+        newblock = None
+        next_commit = time() + 3
+        for height in range(first_height, last_height + 1):
+            blockinfo, transactions = self.parser.parse_block(self.index.read_block(height), height)
+            newblock = self.db.import_blockinfo(blockinfo, tx_resolver=transactions.__getitem__, commit=False)
+            if next_commit <= time():
+                log_block_event(hexlify(newblock.hash), 'Commit', height=height, blk_per_sec='%.1f' % ((height - first_height + 1) / (time() - start_time)))
+                self.db.session.commit()
+                newblock = None
+                next_commit = time() + 3
+
+        if newblock is not None:
+            log_block_event(hexlify(newblock.hash), 'Commit')
+            self.db.session.commit()
+
+        self.index.close()
@@ -0,0 +1,601 @@
+from binascii import unhexlify
+from bitcoinrpc.authproxy import AuthServiceProxy
+from collections import deque
+from datetime import datetime
+from multiprocessing import Pool
+from decimal import Decimal
+from sqlalchemy.orm import sessionmaker
+from time import time
+
+from database import classify_output_address, coinbase_main_output, coinbase_signature
+from logger import log, log_event
+from models import *
+from prefetch import BlockPrefetcher, fetch_block
+from rpc import RpcClient
+
+
+STAGING_TABLE = 'bulk_txin'
+
+ID_TABLES = [ Block.__tablename__, BlockTransaction.__tablename__, Transaction.__tablename__, TransactionOutput.__tablename__, Address.__tablename__, TransactionInput.__tablename__ ]
+
+# (table, column, table the id was allocated for) of every id in the queued rows
+ID_COLUMNS = [
+    (Block.__tablename__,               'id',           Block.__tablename__),
+    (BlockTransaction.__tablename__,    'id',           BlockTransaction.__tablename__),
+    (BlockTransaction.__tablename__,    'transaction',  Transaction.__tablename__),
+    (BlockTransaction.__tablename__,    'block',        Block.__tablename__),
+    (Transaction.__tablename__,         'id',           Transaction.__tablename__),
+    (Transaction.__tablename__,         'confirmation', BlockTransaction.__tablename__),
+    (TransactionOutput.__tablename__,   'id',           TransactionOutput.__tablename__),
+    (TransactionOutput.__tablename__,   'transaction',  Transaction.__tablename__),
+    (CoinbaseInfo.__tablename__,        'block',        Block.__tablename__),
+    (CoinbaseInfo.__tablename__,        'transaction',  Transaction.__tablename__),
+    (CoinbaseInfo.__tablename__,        'mainoutput',   TransactionOutput.__tablename__),
+    (STAGING_TABLE,                     'id',           TransactionInput.__tablename__),
+    (STAGING_TABLE,                     'transaction',  Transaction.__tablename__)
+]
+
+
+# Pooled daemon client of a bulk load worker process, set up by init_worker
+worker_rpc = None
+worker_next_stats = 0
+
+
+def init_worker(daemon_url, retries, stats_interval):
+    global worker_rpc, worker_next_stats
+    worker_rpc = RpcClient(lambda: AuthServiceProxy(daemon_url), connections=1, retries=retries)
+    worker_next_stats = time() + stats_interval
+
+
+def load_chunk(args):
+    # Runs in a worker process: fetches, decodes and converts a range of
+    # blocks to rows. Ids are allocated from zero, the coordinator rebases
+    # them onto the global ids when it takes the chunk in height order.
+    global worker_next_stats
+    first_height, last_height, batch_size, stats_interval = args
+
+    rows = BlockRows()
+    last_hash = None
+    for height in range(first_height, last_height + 1):
+        prefetched = fetch_block(worker_rpc, height, batch_size=batch_size)
+        rows.load_block(prefetched.blockinfo, prefetched.transactions)
+        last_hash = prefetched.hash
+
+    if worker_next_stats <= time():
+        worker_rpc.log_stats()
+        worker_next_stats = time() + stats_interval
+
+    return first_height, last_height, last_hash, rows.rows, rows.next_ids, rows.blocks_loaded, rows.txs_loaded
+
+
+class BlockRows(object):
+    # Rows of a run of whole blocks, ids are allocated sequentially on top of next_ids
+    def __init__(self, next_ids=None, addresses=None):
+        self.rows = {}
+        self.next_ids = next_ids if next_ids is not None else dict([ (table, 0) for table in ID_TABLES ])
+        self.addresses = addresses if addresses is not None else {}
+
+        self.blocks_loaded = 0
+        self.txs_loaded = 0
+
+    def allocate_id(self, table):
+        self.next_ids[table] += 1
+        return self.next_ids[table]
+
+    def queue_row(self, table, row):
+        if table not in self.rows:
+            self.rows[table] = []
+        self.rows[table].append(row)
+
+    def load_block(self, blockinfo, transactions):
+        height = int(blockinfo['height'])
+        block_id = self.allocate_id(Block.__tablename__) if height > 0 else 0
+        txids = blockinfo['tx'] if height > 0 else []
+
+        for tx_index, txid in enumerate(txids):
+            txinfo = transactions[txid]
+            tx_id = self.allocate_id(Transaction.__tablename__)
+            blocktx_id = self.allocate_id(BlockTransaction.__tablename__)
+
+            self.queue_row(BlockTransaction.__tablename__, {'id': blocktx_id, 'transaction': tx_id, 'block': block_id})
+
+            coinbase_inputs = list(filter(lambda txin: 'coinbase' in txin, txinfo['vin']))
+            regular_inputs = list(filter(lambda txin: 'coinbase' not in txin, txinfo['vin']))
+
+            for index, inp in enumerate(regular_inputs):
+                self.queue_row(STAGING_TABLE, {
+                    'id': self.allocate_id(TransactionInput.__tablename__),
+                    'transaction': tx_id,
+                    'index': index,
+                    'prevtxid': unhexlify(inp['txid']),
+                    'prevout': inp['vout']
+                })
+
+            total_out = Decimal(0.0)
+            output_ids = {}
+            for outp in txinfo['vout']:
+                output_ids[outp['n']] = self.allocate_id(TransactionOutput.__tablename__)
+                self.queue_row(TransactionOutput.__tablename__, {
+                    'id': output_ids[outp['n']],
+                    'transaction': tx_id,
+                    'index': outp['n'],
+                    'type': TXOUT_TYPES.internal_id(TXOUT_TYPES.from_rpcapi_type(outp['scriptPubKey']['type'])),
+                    'address': self.address_id(outp['scriptPubKey']),
+                    'amount': outp['value'],
+                    'spentby': None
+                })
+                total_out += outp['value']
+
+            # Fees (and totalvalue of non-coinbase transactions) are filled in by the post-pass
+            self.queue_row(Transaction.__tablename__, {
+                'id': tx_id,
+                'txid': unhexlify(txid),
+                'size': txinfo['size'],
+                'fee': Decimal(0.0),
+                'totalvalue': total_out,
+                'firstseen': datetime.utcfromtimestamp(txinfo['relayedat']) if 'relayedat' in txinfo and txinfo['relayedat'] is not None else None,
+                'relayedby': txinfo['relayedby'] if 'relayedby' in txinfo else None,
+                'confirmation': blocktx_id,
+                'doublespends': None
+            })
+
+            if tx_index == 0 and len(coinbase_inputs) > 0:
+                raw = unhexlify(coinbase_inputs[0]['coinbase'])
+                main_output = coinbase_main_output([
+                    (txo['n'], txo['scriptPubKey']['addresses'][0], txo['value'])
+                    for txo in txinfo['vout']
+                    if txo['value'] > 0.0 and 'addresses' in txo['scriptPubKey'] and len(txo['scriptPubKey']['addresses']) == 1
+                ])
+                self.queue_row(CoinbaseInfo.__tablename__, {
+                    'block': block_id,
+                    'transaction': tx_id,
+                    'newcoins': total_out,
+                    'raw': raw,
+                    'signature': coinbase_signature(raw)[0],
+                    'mainoutput': output_ids[main_output[0]] if main_output is not None else None
+                })
+
+        self.queue_row(Block.__tablename__, {
+            'id': block_id,
+            'hash': unhexlify(blockinfo['hash']),
+            'height': height,
+            'size': blockinfo['size'],
+            'totalfee': Decimal(0.0),
+            'timestamp': datetime.utcfromtimestamp(blockinfo['time']),
+            'difficulty': blockinfo['difficulty'],
+            'firstseen': datetime.utcfromtimestamp(blockinfo['relayedat']) if 'relayedat' in blockinfo and blockinfo['relayedat'] is not None else None,
+            'relayedby': blockinfo['relayedby'] if 'relayedby' in blockinfo else None,
+            'miner': None
+        })
+
+        self.blocks_loaded += 1
+        self.txs_loaded += len(txids)
+
+    def address_id(self, txout_address_info):
+        address, addr_type, raw = classify_output_address(txout_address_info)
+
+        if address is not None and address in self.addresses:
+            return self.addresses[address]
+
+        address_id = self.allocate_id(Address.__tablename__)
+        if address is not None:
+            self.addresses[address] = address_id
+
+        self.queue_row(Address.__tablename__, {
+            'id': address_id,
+            'type': ADDRESS_TYPES.internal_id(addr_type),
+            'address': address,
+            'raw': raw,
+            'balance': Decimal(0.0),
+            'balance_dirty': 0
+        })
+        return address_id
+
+
+class BulkLoader(BlockRows):
+    STAGING_TABLE = STAGING_TABLE
+
+    # Post-pass progress is checkpointed in the `migration` table under this prefix
+    POSTPASS_CHECKPOINT = 'bulk:'
+
+    # Secondary indexes that are not needed during the load (and are not
+    # backing any foreign key), these are rebuilt once after the post-pass.
+    DEFERRED_INDEXES = [
+        ('address',     'addresstype',      '(`type`,`address`)'),
+        ('address',     'balance',          '(`balance`)'),
+        ('address',     'balance_dirty',    '(`balance_dirty`)'),
+        ('block',       'timestamp',        '(`timestamp`)'),
+        ('coinbase',    'signature',        '(`signature`)'),
+        ('transaction', 'mempool',          '(`mempool`)'),
+        ('txout',       'address_utxo',     '(`address`,`spentby`)')
+    ]
+
+    def __init__(self, context, insert_rows=5000, postpass_chunk=100000):
+        self.context = context
+        self.db = context.db
+        self.connection = None
+        self.session = None
+        self.insert_rows = insert_rows
+        self.postpass_chunk = postpass_chunk
+
+        super(BulkLoader, self).__init__(next_ids={})
+
+    def connect(self):
+        # Own connection with foreign key and unique checks off. It is discarded
+        # by close(), so these settings never reach the pooled connections.
+        self.connection = self.db.session.get_bind().connect()
+        self.session = sessionmaker(bind=self.connection)()
+        self.session.execute('SET SESSION foreign_key_checks = 0;')
+        self.session.execute('SET SESSION unique_checks = 0;')
+        self.session.execute('SET SESSION sql_mode = CONCAT(@@sql_mode, \',NO_AUTO_VALUE_ON_ZERO\');')
+        self.session.commit()
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.session.close()
+        self.connection.invalidate()
+        self.connection.close()
+        self.connection = None
+        self.session = None
+
+        # Continue from what the bulk load committed
+        self.db.reset_session()
+
+    def staging_exists(self):
+        return self.session.execute('SHOW TABLES LIKE \'%s\';' % self.STAGING_TABLE).first() is not None
+
+    def index_exists(self, table, name):
+        return self.session.execute('SHOW INDEX FROM `%s` WHERE `Key_name` = :name;' % table, {'name': name}).first() is not None
+
+    def max_id(self, table):
+        return int(self.session.execute('SELECT COALESCE(MAX(`id`), 0) FROM `%s`;' % table).first()[0])
+
+    def setup(self):
+        self.connect()
+
+        if not self.staging_exists():
+            if self.session.query(Transaction.id).first() is not None:
+                raise Exception('Bulk load requires an empty database')
+
+            log_event('Create', 'tbl', self.STAGING_TABLE)
+            self.session.execute('''
+                CREATE TABLE `%s` (
+                    `id` bigint(20) NOT NULL,
+                    `transaction` bigint(20) NOT NULL,
+                    `index` int(11) NOT NULL,
+                    `prevtxid` binary(32) NOT NULL,
+                    `prevout` int(11) NOT NULL,
+                    PRIMARY KEY (`id`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+            ''' % self.STAGING_TABLE)
+
+            for table, name, _ in self.DEFERRED_INDEXES:
+                if self.index_exists(table, name):
+                    log_event('Drop', 'idx', '%s.%s' % (table, name))
+                    self.session.execute('ALTER TABLE `%s` DROP INDEX `%s`;' % (table, name))
+        else:
+            log('Resuming interrupted bulk load')
+
+        for table in [ Block.__tablename__, BlockTransaction.__tablename__, Transaction.__tablename__, TransactionOutput.__tablename__, Address.__tablename__ ]:
+            self.next_ids[table] = self.max_id(table)
+        self.next_ids[TransactionInput.__tablename__] = max(self.max_id(TransactionInput.__tablename__), self.max_id(self.STAGING_TABLE))
+
+        self.addresses = dict(self.session.query(Address.address, Address.id).filter(Address.address != None).all())
+        self.session.commit()
+
+    def flush_rows(self, force=False):
+        if not force and max([ len(rows) for rows in self.rows.values() ] + [0]) < self.insert_rows:
+            return False
+
+        # One multi-row INSERT per table. Rows are only queued for whole blocks,
+        # so an interrupted load can always resume after the current chaintip.
+        for table in [ Address.__table__, Transaction.__table__, TransactionOutput.__table__, BlockTransaction.__table__, CoinbaseInfo.__table__, Block.__table__ ]:
+            rows = self.rows.pop(table.name, [])
+            if len(rows) > 0:
+                self.session.execute(table.insert(), rows)
+
+        rows = self.rows.pop(self.STAGING_TABLE, [])
+        if len(rows) > 0:
+            self.session.execute('INSERT INTO `%s` (`id`, `transaction`, `index`, `prevtxid`, `prevout`) VALUES (:id, :transaction, :index, :prevtxid, :prevout);' % self.STAGING_TABLE, rows)
+
+        self.session.commit()
+        return True
+
+    def load(self, first_height, last_height, prefetch_depth=16, prefetch_threads=4, batch_size=500):
+        log('\nBulk loading blocks %d to %d...\n' % (first_height, last_height))
+
+        start_time = last_report = time()
+        with BlockPrefetcher(self.context.batch_rpc, first_height, last_height, depth=prefetch_depth, threads=prefetch_threads, batch_size=batch_size) as prefetcher:
+            for prefetched in prefetcher:
+                self.load_block(prefetched.blockinfo, prefetched.transactions)
+
+                if self.flush_rows() and time() - last_report >= 10:
+                    self.report(start_time, prefetched.height, prefetched.hash)
+                    last_report = time()
+
+        self.flush_rows(force=True)
+        self.report(start_time)
+
+    def load_parallel(self, first_height, last_height, processes=4, chunk_size=100, batch_size=500):
+        log('\nBulk loading blocks %d to %d in %d processes...\n' % (first_height, last_height, processes))
+
+        stats_interval = self.context.SCHEDULER_STATS_INTERVAL
+        chunks = [ (start, min(start + chunk_size - 1, last_height), batch_size, stats_interval) for start in range(first_height, last_height + 1, chunk_size) ]
+        pending = deque()
+
+        start_time = last_report = time()
+        pool = Pool(processes, initializer=init_worker, initargs=(self.context.DAEMON_URL, self.context.RPC_RETRIES, stats_interval))
+        try:
+            # Bounded look-ahead, chunks are taken in submission (= height) order
+            for chunk in chunks:
+                pending.append(pool.apply_async(load_chunk, (chunk,)))
+                if len(pending) >= processes * 2:
+                    last_report = self.take_chunk(pending.popleft().get(), start_time, last_report)
+            while len(pending) > 0:
+                last_report = self.take_chunk(pending.popleft().get(), start_time, last_report)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.flush_rows(force=True)
+        self.report(start_time)
+
+    def take_chunk(self, result, start_time, last_report):
+        first_height, last_height, last_hash, rows, counts, blocks, txs = result
+
+        self.merge_addresses(rows, counts)
+        for table, column, id_table in ID_COLUMNS:
+            offset = self.next_ids[id_table]
+            for row in rows.get(table, []):
+                # Zero is the genesis block, which keeps its id
+                if row[column]:
+                    row[column] += offset
+
+        for table in ID_TABLES:
+            if table != Address.__tablename__:
+                self.next_ids[table] += counts[table]
+        for table, table_rows in rows.items():
+            self.rows.setdefault(table, []).extend(table_rows)
+
+        self.blocks_loaded += blocks
+        self.txs_loaded += txs
+
+        if self.flush_rows() and time() - last_report >= 10:
+            self.report(start_time, last_height, last_hash)
+            return time()
+        return last_report
+
+    def merge_addresses(self, rows, counts):
+        # Addresses were only deduplicated within the chunk, the ones already
+        # known get their existing id, only new ones get a row inserted.
+        address_ids = [ None ] * (counts[Address.__tablename__] + 1)
+        new_rows = []
+        for row in rows.pop(Address.__tablename__, []):
+            if row['address'] is not None and row['address'] in self.addresses:
+                address_ids[row['id']] = self.addresses[row['address']]
+                continue
+
+            address_id = self.allocate_id(Address.__tablename__)
+            address_ids[row['id']] = address_id
+            row['id'] = address_id
+            if row['address'] is not None:
+                self.addresses[row['address']] = row['id']
+            new_rows.append(row)
+
+        if len(new_rows) > 0:
+            rows[Address.__tablename__] = new_rows
+        for row in rows.get(TransactionOutput.__tablename__, []):
+            row['address'] = address_ids[row['address']]
+
+    def report(self, start_time, height=None, blockhash=None):
+        elapsed = max(time() - start_time, 0.001)
+        log_event('Bulk', 'blk', blockhash if blockhash is not None else 'done', {
+            'height': height,
+            'blocks': self.blocks_loaded,
+            'txs': self.txs_loaded,
+            'blk/s': '%.1f' % (self.blocks_loaded / elapsed),
+            'tx/s': '%.1f' % (self.txs_loaded / elapsed)
+        })
+
+    def postpass_checkpoint(self, description):
+        row = self.session.execute('SELECT `lastid` FROM `migration` WHERE `name` = :name;', {'name': self.POSTPASS_CHECKPOINT + description}).first()
+        return int(row[0]) if row is not None else None
+
+    def run_chunked(self, description, table, statement, checkpoint=True):
+        first_id = int(self.session.execute('SELECT COALESCE(MIN(`id`), 0) FROM `%s`;' % table).first()[0])
+        last_id = self.max_id(table)
+
+        # Steps inserting rows are not idempotent, an interrupted post-pass
+        # continues after the last chunk committed (rows loaded since have higher ids).
+        done_id = self.postpass_checkpoint(description) if checkpoint else None
+        if done_id is not None:
+            log_event('Resume', 'sql', description, {'after': done_id})
+            first_id = max(first_id, done_id + 1)
+
+        start_time = time()
+        rows = 0
+        for chunk_start in range(first_id, last_id + 1, self.postpass_chunk):
+            rows += self.session.execute(statement, {'first': chunk_start, 'last': chunk_start + self.postpass_chunk - 1}).rowcount
+            if checkpoint:
+                # Committed together with the chunk
+                self.session.execute('''
+                    INSERT INTO `migration` (`name`, `lastid`, `done`) VALUES (:name, :last_id, '0')
+                        ON DUPLICATE KEY UPDATE `lastid` = VALUES(`lastid`);
+                ''', {'name': self.POSTPASS_CHECKPOINT + description, 'last_id': chunk_start + self.postpass_chunk - 1})
+            self.session.commit()
+
+        log_event('Bulk', 'sql', description, {'rows': rows, 'time': '%.1f sec' % (time() - start_time)})
+
+    def postpass(self):
+        log('\nRunning bulk load post-pass...\n')
+
+        self.run_chunked('inputs', self.STAGING_TABLE, '''
+            INSERT INTO `txin` (`id`, `transaction`, `index`, `input`)
+                SELECT `staging`.`id`, `staging`.`transaction`, `staging`.`index`, `txout`.`id` FROM `%s` `staging`
+                    JOIN `transaction` ON `transaction`.`txid` = `staging`.`prevtxid`
+                    JOIN `txout` ON `txout`.`transaction` = `transaction`.`id` AND `txout`.`index` = `staging`.`prevout`
+                WHERE `staging`.`id` BETWEEN :first AND :last;
+        ''' % self.STAGING_TABLE)
+
+        self.run_chunked('spentby', TransactionInput.__tablename__, '''
+            UPDATE `txout` JOIN `txin` ON `txout`.`id` = `txin`.`input`
+                SET `txout`.`spentby` = `txin`.`id`
+            WHERE `txin`.`id` BETWEEN :first AND :last;
+        ''')
+
+        self.run_chunked('tx totals', Transaction.__tablename__, '''
+            UPDATE `transaction` JOIN (
+                SELECT `txin`.`transaction`, SUM(`txout`.`amount`) AS `total_in` FROM `txin`
+                    JOIN `txout` ON `txin`.`input` = `txout`.`id`
+                WHERE `txin`.`transaction` BETWEEN :first AND :last
+                GROUP BY `txin`.`transaction`
+            ) `inputs` ON `transaction`.`id` = `inputs`.`transaction`
+                SET `transaction`.`totalvalue` = `inputs`.`total_in`,
+                    `transaction`.`fee` = `inputs`.`total_in` - (
+                        SELECT SUM(`txout`.`amount`) FROM `txout` WHERE `txout`.`transaction` = `inputs`.`transaction`
+                    );
+        ''')
+
+        self.run_chunked('block fees', Block.__tablename__, '''
+            UPDATE `block` JOIN (
+                SELECT `blocktx`.`block`, SUM(`transaction`.`fee`) AS `totalfee` FROM `blocktx`
+                    JOIN `transaction` ON `blocktx`.`transaction` = `transaction`.`id`
+                WHERE `blocktx`.`block` BETWEEN :first AND :last
+                GROUP BY `blocktx`.`block`
+            ) `fees` ON `block`.`id` = `fees`.`block`
+                SET `block`.`totalfee` = `fees`.`totalfee`;
+        ''')
+
+        self.run_chunked('newcoins', Block.__tablename__, '''
+            UPDATE `coinbase`
+                JOIN `block` ON `coinbase`.`block` = `block`.`id`
+                JOIN `transaction` ON `coinbase`.`transaction` = `transaction`.`id`
+                SET `coinbase`.`newcoins` = `transaction`.`totalvalue` - `block`.`totalfee`
+            WHERE `coinbase`.`block` BETWEEN :first AND :last;
+        ''')
+
+        self.run_chunked('block summaries', Block.__tablename__, '''
+            UPDATE `block`
+                JOIN (
+                    SELECT `blocktx`.`block`, COUNT(*) AS `txcount`, SUM(IF(ISNULL(`coinbase`.`transaction`), `transaction`.`totalvalue`, 0.0)) AS `transacted` FROM `blocktx`
+                        JOIN `transaction` ON `blocktx`.`transaction` = `transaction`.`id`
+                        LEFT JOIN `coinbase` ON `transaction`.`id` = `coinbase`.`transaction`
+                    WHERE `blocktx`.`block` BETWEEN :first AND :last
+                    GROUP BY `blocktx`.`block`
+                ) `txs` ON `block`.`id` = `txs`.`block`
+                LEFT JOIN (
+                    SELECT `blocktx`.`block`, COUNT(*) AS `inputcount` FROM `blocktx`
+                        JOIN `txin` ON `blocktx`.`transaction` = `txin`.`transaction`
+                    WHERE `blocktx`.`block` BETWEEN :first AND :last
+                    GROUP BY `blocktx`.`block`
+                ) `inputs` ON `block`.`id` = `inputs`.`block`
+                JOIN (
+                    SELECT `blocktx`.`block`, COUNT(*) AS `outputcount` FROM `blocktx`
+                        JOIN `txout` ON `blocktx`.`transaction` = `txout`.`transaction`
+                    WHERE `blocktx`.`block` BETWEEN :first AND :last
+                    GROUP BY `blocktx`.`block`
+                ) `outputs` ON `block`.`id` = `outputs`.`block`
+                SET `block`.`txcount` = `txs`.`txcount`,
+                    `block`.`inputcount` = COALESCE(`inputs`.`inputcount`, 0),
+                    `block`.`outputcount` = `outputs`.`outputcount`,
+                    `block`.`transacted` = `txs`.`transacted`
+            WHERE `block`.`txcount` IS NULL;
+        ''')
+
+        self.run_chunked('mutations', Transaction.__tablename__, '''
+            INSERT INTO `mutation` (`transaction`, `address`, `amount`)
+                SELECT `transaction`, `address`, SUM(`amount`) FROM (
+                    SELECT `txout`.`transaction`, `txout`.`address`, `txout`.`amount` FROM `txout`
+                        WHERE `txout`.`transaction` BETWEEN :first AND :last
+                UNION ALL
+                    SELECT `txin`.`transaction`, `txout`.`address`, '0' - `txout`.`amount` FROM `txin`
+                        JOIN `txout` ON `txin`.`input` = `txout`.`id`
+                    WHERE `txin`.`transaction` BETWEEN :first AND :last
+                ) temp
+                    GROUP BY `transaction`, `address`;
+        ''')
+
+        # Absolute values, redone completely: blocks loaded after an interruption may touch any address
+        self.run_chunked('balances', Address.__tablename__, '''
+            UPDATE `address` JOIN (
+                SELECT `txout`.`address`, SUM(`txout`.`amount`) AS `balance` FROM `txout`
+                WHERE `txout`.`address` BETWEEN :first AND :last
+                    AND `txout`.`spentby` IS NULL
+                GROUP BY `txout`.`address`
+            ) `utxos` ON `address`.`id` = `utxos`.`address`
+                SET `address`.`balance` = `utxos`.`balance`, `address`.`balance_dirty` = '0';
+        ''', checkpoint=False)
+
+        self.assign_miners()
+        self.update_cache()
+
+        for table, name, columns in self.DEFERRED_INDEXES:
+            if not self.index_exists(table, name):
+                log_event('Create', 'idx', '%s.%s' % (table, name))
+                self.session.execute('ALTER TABLE `%s` ADD INDEX `%s` %s;' % (table, name, columns))
+
+        log_event('Drop', 'tbl', self.STAGING_TABLE)
+        self.session.execute('DROP TABLE `%s`;' % self.STAGING_TABLE)
+        self.session.execute('DELETE FROM `migration` WHERE `name` LIKE :prefix;', {'prefix': self.POSTPASS_CHECKPOINT + '%'})
+        self.session.commit()
+
+    def assign_miners(self):
+        # Known pool signatures, then known pool payout addresses
+        self.session.execute('''
+            UPDATE `block`
+                JOIN `coinbase` ON `block`.`id` = `coinbase`.`block`
+                JOIN `poolsignature` ON `coinbase`.`signature` = `poolsignature`.`signature`
+                SET `block`.`miner` = `poolsignature`.`pool`
+            WHERE LENGTH(`coinbase`.`raw`) > 8;
+        ''')
+        assign_by_address = '''
+            UPDATE `block`
+                JOIN `coinbase` ON `block`.`id` = `coinbase`.`block`
+                JOIN `txout` ON `coinbase`.`mainoutput` = `txout`.`id`
+                JOIN `pooladdress` ON `txout`.`address` = `pooladdress`.`address`
+                SET `block`.`miner` = `pooladdress`.`pool`
+            WHERE `block`.`miner` IS NULL;
+        '''
+        self.session.execute(assign_by_address)
+
+        # Everything else gets a pool per payout address, like find_and_set_miner() does
+        self.session.execute('''
+            INSERT IGNORE INTO `pool` (`group`, `solo`, `name`)
+                SELECT IF(MAX(LENGTH(`coinbase`.`raw`)) <= 8, :solo_group, NULL), IF(MAX(LENGTH(`coinbase`.`raw`)) <= 8, 1, 0),
+                       CONCAT(`address`.`address`, IF(MAX(LENGTH(`coinbase`.`raw`)) <= 8, ' (Solo miner)', ' (Unknown Pool)'))
+                FROM `block`
+                    JOIN `coinbase` ON `block`.`id` = `coinbase`.`block`
+                    JOIN `txout` ON `coinbase`.`mainoutput` = `txout`.`id`
+                    JOIN `address` ON `txout`.`address` = `address`.`id`
+                WHERE `block`.`miner` IS NULL
+                GROUP BY `address`.`id`;
+        ''', {'solo_group': SOLO_POOL_GROUP_ID})
+        self.session.execute('''
+            INSERT IGNORE INTO `pooladdress` (`address`, `pool`)
+                SELECT `address`.`id`, `pool`.`id` FROM `pool`
+                    JOIN `address` ON `pool`.`name` IN (CONCAT(`address`.`address`, ' (Solo miner)'), CONCAT(`address`.`address`, ' (Unknown Pool)'))
+                WHERE `address`.`id` IN (
+                    SELECT `txout`.`address` FROM `block`
+                        JOIN `coinbase` ON `block`.`id` = `coinbase`.`block`
+                        JOIN `txout` ON `coinbase`.`mainoutput` = `txout`.`id`
+                    WHERE `block`.`miner` IS NULL
+                );
+        ''')
+        self.session.execute(assign_by_address)
+        self.session.commit()
+        log_event('Bulk', 'sql', 'miners')
+
+    def update_cache(self):
+        # Runs on the indexer session, which has to see the post-pass commits
+        self.db.reset_session()
+        cache = self.db.cache
+
+        block_stats = self.db.block_stats(use_cache=False)
+        cache.total_blocks = block_stats['blocks']
+        cache.total_fees = block_stats['totalfees'] or 0
+        cache.total_coins_released = block_stats['coinsreleased'] or 0
+        cache.total_transactions = self.db.transaction_stats()['transactions']
+        self.session.commit()
+        log_event('Updated', 'blk', 'cache')
+        log_event('Updated', 'tx', 'cache')
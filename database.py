@@ -2,7 +2,7 @@ from binascii import hexlify, unhexlify
 from datetime import datetime
 from decimal import Decimal
 from cachetools import LFUCache, RRCache
-from sqlalchemy import create_engine, tuple_, or_, func as sqlfunc
+from sqlalchemy import create_engine, event, text, tuple_, or_, func as sqlfunc
 from sqlalchemy.orm import sessionmaker
 from sys import version_info
 from time import time
@@ -11,6 +11,9 @@ from config import Configuration
 from coinsupport import coins
 from coinsupport.addresscodecs import decode_any_address, encode_base58_address
 from models import *
+from idranges import IdRanges
+from txidindex import TxidIndex, TxidIndexWriter
+from utxocache import UtxoCache
 from postprocessor import convert_date
 from logger import *
 
@@ -19,6 +22,118 @@ INTEGER_TYPES = [int] if version_info[0] > 2 else [int, long]
 
 EPOCH = datetime.fromtimestamp(0)
 
+# Spent outputs of at least this many inputs are resolved by joining a
+# temporary table instead of one predicate per input, in chunks of this size.
+INPUT_JOIN_THRESHOLD = 100
+INPUT_JOIN_CHUNK_SIZE = 5000
+
+# Schema changes made after the initial schema: a query telling whether the
+# change is already present (None if the statement is idempotent) and the
+# statement applying it. Executed in order on startup.
+SCHEMA_UPGRADES = [
+    (None, '''
+        CREATE TABLE IF NOT EXISTS `blockundo` (
+          `block` int(11) NOT NULL,
+          `transactions` int(11) NOT NULL,
+          `fees` decimal(16,8) NOT NULL,
+          `newcoins` decimal(16,8) NOT NULL,
+          PRIMARY KEY (`block`),
+          CONSTRAINT `fk_blockundo_block` FOREIGN KEY (`block`) REFERENCES `block` (`id`) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+    '''),
+    (None, '''
+        CREATE TABLE IF NOT EXISTS `blockundoentry` (
+          `id` bigint(20) NOT NULL AUTO_INCREMENT,
+          `block` int(11) NOT NULL,
+          `txout` bigint(20) DEFAULT NULL,
+          `address` int(11) DEFAULT NULL,
+          `amount` decimal(16,8) DEFAULT NULL,
+          PRIMARY KEY (`id`),
+          KEY `fk_blockundoentry_block_idx` (`block`),
+          CONSTRAINT `fk_blockundoentry_block` FOREIGN KEY (`block`) REFERENCES `block` (`id`) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+    '''),
+    (None, '''
+        CREATE TABLE IF NOT EXISTS `migration` (
+          `name` varchar(32) NOT NULL,
+          `lastid` bigint(20) NOT NULL,
+          `done` tinyint(1) NOT NULL,
+          PRIMARY KEY (`name`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+    '''),
+    ('''
+        SELECT COUNT(*) FROM `information_schema`.`COLUMNS`
+            WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'transaction' AND `COLUMN_NAME` = 'evicted';
+    ''', '''
+        ALTER TABLE `transaction`
+            ADD COLUMN `evicted` tinyint(1) NOT NULL DEFAULT '0' AFTER `doublespends`,
+            MODIFY COLUMN `mempool` tinyint(1) AS (IF(ISNULL(`confirmation`) AND ISNULL(`doublespends`) AND `evicted` = 0, '1', '0'));
+    '''),
+    (None, '''
+        CREATE TABLE IF NOT EXISTS `idsequence` (
+          `name` varchar(32) NOT NULL,
+          `nextid` bigint(20) NOT NULL,
+          PRIMARY KEY (`name`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+    '''),
+    ('''
+        SELECT COUNT(*) FROM `information_schema`.`COLUMNS`
+            WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'block' AND `COLUMN_NAME` = 'txcount';
+    ''', '''
+        ALTER TABLE `block`
+            ADD COLUMN `txcount` int(11) DEFAULT NULL AFTER `miner`,
+            ADD COLUMN `inputcount` int(11) DEFAULT NULL AFTER `txcount`,
+            ADD COLUMN `outputcount` int(11) DEFAULT NULL AFTER `inputcount`,
+            ADD COLUMN `transacted` decimal(16,8) DEFAULT NULL AFTER `outputcount`;
+    '''),
+    (None, '''
+        CREATE TABLE IF NOT EXISTS `verification` (
+          `id` tinyint(1) NOT NULL,
+          `lastblock` int(11) NOT NULL,
+          `clean` tinyint(1) NOT NULL,
+          PRIMARY KEY (`id`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+    '''),
+    # The checkpoint used to be kept in the `migration` table
+    (None, '''
+        INSERT IGNORE INTO `verification` (`id`, `lastblock`, `clean`)
+            SELECT 0, `lastid`, `done` FROM `migration` WHERE `name` = 'verify';
+    '''),
+    (None, '''
+        DELETE FROM `migration` WHERE `name` = 'verify';
+    ''')
+]
+
+
+def classify_output_address(txout_address_info):
+    raw = txout_address_info['asm']
+
+    if 'addresses' in txout_address_info and len(txout_address_info['addresses']) == 1:
+        address = txout_address_info['addresses'][0]
+        return address, (ADDRESS_TYPES.BECH32 if len(address) > 34 else ADDRESS_TYPES.BASE58), raw
+
+    if raw[0:10] == 'OP_RETURN ' and len(raw.split(' ')) == 2:
+        return None, ADDRESS_TYPES.DATA, raw.split(' ')[1]
+    return None, ADDRESS_TYPES.RAW, raw
+
+
+def coinbase_main_output(outputs):
+    totalout = sum([o[2] for o in outputs])
+    best_output = list(filter(lambda o: o[2] > (totalout * 95 / 100), outputs))
+    return best_output[0] if len(best_output) > 0 else None
+
+
+def coinbase_signature(raw):
+    solo = len(raw) <= 8
+
+    if not solo:
+        if raw[-1] == b'/' and b'/' in raw[:-1]:
+            try:
+                return raw.split(b'/')[-2].decode('utf-8').join(2 * ['/']), solo
+            except (IndexError, UnicodeDecodeError):
+                pass
+    return None, solo
+
 
 class Cache(object):
     ALL_IDS = [
@@ -109,13 +224,39 @@ class DatabaseSession(object):
     except AttributeError:
         coin = None
 
-    def __init__(self, session, address_cache, txid_cache, utxo_cache=None):
+    def __init__(self, session, address_cache, txid_cache, utxo_cache=None, id_ranges=None, undo_depth=None):
         self.session = session
         self._chaintip = None
 
+        # Undo journals are only kept for this many blocks below the imported
+        # block (None keeps them all), deeper reorgs recompute instead.
+        self.undo_depth = undo_depth
+
+        # Primary keys of transaction, txout, txin and address rows are never
+        # left to AUTO_INCREMENT. Standalone sessions reserve one id at a time.
+        self.id_ranges = id_ranges if id_ranges is not None else IdRanges(session.get_bind(), reserve=1)
+
         self.address_cache = address_cache
         self.txid_cache = txid_cache
         self.utxo_cache = utxo_cache
+        if utxo_cache is not None:
+            event.listen(session, 'after_commit', lambda session: utxo_cache.commit())
+            event.listen(session, 'after_rollback', lambda session: utxo_cache.rollback())
+
+        # Set by concurrent importers: leave the cache table and address
+        # balances to a full recalculation instead of updating them in place.
+        self.defer_aggregates = False
+
+        # Write-behind balance updates of confirmed transactions
+        self.balance_deltas = {}
+        self.dirty_balances = set()
+
+        # Balance changes of the block being imported, for its undo journal
+        self.undo_balances = {}
+        self.undo_dirty = set()
+
+        event.listen(session, 'before_commit', lambda session: self.flush_balances())
+        event.listen(session, 'after_rollback', lambda session: self.discard_balances())
 
     def __enter__(self):
         return self
@@ -129,6 +270,7 @@ class DatabaseSession(object):
 
     def reset_session(self):
         self.session.rollback()
+        self._chaintip = None
 
     @property
     def cache(self):
@@ -188,6 +330,10 @@ class DatabaseSession(object):
             self._chaintip = self.session.query(Block).filter(Block.height != None).order_by(Block.height.desc()).first()
         return self._chaintip
 
+    def committed_chaintip_height(self):
+        # Not cached, other sessions see the importer's commits after a reset
+        return self.session.query(sqlfunc.max(Block.height)).scalar()
+
     def current_coinbase_confirmation_height(self):
         tip = self.chaintip()
         return tip.height - 100 if tip != None else 0
@@ -208,6 +354,37 @@ class DatabaseSession(object):
             return self.session.query(Block).filter(Block.height >= start_height).order_by(Block.height).limit(limit).all()
         return self.session.query(Block).filter(Block.height >= start_height, Block.height % interval == start_height % interval).order_by(Block.height).limit(limit).all()
 
+    def block_hashes(self, heights=None, range=None):
+        query = self.session.query(Block.height, Block.hash)
+
+        if range is None:
+            query = query.filter(Block.height.in_(heights))
+        else:
+            query = query.filter(Block.height >= range[0], Block.height < range[1])
+        return dict(query.all())
+
+    def highest_block_hash(self, max_height):
+        return self.session.query(Block.height, Block.hash).filter(Block.height <= max_height).order_by(Block.height.desc()).first()
+
+    def missing_block_ranges(self, max_height):
+        return [
+            (int(start), int(end) if end is not None and end < max_height else max_height)
+            for start, end in self.session.execute('''
+                SELECT 1, MIN(`block`.`height`) - 1 FROM `block`
+                    WHERE `block`.`height` >= 0
+                    HAVING MIN(`block`.`height`) > 1
+                UNION ALL
+                SELECT `block`.`height` + 1, (
+                    SELECT MIN(`later`.`height`) FROM `block` `later` WHERE `later`.`height` > `block`.`height`
+                ) - 1 FROM `block`
+                    LEFT JOIN `block` `next` ON `next`.`height` = `block`.`height` + 1
+                WHERE `block`.`height` < :max_height
+                    AND `next`.`id` IS NULL;
+            ''', {
+                'max_height': max_height
+            }).fetchall()
+        ]
+
     def blockcount(self, range=None):
         query = self.session.query(sqlfunc.count(Block.id))
 
@@ -244,7 +421,18 @@ class DatabaseSession(object):
         address = self._get_base_address(address)
         if address == None:
             return None, None
-        return address, self.session.query(Address).filter(Address.address == address).first()
+        address_info = self.session.query(Address).filter(Address.address == address).first()
+        if address_info is not None and address_info.balance_dirty == 1:
+            self.prioritize_balance_update(address_info)
+        return address, address_info
+
+    def prioritize_balance_update(self, address_info):
+        # Recalculated ahead of the regular dirty queue by update_dirty_balances.
+        # Own connection and transaction, the request session is left alone.
+        with self.session.get_bind().begin() as connection:
+            connection.execute(text('UPDATE `address` SET `balance_dirty` = \'2\' WHERE `id` = :address_id AND `balance_dirty` = \'1\';'), {
+                'address_id': address_info.id
+            })
 
     def address_info(self, address):
         address, address_info = self._address_info(address)
@@ -372,13 +560,34 @@ class DatabaseSession(object):
         return result if not include_confirmation_info else result[0] if result != None else None
 
     def transaction_internal_id(self, txid):
-        _txid = unhexlify(txid)
-        if _txid in self.txid_cache:
-            return self.txid_cache[_txid]
+        tx_id = self.txid_cache.get(unhexlify(txid))
+        if tx_id is not None:
+            return tx_id
+
+        # The txid index covers every imported transaction, a miss is definitive
+        if isinstance(self.txid_cache, TxidIndexWriter):
+            return None
         tx = self.transaction(txid)
         return tx.id if tx is not None else None
 
-    def remove_blocks_without_coinbase(self):
+    def transaction_internal_ids(self, txids):
+        tx_ids = {}
+        missing = []
+        for txid in txids:
+            tx_id = self.txid_cache.get(unhexlify(txid))
+            if tx_id is not None:
+                tx_ids[txid] = tx_id
+            else:
+                missing.append(unhexlify(txid))
+
+        if isinstance(self.txid_cache, TxidIndexWriter):
+            return tx_ids
+        for start in range(0, len(missing), 1000):
+            for tx_id, txid in self.session.query(Transaction.id, Transaction.txid).filter(Transaction.txid.in_(missing[start:start+1000])).all():
+                tx_ids[hexlify(txid).decode('ascii')] = tx_id
+        return tx_ids
+
+    def remove_blocks_without_coinbase(self, since_block_id=-1):
         corrupt_blocks = self.session.query(
             Block
         ).join(
@@ -386,6 +595,7 @@ class DatabaseSession(object):
             isouter=True
         ).filter(
             Block.id != 0,  # Genesis doesn't have coinbase info
+            Block.id > since_block_id,
             CoinbaseInfo.block_id == None
         ).all()
 
@@ -395,7 +605,8 @@ class DatabaseSession(object):
 
         self.session.flush()
 
-    def verify_confirmed_transactions_state(self):
+    def verify_confirmed_transactions_state(self, since_block_id=-1):
+        unconfirmed = {}
         for (block_id, blocktransaction_id, transaction) in self.session.query(
                     Block.id,
                     BlockTransaction.id,
@@ -405,12 +616,16 @@ class DatabaseSession(object):
                 ).join(
                     BlockTransaction.transaction
                 ).filter(
+                    Block.id > since_block_id,
                     Block.height != None,
                     Transaction.confirmation_id == None
                 ).all():
-            self.confirm_transaction(hexlify(transaction.txid), block_id, tx_resolver=None)
+            unconfirmed.setdefault(block_id, []).append(transaction.id)
 
-    def verify_unconfirmed_transactions_state(self):
+        for block_id, tx_ids in unconfirmed.items():
+            self.confirm_block(block_id, tx_ids)
+
+    def verify_unconfirmed_transactions_state(self, since_block_id=-1):
         for transaction in self.session.query(
                     Transaction
                 ).join(
@@ -419,10 +634,27 @@ class DatabaseSession(object):
                     BlockTransaction.block,
                     isouter=True
                 ).filter(
+                    BlockTransaction.block_id > since_block_id,
                     Block.height == None
                 ).all():
             self.unconfirm_transaction(transaction)
 
+    def verification_checkpoint(self):
+        row = self.session.execute('SELECT `lastblock`, `clean` FROM `verification` WHERE `id` = 0;', {}).first()
+        return (row[0], bool(row[1])) if row is not None else (None, False)
+
+    def set_verification_checkpoint(self, clean):
+        # Moved forward after verifying and on a clean shutdown, the clean
+        # flag is cleared while running
+        self.session.execute('''
+            INSERT INTO `verification` (`id`, `lastblock`, `clean`)
+                SELECT 0, COALESCE(MAX(`id`), 0), :clean FROM `block`
+            ON DUPLICATE KEY UPDATE
+                `lastblock` = VALUES(`lastblock`),
+                `clean` = VALUES(`clean`);
+        ''', {'clean': 1 if clean else 0})
+        self.session.commit()
+
     def latest_transactions(self, confirmed_only=False, limit=100):
         return self.query_transactions(include_confirmation_info=False, confirmed_only=confirmed_only).order_by(Transaction.id.desc()).limit(limit).all()
 
@@ -555,16 +787,54 @@ class DatabaseSession(object):
     def mempool(self):
         return self.mempool_query().order_by(Transaction.id.desc()).all()
 
-    def import_blockinfo(self, blockinfo, tx_resolver=None, commit=True):
+    def mempool_txids(self):
+        return set([ hexlify(txid).decode('ascii') for (txid,) in self.mempool_query(result_columns=(Transaction.txid,)).all() ])
+
+    def set_evicted(self, txids, evicted=True):
+        for start in range(0, len(txids), 1000):
+            self.session.query(
+                Transaction
+            ).filter(
+                Transaction.txid.in_([ unhexlify(txid) for txid in txids[start:start+1000] ]),
+                Transaction.confirmation_id == None,
+                Transaction.evicted == (not evicted)
+            ).update({Transaction.evicted: evicted}, synchronize_session=False)
+        self.session.commit()
+
+    def batch_tx_resolver(self, txids, batch_resolver, fallback=None, always=()):
+        known_txids = self.transaction_internal_ids(txids)
+        unknown_txids = list(always) + [ txid for txid in txids if txid not in always and txid not in known_txids ]
+        resolved = batch_resolver(unknown_txids) if len(unknown_txids) > 0 else {}
+
+        def resolve(txid):
+            if txid in resolved:
+                return resolved[txid]
+            return fallback(txid)
+        return resolve
+
+    def import_blockinfo(self, blockinfo, tx_resolver=None, batch_resolver=None, commit=True):
         # Genesis block workaround
         if blockinfo['height'] == 0:
             blockinfo['tx'] = []
 
         log_block_event(blockinfo['hash'], 'Adding', via=(blockinfo['relayedby'] if 'relayedby' in blockinfo else None))
 
+        if batch_resolver is not None and len(blockinfo['tx']) > 0:
+            tx_resolver = self.batch_tx_resolver(blockinfo['tx'], batch_resolver, fallback=tx_resolver, always=blockinfo['tx'][:1])
+
+        # Only the first transaction in a block can be a coinbase
         coinbase_signatures = {}
-        for txid in blockinfo['tx']:
-            self.check_need_import_transaction(txid, tx_resolver=tx_resolver, coinbase_signatures=coinbase_signatures, commit=False)
+        known_txids = self.transaction_internal_ids(blockinfo['tx'])
+        new_transactions = []
+        for index, txid in enumerate(blockinfo['tx']):
+            if index == 0 or txid not in known_txids:
+                txinfo = tx_resolver(txid)
+                if index == 0:
+                    self.add_coinbase_signature(coinbase_signatures, txinfo)
+            if txid not in known_txids:
+                new_transactions.append((txid, txinfo))
+        tx_ids = self.import_transactions(new_transactions)
+        tx_ids.update(known_txids)
 
         blockhash = unhexlify(blockinfo['hash'])
         block = self.block(blockhash)
@@ -585,7 +855,7 @@ class DatabaseSession(object):
             self._chaintip = None
             return block
 
-        if not self.cache.is_valid(ids=Cache.ALL_IDS):
+        if not self.defer_aggregates and not self.cache.is_valid(ids=Cache.ALL_IDS):
             self.session.flush()
             self.session.commit()
 
@@ -623,15 +893,16 @@ class DatabaseSession(object):
         self.session.add(block)
         self.session.flush()
 
-        for tx in blockinfo['tx']:
-            self.confirm_transaction(tx, block.id)
+        self.undo_balances = {}
+        self.undo_dirty = set()
+        self.confirm_block(block.id, [ tx_ids[txid] for txid in blockinfo['tx'] ])
 
-        block.totalfee = sum([ self.transaction(tx).fee for tx in blockinfo['tx'] ])
+        self.add_block_summary(block, tx_ids[blockinfo['tx'][0]] if len(blockinfo['tx']) > 0 else None)
         self.session.add(block)
 
         if len(coinbase_signatures) > 0:
             log_event('Adding', 'cb', coinbase_signatures.keys()[0])
-            self.add_coinbase_data(block, coinbase_signatures.keys()[0], coinbase_signatures.values()[0][0], coinbase_signatures.values()[0][1])
+            coinbaseinfo = self.add_coinbase_data(block, coinbase_signatures.keys()[0], coinbase_signatures.values()[0][0], coinbase_signatures.values()[0][1])
 
             if block.relayedby != None:
                 tx = self.transaction(coinbase_signatures.keys()[0])
@@ -641,12 +912,17 @@ class DatabaseSession(object):
         else:
             raise Exception('No coinbase!')
 
-        self.cache.total_blocks = self.cache.total_blocks + 1
-        self.cache.total_fees = self.cache.total_fees + block.totalfee
-        log_event('Updated', 'blk', 'cache')
+        if not self.defer_aggregates:
+            self.cache.total_blocks = self.cache.total_blocks + 1
+            self.cache.total_fees = self.cache.total_fees + block.totalfee
+            log_event('Updated', 'blk', 'cache')
+
+            self.cache.total_transactions = self.cache.total_transactions + len(blockinfo['tx']) - len(coinbase_signatures)
+            log_event('Updated', 'tx', 'cache')
 
-        self.cache.total_transactions = self.cache.total_transactions + len(blockinfo['tx']) - len(coinbase_signatures)
-        log_event('Updated', 'tx', 'cache')
+        self.add_block_undo(block, len(blockinfo['tx']) - len(coinbase_signatures), coinbaseinfo.newcoins)
+        if self.undo_depth is not None:
+            self.prune_block_undo(block.height - self.undo_depth)
 
         if commit:
             log_block_event(hexlify(block.hash), 'Commit')
@@ -658,12 +934,164 @@ class DatabaseSession(object):
         log_block_event(hexlify(block.hash), 'Added', height=block.height, time=(block.firstseen or block.timestamp))
         return block
 
+    def add_block_summary(self, block, coinbase_tx_id):
+        # Stored with the block, so listings never have to load its transactions
+        block.txcount, block.totalfee, block.transacted, block.inputcount, block.outputcount = self.session.execute('''
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(`transaction`.`fee`), 0.0),
+                COALESCE(SUM(IF(`transaction`.`id` = :coinbase_tx_id, 0.0, `transaction`.`totalvalue`)), 0.0),
+                (SELECT COUNT(*) FROM `blocktx` JOIN `txin` ON `blocktx`.`transaction` = `txin`.`transaction` WHERE `blocktx`.`block` = :block_id),
+                (SELECT COUNT(*) FROM `blocktx` JOIN `txout` ON `blocktx`.`transaction` = `txout`.`transaction` WHERE `blocktx`.`block` = :block_id)
+            FROM `blocktx`
+                JOIN `transaction` ON `blocktx`.`transaction` = `transaction`.`id`
+            WHERE `blocktx`.`block` = :block_id;
+        ''', {
+            'block_id': block.id,
+            'coinbase_tx_id': coinbase_tx_id
+        }).first()
+
+    def add_block_undo(self, block, transactions, newcoins):
+        undo = BlockUndo()
+        undo.block_id = block.id
+        undo.transactions = transactions
+        undo.fees = block.totalfee
+        undo.newcoins = newcoins
+        self.session.add(undo)
+
+        self.session.execute('''
+            INSERT INTO `blockundoentry` (`block`, `txout`)
+                SELECT :block_id, `txin`.`input` FROM `blocktx`
+                    JOIN `txin` ON `blocktx`.`transaction` = `txin`.`transaction`
+                WHERE `blocktx`.`block` = :block_id;
+        ''', {
+            'block_id': block.id
+        })
+
+        entries = [ {'block': block.id, 'address': address_id, 'amount': amount} for address_id, amount in self.undo_balances.items() if address_id not in self.undo_dirty ]
+        entries += [ {'block': block.id, 'address': address_id, 'amount': None} for address_id in self.undo_dirty ]
+        if len(entries) > 0:
+            self.session.execute(BlockUndoEntry.__table__.insert(), entries)
+
+        self.undo_balances = {}
+        self.undo_dirty = set()
+
+    def prune_block_undo(self, below_height):
+        # Driven from `blockundo`, which only holds the retained journals
+        self.session.execute('''
+            DELETE `blockundoentry` FROM `blockundo`
+                JOIN `block` ON `blockundo`.`block` = `block`.`id`
+                JOIN `blockundoentry` ON `blockundo`.`block` = `blockundoentry`.`block`
+            WHERE `block`.`height` < :height;
+        ''', {
+            'height': below_height
+        })
+        self.session.execute('''
+            DELETE `blockundo` FROM `blockundo`
+                JOIN `block` ON `blockundo`.`block` = `block`.`id`
+            WHERE `block`.`height` < :height;
+        ''', {
+            'height': below_height
+        })
+
     def orphan_blocks(self, first_height):
-        chaintip = self.chaintip()
-        for height in range(chaintip.height, first_height - 1, -1):
-            self.orphan_block(height)
+        self.session.flush()
+        self.flush_balances()
+
+        blocks = self.session.query(
+            Block.id,
+            Block.height,
+            BlockUndo.block_id
+        ).outerjoin(
+            BlockUndo,
+            BlockUndo.block_id == Block.id
+        ).filter(
+            Block.height >= first_height
+        ).order_by(
+            Block.height.desc()
+        ).all()
+
+        # Reorgs deeper than the retained journals (or reaching blocks imported
+        # before journals were written) take the slow path for every block.
+        if any([ undo_block_id is None for block_id, height, undo_block_id in blocks ]):
+            log_event('Orphan', 'blk', '%d blocks' % len(blocks), {'journal': 'incomplete, recalculating'})
+            for block_id, height, undo_block_id in blocks:
+                self.orphan_block(height)
+
+            # Journals of the remaining blocks would not be accurate anymore
+            block_list = ', '.join([ str(int(block_id)) for block_id, height, undo_block_id in blocks ])
+            self.session.execute('DELETE FROM `blockundoentry` WHERE `block` IN (%s);' % block_list, {})
+            self.session.execute('DELETE FROM `blockundo` WHERE `block` IN (%s);' % block_list, {})
+            self.cache.invalidate()
+        else:
+            self.disconnect_blocks([ block_id for block_id, height, undo_block_id in blocks ])
+        self.session.commit()
+        self._chaintip = None
+
+    def disconnect_blocks(self, block_ids):
+        if len(block_ids) == 0:
+            return
+
+        start_time = time()
+        self.session.flush()
+        block_list = ', '.join([ str(int(block_id)) for block_id in block_ids ])
+
+        # Addresses already dirty are recalculated anyway, the ones without a
+        # recorded delta (no mutations for a transaction) are marked dirty.
+        self.session.execute('''
+            UPDATE `address`
+                JOIN (
+                    SELECT `address`, SUM(`amount`) AS `delta`, MAX(ISNULL(`amount`)) AS `unknown` FROM `blockundoentry`
+                        WHERE `block` IN (%s)
+                            AND `address` IS NOT NULL
+                        GROUP BY `address`
+                ) `undo` ON `address`.`id` = `undo`.`address`
+            SET `address`.`balance` = IF(`address`.`balance_dirty` = 0 AND `undo`.`unknown` = 0, `address`.`balance` - `undo`.`delta`, `address`.`balance`),
+                `address`.`balance_dirty` = IF(`address`.`balance_dirty` = 0 AND `undo`.`unknown` = 1, 1, `address`.`balance_dirty`);
+        ''' % block_list, {})
+
+        self.session.execute('''
+            UPDATE `txout`
+                JOIN `blockundoentry` ON `txout`.`id` = `blockundoentry`.`txout`
+            SET `txout`.`spentby` = NULL
+                WHERE `blockundoentry`.`block` IN (%s);
+        ''' % block_list, {})
+
+        self.session.execute('''
+            UPDATE `transaction`
+                JOIN `blocktx` ON `transaction`.`confirmation` = `blocktx`.`id`
+            SET `transaction`.`confirmation` = NULL
+                WHERE `blocktx`.`block` IN (%s);
+        ''' % block_list, {})
+
+        self.session.execute('''
+            UPDATE `cache`
+                JOIN (
+                    SELECT COUNT(*) AS `blocks`, SUM(`transactions`) AS `transactions`, SUM(`fees`) AS `fees`, SUM(`newcoins`) AS `newcoins` FROM `blockundo`
+                        WHERE `block` IN (%s)
+                ) `undo`
+            SET `cache`.`value` = `cache`.`value` - CASE `cache`.`id`
+                WHEN :total_transactions THEN `undo`.`transactions`
+                WHEN :total_blocks THEN `undo`.`blocks`
+                WHEN :total_fees THEN `undo`.`fees`
+                WHEN :total_coins_released THEN `undo`.`newcoins`
+                ELSE 0
+            END;
+        ''' % block_list, {
+            'total_transactions': CACHE_IDS.TOTAL_TRANSACTIONS,
+            'total_blocks': CACHE_IDS.TOTAL_BLOCKS,
+            'total_fees': CACHE_IDS.TOTAL_FEES,
+            'total_coins_released': CACHE_IDS.TOTAL_COINS_RELEASED
+        })
+
+        # A block connected again is not confirmed transaction by transaction
+        # (see import_blockinfo), so its journal would no longer be accurate.
+        self.session.execute('DELETE FROM `blockundoentry` WHERE `block` IN (%s);' % block_list, {})
+        self.session.execute('DELETE FROM `blockundo` WHERE `block` IN (%s);' % block_list, {})
+        self.session.execute('UPDATE `block` SET `height` = NULL WHERE `id` IN (%s);' % block_list, {})
 
-        self.cache.invalidate(commit=True)
+        self.session.expire_all()
+        log_event('Orphan', 'blk', '%d blocks' % len(block_ids), {'time': '%d msec' % int((time() - start_time) * 1000)})
 
     def orphan_block(self, height):
         block = self.block(height)
@@ -673,7 +1101,7 @@ class DatabaseSession(object):
             for txref in self.session.query(BlockTransaction).filter(BlockTransaction.block_id == block.id).all():
                 self.unconfirm_transaction(txref.transaction)
             self.session.add(block)
-            self.session.commit()
+            self.session.flush()
 
     def unconfirm_transaction(self, transaction):
         log_tx_event(hexlify(transaction.txid), 'Unconf')
@@ -685,152 +1113,158 @@ class DatabaseSession(object):
             tx_input.input.spentby_id = None
         self.session.add(transaction)
 
+    def add_coinbase_signature(self, coinbase_signatures, txinfo):
+        coinbase_inputs = list(filter(lambda txin: 'coinbase' in txin, txinfo['vin']))
+        if len(coinbase_inputs) == 0:
+            return
+
+        coinbase_regular_outputs = filter(
+            lambda txo: txo['value'] > 0.0 and 'addresses' in txo['scriptPubKey'] and len(txo['scriptPubKey']['addresses']) == 1,
+            txinfo['vout']
+        )
+        coinbase_signatures[txinfo['txid']] = (coinbase_inputs[0]['coinbase'], [
+            (txo['n'], txo['scriptPubKey']['addresses'][0], txo['value']) for txo in coinbase_regular_outputs
+        ])
+
     def check_need_import_transaction(self, txid, tx_resolver, coinbase_signatures=None, commit=True):
         tx_id = self.transaction_internal_id(txid)
 
         if tx_id == None or coinbase_signatures is not None:
             txinfo = tx_resolver(txid)
 
-            coinbase_inputs = list(filter(lambda txin: 'coinbase' in txin, txinfo['vin']))
-            regular_inputs = list(filter(lambda txin: 'coinbase' not in txin, txinfo['vin']))
-
-            is_coinbase_tx = len(coinbase_inputs) > 0
-
-            if coinbase_signatures is not None and is_coinbase_tx:
-                coinbase_regular_outputs = filter(
-                    lambda txo: txo['value'] > 0.0 and 'addresses' in txo['scriptPubKey'] and len(txo['scriptPubKey']['addresses']) == 1,
-                    txinfo['vout']
-                )
-                coinbase_signatures[txinfo['txid']] = (coinbase_inputs[0]['coinbase'], [
-                    (txo['n'], txo['scriptPubKey']['addresses'][0], txo['value']) for txo in coinbase_regular_outputs
-                ])
+            if coinbase_signatures is not None:
+                self.add_coinbase_signature(coinbase_signatures, txinfo)
 
         if tx_id != None:
             return tx_id
-        return self.import_transaction(txid, txinfo, regular_inputs, coinbase_inputs, commit=commit).id
-
-    def import_transaction(self, txid, txinfo, regular_inputs, coinbase_inputs, commit=True):
-        if len(regular_inputs) > 0:
-            log_tx_event(txid, 'Adding', inputs=len(regular_inputs), outputs=len(txinfo['vout']), via=txinfo['relayedby'] if 'relayedby' in txinfo else 'unknown')
-        else:
-            log_tx_event(txid, 'Adding', coinbase=True, outputs=len(txinfo['vout']))
 
-        tx = Transaction()
+        tx_id = self.import_transactions([ (txid, txinfo) ])[txid]
+        if commit:
+            log_tx_event(txid, 'Commit')
+            self.session.commit()
+        return tx_id
 
-        tx.txid = unhexlify(txid)
-        tx.size = txinfo['size']
-        tx.fee = -1.0
-        tx.totalvalue = -1.0
-        tx.firstseen = datetime.utcfromtimestamp(txinfo['relayedat']) if 'relayedat' in txinfo and txinfo['relayedat'] is not None else datetime.now()
-        tx.relayedby = txinfo['relayedby'] if 'relayedby' in txinfo else None
-        tx.confirmation_id = None
+    def import_transactions(self, transactions):
+        ##
+        ##  Imports new transactions, in dependency order (as they appear in
+        ##  a block). Ids are taken from reserved ranges, so all rows are built
+        ##  in memory and every table is written with a single multi-row
+        ##  INSERT, without flushing to learn AUTO_INCREMENT ids.
+        ##
 
-        self.session.add(tx)
-        self.session.flush()
+        if len(transactions) == 0:
+            return {}
 
-        self.txid_cache[tx.txid] = tx.id
+        next_tx_id = self.id_ranges.allocate(Transaction.__tablename__, len(transactions))
+        next_txout_id = self.id_ranges.allocate(TransactionOutput.__tablename__, sum([ len(txinfo['vout']) for txid, txinfo in transactions ]))
 
-        total_in = Decimal(0.0)
+        tx_ids = {}
+        batch_utxos = {}
+        inputs = []
+        for txid, txinfo in transactions:
+            regular_inputs = list(filter(lambda txin: 'coinbase' not in txin, txinfo['vin']))
+            if len(regular_inputs) > 0:
+                log_tx_event(txid, 'Adding', inputs=len(regular_inputs), outputs=len(txinfo['vout']), via=txinfo['relayedby'] if 'relayedby' in txinfo else 'unknown')
+            else:
+                log_tx_event(txid, 'Adding', coinbase=True, outputs=len(txinfo['vout']))
 
-        utxo_cache_hits = 0
-        txid_cache_hits = 0
+            tx_ids[txid] = next_tx_id
+            next_tx_id += 1
 
-        if len(regular_inputs) > 0:
             for inp in regular_inputs:
                 inp['_txid'] = unhexlify(inp['txid'])
+                inp['_vout'] = int(inp['vout'])
                 inp['_txo'] = inp['txid'] + '_' + str(inp['vout'])
+            inputs += regular_inputs
 
-            utxo_cache_map, non_cached_inputs = self.lookup_input_utxos_from_utxo_cache(regular_inputs)
-            txid_cache_map, non_cached_inputs = self.lookup_input_utxos_using_txid_cache(non_cached_inputs)
-            txo_map = self.lookup_input_utxos_slow(non_cached_inputs)
+            for outp in txinfo['vout']:
+                batch_utxos[txid + '_' + str(outp['n'])] = (next_txout_id, outp['value'])
+                next_txout_id += 1
 
-            utxo_cache_hits = len(utxo_cache_map)
-            txid_cache_hits = len(txid_cache_map)
+        # Outputs created and spent within the batch are resolved right here
+        spent_in_batch = set([ inp['_txo'] for inp in inputs if inp['_txo'] in batch_utxos ])
+        utxo_cache_map, non_cached_inputs = self.lookup_input_utxos_from_utxo_cache([ inp for inp in inputs if inp['_txo'] not in spent_in_batch ])
+        txid_cache_map, non_cached_inputs = self.lookup_input_utxos_using_txid_cache(non_cached_inputs)
+        txo_map = self.lookup_input_utxos_slow(non_cached_inputs)
 
-            txo_map.update(utxo_cache_map)
-            txo_map.update(txid_cache_map)
+        txo_map.update(utxo_cache_map)
+        txo_map.update(txid_cache_map)
+        txo_map.update(dict([ (txo, batch_utxos[txo]) for txo in spent_in_batch ]))
 
-            total_in = self.import_tx_inputs(regular_inputs, tx.id, txo_map)
+        address_ids = self.output_address_ids([ outp['scriptPubKey'] for txid, txinfo in transactions for outp in txinfo['vout'] ])
 
-        address_map = dict({outp['n']: self.get_or_create_output_address(outp['scriptPubKey'], flushdb=False) for outp in txinfo['vout']})
-        self.session.flush()
-
-        utxos, total_out = self.import_tx_outputs(txinfo['vout'], tx.id, address_map)
-        tx.totalvalue, tx.fee = self.calculate_tx_totals(total_in, total_out, coinbase=(len(coinbase_inputs) > 0))
+        next_txin_id = self.id_ranges.allocate(TransactionInput.__tablename__, len(inputs)) if len(inputs) > 0 else None
+        tx_rows = []
+        txout_rows = []
+        txin_rows = []
+        for txid, txinfo in transactions:
+            regular_inputs = list(filter(lambda txin: 'coinbase' not in txin, txinfo['vin']))
+            total_in = Decimal(0.0)
+            total_out = Decimal(0.0)
+
+            for index, inp in enumerate(regular_inputs):
+                utxo_id, utxo_value = txo_map[inp['_txo']]
+                txin_rows.append({'id': next_txin_id, 'transaction': tx_ids[txid], 'index': index, 'input': utxo_id})
+                next_txin_id += 1
+                total_in += utxo_value
+
+            for outp in txinfo['vout']:
+                txout_rows.append({
+                    'id': batch_utxos[txid + '_' + str(outp['n'])][0],
+                    'transaction': tx_ids[txid],
+                    'index': outp['n'],
+                    'type': TXOUT_TYPES.internal_id(TXOUT_TYPES.from_rpcapi_type(outp['scriptPubKey']['type'])),
+                    'address': address_ids[len(txout_rows)],
+                    'amount': outp['value']
+                })
+                total_out += outp['value']
+
+            totalvalue, fee = self.calculate_tx_totals(total_in, total_out, coinbase=(len(regular_inputs) == 0))
+            tx_rows.append({
+                'id': tx_ids[txid],
+                'txid': unhexlify(txid),
+                'size': txinfo['size'],
+                'fee': fee,
+                'totalvalue': totalvalue,
+                'firstseen': datetime.utcfromtimestamp(txinfo['relayedat']) if 'relayedat' in txinfo and txinfo['relayedat'] is not None else datetime.now(),
+                'relayedby': txinfo['relayedby'] if 'relayedby' in txinfo else None
+            })
 
-        self.session.bulk_save_objects(utxos, return_defaults=(self.utxo_cache is not None))
-        self.session.flush()
+        for table, rows in [ (Transaction.__table__, tx_rows), (TransactionOutput.__table__, txout_rows), (TransactionInput.__table__, txin_rows) ]:
+            if len(rows) > 0:
+                self.session.execute(table.insert(), rows)
 
-        self.add_tx_mutations_info(tx)
+        self.add_tx_mutations_info(tx_rows[0]['id'], tx_rows[-1]['id'])
 
-        if commit:
-            log_tx_event(hexlify(tx.txid), 'Commit')
-            self.session.commit()
+        for row in tx_rows:
+            self.txid_cache[row['txid']] = row['id']
 
         if self.utxo_cache is not None:
-            self.update_utxo_cache(txinfo['txid'], tx.id, utxos)
-            log_tx_event(txinfo['txid'], 'Added',
-                utxo_cache=self.utxo_cache.currsize,
-                hit='%d/%d' % (utxo_cache_hits, len(regular_inputs)),
-                txid_cache=self.txid_cache.currsize,
-                address_cache=self.address_cache.currsize
-            )
+            raw_type = TXOUT_TYPES.internal_id(TXOUT_TYPES.RAW)
+            for txid, txinfo in transactions:
+                for outp in txinfo['vout']:
+                    txo = txid + '_' + str(outp['n'])
+                    if txo not in spent_in_batch and TXOUT_TYPES.internal_id(TXOUT_TYPES.from_rpcapi_type(outp['scriptPubKey']['type'])) != raw_type:
+                        self.utxo_cache.add(unhexlify(txid), outp['n'], batch_utxos[txo][0], outp['value'])
+
+        stats = {
+            'hit': '%d/%d' % (len(utxo_cache_map), len(inputs)),
+            'txid_cache': self.txid_cache.currsize,
+            'address_cache': self.address_cache.currsize
+        }
+        if self.utxo_cache is not None:
+            stats['utxo_cache'] = self.utxo_cache.currsize
+        if len(transactions) == 1:
+            log_tx_event(transactions[0][0], 'Added', **stats)
         else:
-            log_tx_event(txinfo['txid'], 'Added',
-                txid_cache=self.txid_cache.currsize,
-                hit='%d/%d' % (utxo_cache_hits, len(regular_inputs)),
-                address_cache=self.address_cache.currsize
-            )
-        return tx
-
-    def import_tx_inputs(self, inputs, internal_tx_id, utxo_info):
-        inserts = []
-        total_value = Decimal(0.0)
-
-        for index, inp in enumerate(inputs):
-            utxo_id, utxo_value = utxo_info[inp['_txo']]
-
-            txin = TransactionInput()
-            txin.input_id = utxo_id
-            txin.transaction_id = internal_tx_id
-            txin.index = index
-            inserts.append(txin)
-
-            total_value += utxo_value
-
-        self.session.bulk_save_objects(inserts)
-        return total_value
-
-    def import_tx_outputs(self, outputs, internal_tx_id, address_id_mappings):
-        inserts = []
-        total_value = Decimal(0.0)
-
-        for outp in outputs:
-            utxo = TransactionOutput()
-            utxo.transaction_id = internal_tx_id
-            utxo.index = outp['n']
-            utxo.type = TXOUT_TYPES.from_rpcapi_type(outp['scriptPubKey']['type'])
-            utxo.amount = outp['value']
-
-            utxo.address_id = address_id_mappings[outp['n']].id
-            inserts.append(utxo)
-
-            total_value += utxo.amount
-
-        return inserts, total_value
+            log_event('Added', 'tx', '%d transactions' % len(transactions), stats)
+        return tx_ids
 
     def calculate_tx_totals(self, total_in, total_out, coinbase=False):
         if coinbase:
             return total_out, Decimal(0.0)
         return total_in, total_in - total_out
 
-    def update_utxo_cache(self, txid, internal_tx_id, utxos):
-        if self.utxo_cache is None:
-            return
-        for utxo in utxos:
-            if utxo.type != TXOUT_TYPES.RAW:
-                self.utxo_cache[txid + '_' + str(utxo.index)] = (internal_tx_id, utxo.id, utxo.amount)
-
     def lookup_input_utxos_from_utxo_cache(self, inputs):
         if self.utxo_cache is None:
             return {}, inputs
@@ -839,30 +1273,33 @@ class DatabaseSession(object):
         resolved_utxos = {}
 
         for inp in inputs:
-            key = inp['_txo']
-            if key in self.utxo_cache:
-                tx_internal_id, utxo_internal_id, utxo_value = self.utxo_cache[key]
-                resolved_utxos[key] = (utxo_internal_id, utxo_value)
-                del self.utxo_cache[key]
+            utxo = self.utxo_cache.pop(inp['_txid'], inp['_vout'])
+            if utxo is not None:
+                resolved_utxos[inp['_txo']] = utxo
             else:
                 cache_misses.append(inp)
         return resolved_utxos, cache_misses
 
-    def lookup_input_utxos_using_txid_cache(self, inputs):
-        queryfilter = tuple([
-            tuple_(TransactionOutput.transaction_id, TransactionOutput.index) == (self.txid_cache[txo[0]], txo[1])
-            for txo in
-            filter(lambda txo: txo[0] in self.txid_cache, [
-                (inp['_txid'], inp['vout'])
-                for inp in
-                inputs
-            ])
-        ])
-        ctx_txo_map = {
-            (str(txo.transaction_id) + '_' + str(txo.index)): (txo.id, txo.amount)
-            for txo in
-            self.session.query(TransactionOutput).filter(or_(*queryfilter)).all()
-        } if queryfilter != () else {}
+    def lookup_input_utxos_using_txid_cache(self, inputs, join_threshold=INPUT_JOIN_THRESHOLD):
+        cached = [ (self.txid_cache[inp['_txid']], inp['_vout']) for inp in inputs if inp['_txid'] in self.txid_cache ]
+
+        if len(cached) == 0:
+            results = []
+        elif len(cached) < join_threshold:
+            results = self.session.query(
+                TransactionOutput.transaction_id,
+                TransactionOutput.index,
+                TransactionOutput.id,
+                TransactionOutput.amount
+            ).filter(or_(*[
+                tuple_(TransactionOutput.transaction_id, TransactionOutput.index) == outpoint for outpoint in cached
+            ])).all()
+        else:
+            results = self.lookup_outpoints_joined([ {'txid': None, 'transaction': tx_id, 'vout': vout} for tx_id, vout in cached ], '''
+                SELECT `lookup`.`transaction`, `txout`.`index`, `txout`.`id`, `txout`.`amount` FROM `outpointlookup` `lookup`
+                    JOIN `txout` ON `lookup`.`transaction` = `txout`.`transaction` AND `lookup`.`vout` = `txout`.`index`;
+            ''')
+        ctx_txo_map = dict([ (str(tx_id) + '_' + str(index), (txo_id, amount)) for tx_id, index, txo_id, amount in results ])
 
         cache_misses = []
         resolved_utxos = {}
@@ -874,108 +1311,176 @@ class DatabaseSession(object):
                 cache_misses.append(inp)
         return resolved_utxos, cache_misses
 
-    def lookup_input_utxos_slow(self, inputs):
+    def lookup_input_utxos_slow(self, inputs, join_threshold=INPUT_JOIN_THRESHOLD):
         if len(inputs) == 0:
             return {}
 
-        queryfilter = tuple([
-            tuple_(Transaction.txid, TransactionOutput.index) == (inp['_txid'], inp['vout'])
-            for inp in inputs
-        ])
-        results = self.session.query(
-            TransactionOutput,
-            Transaction
-        ).join(
-            Transaction
-        ).filter(or_(*queryfilter)).all()
-
-        return {
-            (hexlify(tx.txid) + '_' + str(txo.index)): (txo.id, txo.amount)
-            for (txo, tx) in results
-        }
-
-    def confirm_transaction(self, txid, internal_block_id, tx_resolver=None):
-        log_tx_event(txid, 'Confirm')
+        # Large sets (consolidations, whole blocks) are joined against a
+        # temporary table, a predicate per input makes for huge statements.
+        if len(inputs) < join_threshold:
+            results = self.session.query(
+                Transaction.txid,
+                TransactionOutput.index,
+                TransactionOutput.id,
+                TransactionOutput.amount
+            ).select_from(
+                TransactionOutput
+            ).join(
+                Transaction
+            ).filter(or_(*[
+                tuple_(Transaction.txid, TransactionOutput.index) == (inp['_txid'], inp['_vout']) for inp in inputs
+            ])).all()
+        else:
+            results = self.lookup_outpoints_joined([ {'txid': inp['_txid'], 'transaction': None, 'vout': inp['_vout']} for inp in inputs ], '''
+                SELECT `lookup`.`txid`, `txout`.`index`, `txout`.`id`, `txout`.`amount` FROM `outpointlookup` `lookup`
+                    JOIN `transaction` ON `lookup`.`txid` = `transaction`.`txid`
+                    JOIN `txout` ON `transaction`.`id` = `txout`.`transaction` AND `lookup`.`vout` = `txout`.`index`;
+            ''')
+
+        return dict([ (hexlify(txid).decode('ascii') + '_' + str(index), (txo_id, amount)) for txid, index, txo_id, amount in results ])
+
+    def lookup_outpoints_joined(self, outpoints, query):
+        # Temporary tables are private to the connection and creating one does
+        # not commit the running transaction. Filled and emptied per chunk,
+        # so statements stay well below max_allowed_packet.
+        self.session.execute('''
+            CREATE TEMPORARY TABLE IF NOT EXISTS `outpointlookup` (
+              `txid` binary(32) DEFAULT NULL,
+              `transaction` bigint(20) DEFAULT NULL,
+              `vout` int(11) NOT NULL
+            ) ENGINE=MEMORY;
+        ''', {})
+
+        results = []
+        for start in range(0, len(outpoints), INPUT_JOIN_CHUNK_SIZE):
+            self.session.execute('INSERT INTO `outpointlookup` (`txid`, `transaction`, `vout`) VALUES (:txid, :transaction, :vout);', outpoints[start:start+INPUT_JOIN_CHUNK_SIZE])
+            results += self.session.execute(query, {}).fetchall()
+            self.session.execute('DELETE FROM `outpointlookup`;', {})
+        return results
+
+    def confirm_block(self, block_id, tx_ids):
+        ##
+        ##  Confirms the transactions of a block with set-based statements
+        ##  keyed on the block id, the number of statements does not depend
+        ##  on the number of transactions.
+        ##
 
-        tx_id = self.check_need_import_transaction(txid, tx_resolver=tx_resolver)
+        existing = set([ tx_id for (tx_id,) in self.session.query(BlockTransaction.transaction_id).filter(BlockTransaction.block_id == block_id).all() ])
+        rows = [ {'block': block_id, 'transaction': tx_id} for tx_id in tx_ids if tx_id not in existing ]
+        if len(rows) > 0:
+            self.session.execute('INSERT INTO `blocktx` (`block`, `transaction`) VALUES (:block, :transaction);', rows)
 
-        blockref = self.session.query(BlockTransaction).filter(BlockTransaction.block_id == internal_block_id).filter(BlockTransaction.transaction_id == tx_id).first()
-        if blockref == None:
-            blockref = BlockTransaction()
-            blockref.block_id = internal_block_id
-            blockref.transaction_id = tx_id
-            self.session.add(blockref)
-            self.session.flush()
+        self.session.execute('''
+            UPDATE `transaction`
+                JOIN `blocktx` ON `transaction`.`id` = `blocktx`.`transaction`
+            SET `transaction`.`confirmation` = `blocktx`.`id`, `transaction`.`doublespends` = NULL, `transaction`.`evicted` = '0'
+                WHERE `blocktx`.`block` = :block_id;
+        ''', {
+            'block_id': block_id
+        })
 
-        self.session.execute('UPDATE `transaction` SET `confirmation` = :blockref, `doublespends` = NULL WHERE `id` = :tx_id;', {'blockref': blockref.id, 'tx_id': tx_id})
-        self.session.execute('UPDATE `txout` LEFT JOIN `txin` ON `txout`.`id` = `txin`.`input` SET `spentby` = `txin`.`id` WHERE `txin`.`transaction` = :tx_id;', {
-            'tx_id': tx_id
+        self.session.execute('''
+            UPDATE `txout`
+                JOIN `txin` ON `txout`.`id` = `txin`.`input`
+                JOIN `blocktx` ON `txin`.`transaction` = `blocktx`.`transaction`
+            SET `txout`.`spentby` = `txin`.`id`
+                WHERE `blocktx`.`block` = :block_id;
+        ''', {
+            'block_id': block_id
         })
 
         # Add doublespent reference to any transaction spending the same inputs
-        self.session.execute(
-            '''
-                UPDATE `transaction`
-                    INNER JOIN `txin` ON `transaction`.`id` = `txin`.`transaction`
-                SET `transaction`.`doublespends` = :tx_id
-                    WHERE `txin`.`input` IN (
-                        SELECT `txin`.`input` FROM `txin`
-                            WHERE `txin`.`transaction` = :tx_id
-                    )
-                    AND `txin`.`transaction` != :tx_id;
-            ''', {
-                'tx_id': tx_id
-            })
+        self.session.execute('''
+            UPDATE `transaction`
+                JOIN `txin` ON `transaction`.`id` = `txin`.`transaction`
+                JOIN `txin` `confirmed` ON `txin`.`input` = `confirmed`.`input` AND `txin`.`transaction` != `confirmed`.`transaction`
+                JOIN `blocktx` ON `confirmed`.`transaction` = `blocktx`.`transaction`
+            SET `transaction`.`doublespends` = `confirmed`.`transaction`
+                WHERE `blocktx`.`block` = :block_id;
+        ''', {
+            'block_id': block_id
+        })
 
         ##
         ##  Process address balance updates.
         ##
-        ##  Note that this is terribly slow during catchup, but
-        ##  *way* faster than full-on utxo queries when in sync.
+        ##  Deltas are taken from the mutations written by the import and
+        ##  accumulated per address, they are written out right before the
+        ##  session commits (see flush_balances).
         ##
 
-        update_balances = {}
-        def process_address_mutations(results, factor=1):
-            for address, mutation in results:
-                if address.balance_dirty != 0:
-                    log_balance_event(address.address if address.address is not None else ' < RAW >', 'Dirty')
-                    address.balance_dirty = 1
-                else:
-                    if address.id not in update_balances:
-                        update_balances[address.id] = [address, Decimal(0.0)]
-                    update_balances[address.id][1] += mutation * factor
-
-        process_address_mutations(self.session.query(
-            Address,
-            sqlfunc.sum(TransactionOutput.amount)
-        ).join(
-            TransactionOutput
-        ).join(
-            TransactionOutput.spenders
-        ).filter(
-            TransactionInput.transaction_id == tx_id
-        ).group_by(
-            Address.id
-        ).all(), factor=-1)
-
-        process_address_mutations(self.session.query(
-            Address,
-            sqlfunc.sum(TransactionOutput.amount)
-        ).join(
-            TransactionOutput
-        ).filter(
-            TransactionOutput.transaction_id == tx_id
-        ).group_by(
-            Address.id
-        ).all())
+        mutations = self.session.execute('''
+            SELECT `mutation`.`address`, SUM(`mutation`.`amount`) FROM `blocktx`
+                JOIN `mutation` ON `blocktx`.`transaction` = `mutation`.`transaction`
+            WHERE `blocktx`.`block` = :block_id
+                GROUP BY `mutation`.`address`;
+        ''', {
+            'block_id': block_id
+        }).fetchall()
+
+        for address_id, amount in mutations:
+            if self.defer_aggregates:
+                self.dirty_balances.add(address_id)
+            else:
+                self.balance_deltas[address_id] = self.balance_deltas.get(address_id, Decimal(0.0)) + amount
+            self.undo_balances[address_id] = self.undo_balances.get(address_id, Decimal(0.0)) + amount
+
+        # Imported before mutations were tracked, leave these to the balance recalculation
+        dirty = set([ address_id for (address_id,) in self.session.execute('''
+            SELECT `txout`.`address` FROM `blocktx`
+                LEFT JOIN `mutation` ON `blocktx`.`transaction` = `mutation`.`transaction`
+                JOIN `txin` ON `blocktx`.`transaction` = `txin`.`transaction`
+                JOIN `txout` ON `txin`.`input` = `txout`.`id`
+            WHERE `blocktx`.`block` = :block_id
+                AND `mutation`.`id` IS NULL
+        UNION
+            SELECT `txout`.`address` FROM `blocktx`
+                LEFT JOIN `mutation` ON `blocktx`.`transaction` = `mutation`.`transaction`
+                JOIN `txout` ON `blocktx`.`transaction` = `txout`.`transaction`
+            WHERE `blocktx`.`block` = :block_id
+                AND `mutation`.`id` IS NULL;
+        ''', {
+            'block_id': block_id
+        }).fetchall() ])
+        self.dirty_balances.update(dirty)
+        self.undo_dirty.update(dirty)
+
+        log_event('Confirm', 'blk', block_id, {'transactions': len(tx_ids)})
 
-        for address, mutation in update_balances.values():
-            log_balance_event(address.address if address.address is not None else ' < RAW >', 'Update', mutation=mutation)
-            address.balance += mutation
-            self.session.add(address)       # FIXME: Are results automatically part of the session?
+    def flush_balances(self):
+        if len(self.balance_deltas) == 0 and len(self.dirty_balances) == 0:
+            return
 
+        # Make sure addresses marked dirty through the ORM (orphaned blocks)
+        # are written first, those are left to the full recalculation.
         self.session.flush()
 
+        deltas = list(self.balance_deltas.items())
+        for start in range(0, len(deltas), 1000):
+            chunk = deltas[start:start+1000]
+            params = {}
+            for index, (address_id, amount) in enumerate(chunk):
+                params['a%d' % index] = address_id
+                params['d%d' % index] = amount
+            self.session.execute('''
+                UPDATE `address`
+                    JOIN (%s) `deltas` ON `address`.`id` = `deltas`.`id`
+                SET `address`.`balance` = `address`.`balance` + `deltas`.`delta`
+                    WHERE `address`.`balance_dirty` = 0;
+            ''' % ' UNION ALL '.join([ 'SELECT :a%d AS `id`, :d%d AS `delta`' % (index, index) for index in range(len(chunk)) ]), params)
+
+        dirty = list(self.dirty_balances)
+        for start in range(0, len(dirty), 1000):
+            self.session.query(Address).filter(Address.id.in_(dirty[start:start+1000]), Address.balance_dirty == 0).update({Address.balance_dirty: 1}, synchronize_session=False)
+
+        log_event('Flush', 'bal', '%d addresses' % len(deltas), {'dirty': len(dirty)})
+        self.balance_deltas = {}
+        self.dirty_balances = set()
+
+    def discard_balances(self):
+        self.balance_deltas = {}
+        self.dirty_balances = set()
+
     def add_coinbase_data(self, block, txid, signature, outputs):
         coinbaseinfo = CoinbaseInfo()
         coinbaseinfo.block_id = block.id
@@ -986,8 +1491,7 @@ class DatabaseSession(object):
         totalout = sum([o[2] for o in outputs])
         coinbaseinfo.newcoins = totalout - block.totalfee
 
-        best_output = list(filter(lambda o: o[2] > (totalout * 95 / 100), outputs))
-        best_output = best_output[0] if len(best_output) > 0 else None
+        best_output = coinbase_main_output(outputs)
         coinbaseinfo.mainoutput_id = self.session.query(
             TransactionOutput
         ).filter(
@@ -995,21 +1499,16 @@ class DatabaseSession(object):
             TransactionOutput.index == best_output[0]
         ).first().id if best_output is not None else None
 
-        solo = len(coinbaseinfo.raw) <= 8
-
-        if not solo:
-            if coinbaseinfo.raw[-1] == b'/' and b'/' in coinbaseinfo.raw[:-1]:
-                try:
-                    coinbaseinfo.signature = coinbaseinfo.raw.split(b'/')[-2].decode('utf-8').join(2 * ['/'])
-                except (IndexError, UnicodeDecodeError):
-                    pass
+        coinbaseinfo.signature, solo = coinbase_signature(coinbaseinfo.raw)
 
         self.session.add(coinbaseinfo)
         self.session.flush()
 
-        self.cache.total_coins_released = self.cache.total_coins_released + coinbaseinfo.newcoins
+        if not self.defer_aggregates:
+            self.cache.total_coins_released = self.cache.total_coins_released + coinbaseinfo.newcoins
 
         self.find_and_set_miner(block, coinbaseinfo, solo)
+        return coinbaseinfo
 
     def find_and_set_miner(self, block, coinbaseinfo, solo):
         if not solo and coinbaseinfo.signature is not None:
@@ -1041,76 +1540,166 @@ class DatabaseSession(object):
             return
 
     def get_or_create_output_address_id(self, txout_address_info):
-        return self.get_or_create_output_address(txout_address_info).id
-
-    def get_or_create_output_address(self, txout_address_info, flushdb=True):
-        class CachedAddress(object):
-            def __init__(self, source):
-                self.id = source.id
-                self.type = source.type
-                self.address = source.address
-                self.raw = source.raw
+        return self.output_address_ids([ txout_address_info ])[0]
 
-        raw = txout_address_info['asm']
-
-        if 'addresses' in txout_address_info and len(txout_address_info['addresses']) == 1:
-            address = txout_address_info['addresses'][0]
-            addr_type = ADDRESS_TYPES.BASE58
+    def output_address_ids(self, scripts):
+        ##
+        ##  Address ids for a list of output scripts (all outputs of a block).
+        ##
+        ##  Cache misses are looked up with one IN query per 1000 addresses,
+        ##  the remaining addresses are created with a single multi-row
+        ##  upsert. The cache holds (id, type) of addresses found in the
+        ##  database, new ones are only cached once looked up again.
+        ##
 
-            if len(address) > 34:
-                addr_type = ADDRESS_TYPES.BECH32
+        classified = [ classify_output_address(script) for script in scripts ]
 
+        known = {}
+        missing = set()
+        for address, addr_type, raw in classified:
+            if address is None or address in known:
+                continue
             if self.address_cache is not None and address in self.address_cache:
-                db_address = self.address_cache[address]
-            else:
-                db_address = self.session.query(Address).filter(Address.address == address).first()
-                if db_address != None and self.address_cache is not None:
-                    self.address_cache[address] = CachedAddress(db_address)
-        else:
-            db_address = None
-            address = None
-            if raw[0:10] == 'OP_RETURN ' and len(raw.split(' ')) == 2:
-                raw = raw.split(' ')[1]
-                addr_type = ADDRESS_TYPES.DATA
+                known[address] = self.address_cache[address]
             else:
-                addr_type = ADDRESS_TYPES.RAW
-
-        if db_address == None:
-            db_address = Address()
-            db_address.address = address
-            db_address.type = addr_type
-            db_address.raw = raw
-            db_address.balance = Decimal(0.0)
-            db_address.balance_dirty = 0
-
-            self.session.add(db_address)
+                missing.add(address)
+
+        for address_id, type_id, address in self.query_addresses(list(missing)):
+            known[address] = (address_id, type_id)
+            if self.address_cache is not None:
+                self.address_cache[address] = (address_id, type_id)
+
+        address_ids = []
+        new_addresses = {}
+        rows = []
+        for address, addr_type, raw in classified:
+            if address in known:
+                address_ids.append(known[address][0])
+                continue
+            if address in new_addresses:
+                address_ids.append(new_addresses[address])
+                continue
+
+            address_id = self.id_ranges.allocate(Address.__tablename__)
+            rows.append({
+                'id': address_id,
+                'type': ADDRESS_TYPES.internal_id(addr_type),
+                'address': address,
+                'raw': raw,
+                'balance': Decimal(0.0),
+                'balance_dirty': 0
+            })
+            if address is not None:
+                new_addresses[address] = address_id
+            address_ids.append(address_id)
 
-            if flushdb:
-                self.session.flush()
+        if len(rows) == 0:
+            return address_ids
 
-        return db_address
+        self.session.execute('''
+            INSERT INTO `address` (`id`, `type`, `address`, `raw`, `balance`, `balance_dirty`)
+                VALUES (:id, :type, :address, :raw, :balance, :balance_dirty)
+                ON DUPLICATE KEY UPDATE `id` = `id`;
+        ''', rows)
+
+        # Addresses created by another writer in the meantime (indexerapi)
+        # were left as they are, outputs have to reference those rows.
+        replaced = {}
+        for address_id, type_id, address in self.query_addresses(list(new_addresses.keys())):
+            if address_id != new_addresses[address]:
+                replaced[new_addresses[address]] = address_id
+        if len(replaced) > 0:
+            address_ids = [ replaced.get(address_id, address_id) for address_id in address_ids ]
+        return address_ids
+
+    def query_addresses(self, addresses):
+        results = []
+        for start in range(0, len(addresses), 1000):
+            results += self.session.query(Address.id, Address.type_id, Address.address).filter(Address.address.in_(addresses[start:start+1000])).all()
+        return results
+
+    def add_coindays_destroyed(self, first_block_id, end_block_id):
+        # Coin-days of every input, aged from the block that confirmed the
+        # spent output up to when the spending transaction was first seen.
+        return self.session.execute('''
+            INSERT INTO `coindaysdestroyed` (`transaction`, `coindays`, `timestamp`)
+                SELECT
+                    `transaction`.`id`,
+                    COALESCE(SUM(`txout`.`amount` * GREATEST(TIMESTAMPDIFF(SECOND, `origin`.`timestamp`, COALESCE(`transaction`.`firstseen`, `block`.`timestamp`)), 0)), 0) / 86400,
+                    COALESCE(`transaction`.`firstseen`, `block`.`timestamp`)
+                FROM `block`
+                    JOIN `blocktx` ON `block`.`id` = `blocktx`.`block`
+                    JOIN `transaction` ON `blocktx`.`transaction` = `transaction`.`id`
+                    LEFT JOIN `coinbase` ON `transaction`.`id` = `coinbase`.`transaction`
+                    LEFT JOIN `coindaysdestroyed` ON `transaction`.`id` = `coindaysdestroyed`.`transaction`
+                    LEFT JOIN `txin` ON `transaction`.`id` = `txin`.`transaction`
+                    LEFT JOIN `txout` ON `txin`.`input` = `txout`.`id`
+                    LEFT JOIN `transaction` `origintx` ON `txout`.`transaction` = `origintx`.`id`
+                    LEFT JOIN `blocktx` `originref` ON `origintx`.`confirmation` = `originref`.`id`
+                    LEFT JOIN `block` `origin` ON `originref`.`block` = `origin`.`id`
+                WHERE `block`.`id` >= :first_block_id
+                    AND `block`.`id` < :end_block_id
+                    AND `block`.`height` IS NOT NULL
+                    AND `coinbase`.`transaction` IS NULL
+                    AND `coindaysdestroyed`.`transaction` IS NULL
+                GROUP BY `transaction`.`id`;
+        ''', {
+            'first_block_id': first_block_id,
+            'end_block_id': end_block_id
+        }).rowcount
 
-    def add_tx_mutations_info(self, tx, commit=False):
-        log_event('Import', 'mts', hexlify(tx.txid))
+    def add_tx_mutations_info(self, first_tx_id, last_tx_id, commit=False):
+        log_event('Import', 'mts', '%d transactions' % (last_tx_id - first_tx_id + 1))
         self.session.execute('''
             INSERT INTO `mutation` (`transaction`, `address`, `amount`)
-                SELECT :tx_id, `address`, SUM(`amount`) FROM (
-                    SELECT `txout`.`address`, `txout`.`amount` FROM `transaction`
-                        JOIN `txout` ON `transaction`.`id` = `txout`.`transaction`
-                    WHERE `transaction`.`id` = :tx_id
+                SELECT `transaction`, `address`, SUM(`amount`) FROM (
+                    SELECT `txout`.`transaction`, `txout`.`address`, `txout`.`amount` FROM `txout`
+                        WHERE `txout`.`transaction` BETWEEN :first_tx_id AND :last_tx_id
                 UNION ALL
-                    SELECT `txout`.`address`, '0' - `txout`.`amount` FROM `transaction`
-                        JOIN `txin` ON `transaction`.`id` = `txin`.`transaction`
+                    SELECT `txin`.`transaction`, `txout`.`address`, '0' - `txout`.`amount` FROM `txin`
                         JOIN `txout` ON `txin`.`input` = `txout`.`id`
-                    WHERE `transaction`.`id` = :tx_id
+                    WHERE `txin`.`transaction` BETWEEN :first_tx_id AND :last_tx_id
                 ) temp
-                    GROUP BY address;
+                    GROUP BY `transaction`, `address`;
             ''', {
-                'tx_id': tx.id
+                'first_tx_id': first_tx_id,
+                'last_tx_id': last_tx_id
         })
         if commit:
             self.session.commit()
 
+    def dirty_address_ids(self, limit):
+        address_ids = [ address_id for (address_id,) in self.session.query(Address.id).filter(Address.balance_dirty == 2).limit(limit).all() ]
+        if len(address_ids) < limit:
+            address_ids += [ address_id for (address_id,) in self.session.query(Address.id).filter(Address.balance_dirty == 1).order_by(Address.id).limit(limit - len(address_ids)).all() ]
+        return address_ids
+
+    def update_dirty_balances(self, limit=500):
+        address_ids = self.dirty_address_ids(limit)
+        if len(address_ids) == 0:
+            return 0
+
+        # Pending deltas must not be applied on top of the recalculated balances
+        self.flush_balances()
+
+        address_list = ', '.join([ str(int(address_id)) for address_id in address_ids ])
+        self.session.execute('''
+            UPDATE `address`
+                LEFT JOIN (
+                    SELECT `txout`.`address`, SUM(`txout`.`amount`) AS `balance` FROM `txout`
+                        JOIN `transaction` ON `txout`.`transaction` = `transaction`.`id`
+                    WHERE `txout`.`address` IN (%s)
+                        AND `txout`.`spentby` IS NULL
+                        AND `transaction`.`confirmation` IS NOT NULL
+                    GROUP BY `txout`.`address`
+                ) `utxos` ON `address`.`id` = `utxos`.`address`
+            SET `address`.`balance` = COALESCE(`utxos`.`balance`, 0.0), `address`.`balance_dirty` = '0'
+                WHERE `address`.`id` IN (%s);
+        ''' % (address_list, address_list), {})
+
+        self.session.commit()
+        return len(address_ids)
+
     def next_dirty_address(self, check_for_id=1, random_address=False):
         return self.session.query(Address).filter(Address.balance_dirty == check_for_id).order_by(Address.id if not random_address else sqlfunc.rand()).first()
 
@@ -1130,6 +1719,9 @@ class DatabaseSession(object):
         log_balance_event(address_s, 'Update')
         start_time = time()
 
+        # Pending deltas must not be applied on top of the recalculated balance
+        self.flush_balances()
+
         self.session.execute("""
             UPDATE `address` SET `balance_dirty` = '0', `balance` = (
                 SELECT COALESCE(SUM(`txout`.`amount`), 0.0)
@@ -1151,14 +1743,70 @@ class DatabaseSession(object):
 
 
 class DatabaseIO(DatabaseSession):
-    def __init__(self, url, timeout=30, utxo_cache=False, debug=False):
-        self.sessionmaker = sessionmaker(bind=create_engine(url, connect_args={'connect_timeout': timeout}, encoding='utf8', echo=debug))
+    def __init__(self, url, timeout=30, utxo_cache=False, utxo_cache_memory=256*1024*1024, utxo_cache_snapshot=None, txid_index=None, undo_depth=None, debug=False):
+        engine = create_engine(url, connect_args={'connect_timeout': timeout}, encoding='utf8', echo=debug)
+        self.sessionmaker = sessionmaker(bind=engine)
+        self.id_ranges = IdRanges(engine)
 
         self.address_cache = LFUCache(maxsize=16384)
         self.txid_cache = RRCache(maxsize=131072)
-        self.utxo_cache = RRCache(maxsize=262144) if utxo_cache else None
+        self.txid_index = TxidIndex(txid_index) if txid_index is not None else None
+        self.utxo_cache = UtxoCache(memory=utxo_cache_memory) if utxo_cache else None
+        self.utxo_cache_snapshot = utxo_cache_snapshot
+        self.undo_depth = undo_depth
+
+        session = self.sessionmaker()
+        super(DatabaseIO, self).__init__(session, address_cache=self.address_cache, txid_cache=self.session_txid_cache(session), utxo_cache=self.utxo_cache, id_ranges=self.id_ranges, undo_depth=undo_depth)
+
+    def flush(self):
+        super(DatabaseIO, self).flush()
+        if self.txid_index is not None:
+            self.txid_index.close()
+
+    def session_txid_cache(self, session, shared_caches=True):
+        if self.txid_index is not None:
+            return self.txid_index.writer(session)
+        return self.txid_cache if shared_caches else RRCache(maxsize=131072)
+
+    def new_session(self, shared_caches=True):
+        session = self.sessionmaker()
+        if not shared_caches:
+            return DatabaseSession(session, address_cache=LFUCache(maxsize=16384), txid_cache=self.session_txid_cache(session, shared_caches=False), id_ranges=self.id_ranges, undo_depth=self.undo_depth)
+        return DatabaseSession(session, address_cache=self.address_cache, txid_cache=self.session_txid_cache(session), utxo_cache=self.utxo_cache, id_ranges=self.id_ranges, undo_depth=self.undo_depth)
+
+    def upgrade_schema(self):
+        for check, statement in SCHEMA_UPGRADES:
+            if check is not None and self.session.execute(check, {}).scalar() != 0:
+                continue
+            self.session.execute(statement, {})
+        self.session.commit()
+
+    def sync_txid_index(self):
+        if self.txid_index is None:
+            return
+        max_id = self.session.execute('SELECT MAX(`id`) FROM `transaction`;').scalar()
+        if not self.txid_index.was_clean:
+            log('Txid index was not closed cleanly, rebuilding...')
+            self.txid_index.rebuild(self.session)
+        elif self.txid_index.synced_id > (max_id or 0):
+            log('Txid index does not match the database, rebuilding...')
+            self.txid_index.rebuild(self.session)
+        else:
+            self.txid_index.catch_up(self.session)
+
+    def committed_chaintip_hash(self):
+        tip = self.session.query(Block.hash).filter(Block.height != None).order_by(Block.height.desc()).first()
+        return tip.hash if tip is not None else None
 
-        super(DatabaseIO, self).__init__(self.sessionmaker(), address_cache=self.address_cache, txid_cache=self.txid_cache, utxo_cache=self.utxo_cache)
+    def load_utxo_cache(self):
+        if self.utxo_cache is None or self.utxo_cache_snapshot is None:
+            return False
+        chaintip_hash = self.committed_chaintip_hash()
+        return chaintip_hash is not None and self.utxo_cache.load(self.utxo_cache_snapshot, chaintip_hash)
 
-    def new_session(self):
-        return DatabaseSession(self.sessionmaker(), address_cache=self.address_cache, txid_cache=self.txid_cache, utxo_cache=self.utxo_cache)
+    def save_utxo_cache(self):
+        if self.utxo_cache is None or self.utxo_cache_snapshot is None:
+            return
+        chaintip_hash = self.committed_chaintip_hash()
+        if chaintip_hash is not None:
+            self.utxo_cache.save(self.utxo_cache_snapshot, chaintip_hash)
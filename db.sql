@@ -55,6 +55,10 @@ CREATE TABLE `block` (
   `firstseen` timestamp NULL DEFAULT NULL,
   `relayedby` varchar(48) DEFAULT NULL,
   `miner` int(11) DEFAULT NULL,
+  `txcount` int(11) DEFAULT NULL,
+  `inputcount` int(11) DEFAULT NULL,
+  `outputcount` int(11) DEFAULT NULL,
+  `transacted` decimal(16,8) DEFAULT NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY `hash` (`hash`),
   UNIQUE KEY `height` (`height`),
@@ -83,6 +87,42 @@ CREATE TABLE `blocktx` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `blockundo`
+--
+
+DROP TABLE IF EXISTS `blockundo`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `blockundo` (
+  `block` int(11) NOT NULL,
+  `transactions` int(11) NOT NULL,
+  `fees` decimal(16,8) NOT NULL,
+  `newcoins` decimal(16,8) NOT NULL,
+  PRIMARY KEY (`block`),
+  CONSTRAINT `fk_blockundo_block` FOREIGN KEY (`block`) REFERENCES `block` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `blockundoentry`
+--
+
+DROP TABLE IF EXISTS `blockundoentry`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `blockundoentry` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `block` int(11) NOT NULL,
+  `txout` bigint(20) DEFAULT NULL,
+  `address` int(11) DEFAULT NULL,
+  `amount` decimal(16,8) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `fk_blockundoentry_block_idx` (`block`),
+  CONSTRAINT `fk_blockundoentry_block` FOREIGN KEY (`block`) REFERENCES `block` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `cache`
 --
@@ -149,6 +189,35 @@ CREATE TABLE `coindaysdestroyed` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `idsequence`
+--
+
+DROP TABLE IF EXISTS `idsequence`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `idsequence` (
+  `name` varchar(32) NOT NULL,
+  `nextid` bigint(20) NOT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `migration`
+--
+
+DROP TABLE IF EXISTS `migration`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `migration` (
+  `name` varchar(32) NOT NULL,
+  `lastid` bigint(20) NOT NULL,
+  `done` tinyint(1) NOT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `mutation`
 --
@@ -259,7 +328,8 @@ CREATE TABLE `transaction` (
   `relayedby` varchar(48) DEFAULT NULL,
   `confirmation` bigint(20) DEFAULT NULL,
   `doublespends` bigint(20) DEFAULT NULL,
-  `mempool` tinyint(1) AS (IF(ISNULL(`confirmation`) AND ISNULL(`doublespends`), '1', '0')),
+  `evicted` tinyint(1) NOT NULL DEFAULT '0',
+  `mempool` tinyint(1) AS (IF(ISNULL(`confirmation`) AND ISNULL(`doublespends`) AND `evicted` = 0, '1', '0')),
   PRIMARY KEY (`id`),
   UNIQUE KEY `txid` (`txid`),
   UNIQUE KEY `confirmation` (`confirmation`),
@@ -316,6 +386,20 @@ CREATE TABLE `txout` (
   CONSTRAINT `fk_txout_spentby` FOREIGN KEY (`spentby`) REFERENCES `txin` (`id`) ON DELETE SET NULL,
   CONSTRAINT `fk_txout_transaction` FOREIGN KEY (`transaction`) REFERENCES `transaction` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+--
+-- Table structure for table `verification`
+--
+
+DROP TABLE IF EXISTS `verification`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `verification` (
+  `id` tinyint(1) NOT NULL,
+  `lastblock` int(11) NOT NULL,
+  `clean` tinyint(1) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
@@ -0,0 +1,37 @@
+import threading
+
+from sqlalchemy import text
+
+
+class IdRanges(object):
+    # Hands out primary keys from ranges reserved in the `idsequence` table,
+    # so rows referencing each other can be built in memory and written with
+    # multi-row INSERTs instead of flushing for every AUTO_INCREMENT id.
+    # Every process writing these tables has to allocate through here.
+    def __init__(self, engine, reserve=1000):
+        self.engine = engine
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.ranges = {}
+
+    def allocate(self, table, count=1):
+        # Returns the first of `count` consecutive ids
+        with self.lock:
+            next_id, end_id = self.ranges.get(table, (0, 0))
+            if end_id - next_id < count:
+                next_id, end_id = self.fetch(table, max(count, self.reserve))
+            self.ranges[table] = (next_id + count, end_id)
+            return next_id
+
+    def fetch(self, table, count):
+        # Own connection and transaction, the sequence row is only locked for the
+        # reservation itself and not until the importing session commits.
+        with self.engine.begin() as connection:
+            max_id = connection.execute(text('SELECT COALESCE(MAX(`id`), 0) FROM `%s`;' % table)).scalar()
+            connection.execute(text('''
+                INSERT INTO `idsequence` (`name`, `nextid`) VALUES (:name, :next_id)
+                    ON DUPLICATE KEY UPDATE `nextid` = GREATEST(`nextid`, VALUES(`nextid`));
+            '''), {'name': table, 'next_id': max_id + 1})
+            connection.execute(text('UPDATE `idsequence` SET `nextid` = LAST_INSERT_ID(`nextid` + :count) WHERE `name` = :name;'), {'name': table, 'count': count})
+            end_id = connection.execute(text('SELECT LAST_INSERT_ID();')).scalar()
+        return end_id - count, end_id
@@ -1,70 +1,100 @@
 import __main__
-import socket
 
 from binascii import hexlify, unhexlify
 from bitcoinrpc import authproxy
-from cachetools import TTLCache
 from datetime import datetime
-from time import sleep, time
+from time import time
 from traceback import print_exc
+from sqlalchemy import func as sqlfunc
 from sqlalchemy.orm import aliased
-from sys import version_info, argv
+from sys import argv
 
 from coinsupport import Daemon
 
+from backfill import Backfill
+from blockfiles import BlockFileImporter, BlockParser
+from bulkload import BulkLoader
 from database import DatabaseIO
-from models import Address, Block, BlockTransaction, CoinbaseInfo, CoinDaysDestroyed, Mutation, Transaction, TransactionInput, TransactionOutput
+from mempool import ImportLock, MempoolWorker
+from migrations import MigrationRunner
+from notifications import NotificationListener
+from models import Block, CoinbaseInfo, Transaction, TransactionInput, TransactionOutput
 from config import Configuration
 from logger import log, log_event, log_block_event, log_tx_event
 from pidfile import make_pidfile
-
-
-if version_info[0] > 2:
-    import http.client as httplib
-else:
-    import httplib
+from prefetch import BlockPrefetcher, PrefetchedBlock, load_transaction, load_transactions
+from rpc import RpcClient
+from scheduler import Scheduler
 
 
 
 class Context(Configuration):
     def __init__(self, db_timeout=30):
-        self._daemon = None
-        self.db = DatabaseIO(self.DATABASE_URL, timeout=db_timeout, utxo_cache=self.UTXO_CACHE, debug=self.DEBUG_SQL)
-        self.mempoolcache = TTLCache(ttl=600, maxsize=4096)
-        self.migration_type = 'init'
-        self.migration_last_id = None
+        self.rpc = RpcClient(lambda: Daemon(self.DAEMON_URL), connections=self.RPC_CONNECTIONS, retries=self.RPC_RETRIES)
+        self.batch_rpc = RpcClient(lambda: authproxy.AuthServiceProxy(self.DAEMON_URL), connections=self.RPC_CONNECTIONS, retries=self.RPC_RETRIES)
+        self.db = DatabaseIO(
+            self.DATABASE_URL,
+            timeout=db_timeout,
+            utxo_cache=self.UTXO_CACHE,
+            utxo_cache_memory=self.UTXO_CACHE_MEMORY,
+            utxo_cache_snapshot=self.UTXO_CACHE_SNAPSHOT,
+            txid_index=self.TXID_INDEX,
+            undo_depth=self.MAX_REORG_DEPTH,
+            debug=self.DEBUG_SQL
+        )
+        self.migrations = MigrationRunner(self)
         self.coindays_destroyed_calc_last_block_id = 1
         self.last_synced_blk = None
         self.last_mempool_check_blk = None
+        self.next_utxo_cache_snapshot = time() + self.UTXO_CACHE_SNAPSHOT_INTERVAL
+
+        self.notifications = NotificationListener(self.ZMQ_URL, resync_interval=self.ZMQ_RESYNC_INTERVAL) if self.ZMQ_URL is not None else None
+        self.poll_chaintip = True
+
+        self.import_lock = ImportLock()
+        self.verified = False
+        self.mempool_worker = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.mempool_worker is not None:
+            self.mempool_worker.stop()
+        if self.notifications is not None:
+            self.notifications.stop()
+        if exc_type is None and self.verified:
+            self.db.reset_session()
+            self.db.set_verification_checkpoint(clean=True)
         self.db.flush()
 
     def daemon(self):
-        if self._daemon is not None:
-            try:
-                self._daemon.uptime()
-            except (socket.timeout, socket.error, httplib.BadStatusLine):
-                self._daemon = None
-        if self._daemon is None:
-            self._daemon = Daemon(self.DAEMON_URL)
-        return self._daemon
-
-    def verify_state(self):
+        return self.rpc
+
+    def verify_state(self, full=False):
+        # Blocks up to the checkpoint were verified before or were imported
+        # before a clean shutdown. Reorgs disconnect blocks in a single
+        # transaction, so older blocks can not be left half way either.
+        since_block_id, clean = self.db.verification_checkpoint()
+        if full or since_block_id is None:
+            log('Verifying all blocks')
+            since_block_id = -1
+        else:
+            log('Verifying blocks after id %d%s' % (since_block_id, '' if clean else ' (unclean shutdown)'))
+
         # Looks like we can end up in a state where we have blocks
         # without coinbase info if we exit at the wrong point?
-        self.db.remove_blocks_without_coinbase()
+        self.db.remove_blocks_without_coinbase(since_block_id)
 
         # Verify transactions in on-chain blocks are confirmed
-        self.db.verify_confirmed_transactions_state()
+        self.db.verify_confirmed_transactions_state(since_block_id)
 
         # Verify confirmed transactions are on-chain
-        self.db.verify_unconfirmed_transactions_state()
+        self.db.verify_unconfirmed_transactions_state(since_block_id)
 
         self.db.session.commit()
+        self.db.set_verification_checkpoint(clean=False)
+        self.verified = True
 
 
     def find_common_ancestor(self):
@@ -75,23 +105,52 @@ class Context(Configuration):
         if indexer_tip == None:
             return -1, -1, chaintip_height
 
-        ancestor_height = indexer_tip.height if indexer_tip.height <= chaintip_height else chaintip_height
-        chain_block_hash = daemon.getblockhash(ancestor_height)
+        top_height = indexer_tip.height if indexer_tip.height <= chaintip_height else chaintip_height
 
-        if indexer_tip.hash != unhexlify(chain_block_hash):
-            ancestor_height -= 1
-            while ancestor_height > 0:
-                chain_block_hash = daemon.getblockhash(ancestor_height)
-                indexer_block = self.db.block(ancestor_height)
+        # Heights missing from the indexer are refilled by the backfill, so only
+        # heights the indexer has are compared. A forked block mismatches at
+        # every indexed height above the fork, which keeps the search monotonic.
+        def matches(height, blockhash):
+            return blockhash == unhexlify(daemon.getblockhash(height))
 
-                if indexer_block.hash == unhexlify(chain_block_hash):
-                    break
+        # Step back exponentially until we hit a common block...
+        probe_heights = [ top_height ]
+        while probe_heights[-1] > 0:
+            probe_heights.append(max(top_height - 2 ** len(probe_heights), 0))
 
-                ancestor_height -= 1
+        mismatch_height = None
+        ancestor_height = 0
+        for height in probe_heights:
+            if mismatch_height is not None and height >= mismatch_height:
+                continue
+            indexed = self.db.highest_block_hash(height)
+            if indexed is None or indexed[0] == 0:
+                break
+            if matches(indexed[0], indexed[1]):
+                ancestor_height = indexed[0]
+                break
+            mismatch_height = indexed[0]
+
+        # ...then binary search for the fork point between that and the last mismatch
+        if mismatch_height is not None:
+            indexer_hashes = self.db.block_hashes(range=(ancestor_height + 1, mismatch_height))
+            heights = sorted(indexer_hashes.keys())
+            low, high = -1, len(heights)
+            while high - low > 1:
+                middle = (low + high) // 2
+                if matches(heights[middle], indexer_hashes[heights[middle]]):
+                    low = middle
+                else:
+                    high = middle
+            if low >= 0:
+                ancestor_height = heights[low]
 
         return ancestor_height, indexer_tip.height, chaintip_height
 
     def sync_blocks(self, initial=False):
+        if not initial and not self.poll_chaintip:
+            return False
+
         ancestor_height, indexer_height, chain_height = self.find_common_ancestor()
 
         if initial:
@@ -104,39 +163,58 @@ class Context(Configuration):
         if ancestor_height == chain_height and not initial:
             return False
 
-        if ancestor_height < indexer_height:
-            self.db.orphan_blocks(ancestor_height + 1)
-
-        if initial and self.db.blockcount() != ancestor_height:
-            log('\nIndexer is missing %d blocks, doing full rescan...\n' % (ancestor_height - self.db.blockcount()))
-
-            for base in range(1, ancestor_height + 1, 1000):
-                if self.db.blockcount(range=(base, base + 1000)) != 1000:
-                    for height in range(base, base + 1000 if base + 1000 < ancestor_height + 1 else ancestor_height + 1):
-                        block = self.db.block(height)
-                        if block == None:
-                            self.import_blockheight(height)
-
-        newblock = None
-        next_commit = time() + 3
-        for height in range(ancestor_height + 1, chain_height + 1):
-            newblock = self.import_blockheight(height, commit=False)
-            self.last_synced_blk = newblock.hash
-            if next_commit <= time():
+        with self.import_lock.hold(self.db):
+            if ancestor_height < indexer_height:
+                self.db.orphan_blocks(ancestor_height + 1)
+
+            if initial:
+                missing_ranges = self.db.missing_block_ranges(ancestor_height)
+                if len(missing_ranges) > 0:
+                    log('\nIndexer is missing %d blocks in %d ranges, backfilling...\n' % (sum([ end - start + 1 for start, end in missing_ranges ]), len(missing_ranges)))
+                    Backfill(self, missing_ranges, threads=self.BACKFILL_THREADS, chunk_size=self.BACKFILL_CHUNK_SIZE).run()
+
+            newblock = None
+            next_commit = time() + 3
+            with BlockPrefetcher(self.batch_rpc, ancestor_height + 1, chain_height, depth=self.PREFETCH_DEPTH, threads=self.PREFETCH_THREADS, batch_size=self.RPC_BATCH_SIZE) as prefetcher:
+                for prefetched in prefetcher:
+                    # Chaintip moved while we were prefetching, resync on next pass
+                    if self.last_synced_blk is not None and prefetched.height > ancestor_height + 1 and unhexlify(prefetched.blockinfo['previousblockhash']) != self.last_synced_blk:
+                        log_block_event(prefetched.hash, 'Stale', height=prefetched.height)
+                        break
+
+                    newblock = self.import_blockheight(prefetched.height, commit=False, prefetched=prefetched)
+                    self.last_synced_blk = newblock.hash
+                    if next_commit <= time():
+                        log_block_event(hexlify(newblock.hash), 'Commit')
+                        self.db.session.commit()
+                        self.snapshot_utxo_cache()
+                        newblock = None
+                        next_commit = time() + 3
+
+                        # Let the mempool worker in between commits
+                        self.import_lock.yield_to_waiters(self.db)
+
+            if newblock is not None:
                 log_block_event(hexlify(newblock.hash), 'Commit')
                 self.db.session.commit()
-                newblock = None
-                next_commit = time() + 3
-
-        if newblock is not None:
-            log_block_event(hexlify(newblock.hash), 'Commit')
-            self.db.session.commit()
+                self.snapshot_utxo_cache()
         return True
 
-    def import_blockheight(self, height, commit=True):
+    def snapshot_utxo_cache(self):
+        # Only called right after a commit, snapshot must match the committed chaintip
+        if self.next_utxo_cache_snapshot <= time():
+            self.db.save_utxo_cache()
+            self.next_utxo_cache_snapshot = time() + self.UTXO_CACHE_SNAPSHOT_INTERVAL
+
+    def import_blockheight(self, height, commit=True, prefetched=None):
         daemon = self.daemon()
-        blockhash = daemon.getblockhash(height)
-        blockinfo = daemon.getblock(blockhash)
+        batch_resolver = None
+        if prefetched is None:
+            blockhash = daemon.getblockhash(height)
+            prefetched = PrefetchedBlock(height, blockhash, daemon.getblock(blockhash), {})
+            batch_resolver = self.get_transactions
+
+        blockinfo = prefetched.blockinfo
         last_blockhash = blockinfo['previousblockhash']
         next_blockhash = blockinfo['nextblockhash'] if 'nextblockhash' in blockinfo else None
 
@@ -150,94 +228,41 @@ class Context(Configuration):
             if next_blockhash is None or unhexlify(next_blockhash) != nextblock.hash:
                 self.db.orphan_blocks(height + 1)
 
-        return self.db.import_blockinfo(daemon.getblock(blockhash), tx_resolver=self.get_transaction, commit=commit)
+        return self.db.import_blockinfo(blockinfo, tx_resolver=prefetched.tx_resolver(self.get_transaction), batch_resolver=batch_resolver, commit=commit)
 
-    def query_mempool(self):
-        new_txs = list(filter(lambda tx: tx not in self.mempoolcache, self.daemon().getrawmempool()))
-        if len(new_txs) == 0:
-            return False
-        for txid in new_txs:
-            self.db.check_need_import_transaction(txid, tx_resolver=self.get_transaction)
-            self.mempoolcache[txid] = True
-        return True
+    def check_notifications(self):
+        # Without notifications the daemon is polled on every pass, with them
+        # only when a block was announced or on the periodic resync.
+        if self.notifications is None:
+            return
+        self.notifications.acknowledge()
+        self.poll_chaintip = self.notifications.take_block() or self.notifications.resync_due(b'hashblock')
 
-    def update_single_balance(self):
-        dirty_address = self.db.next_dirty_address()
-        if dirty_address is None:
+    def update_dirty_balances(self):
+        start_time = time()
+        updated = self.db.update_dirty_balances(limit=self.BALANCE_BATCH_SIZE)
+        if updated == 0:
             return False
-        self.db.update_address_balance(dirty_address)
+
+        log_event('Updated', 'bal', '%d addresses' % updated, {'addr/s': '%.1f' % (updated / max(time() - start_time, 0.001))})
         return True
 
-    def update_coindays_destroyed(self, amount_at_once=50):
+    def update_coindays_destroyed(self, blocks_at_once=1000):
         self.db.reset_session()
 
-        results = self.db.session.query(
-            Block.id,
-            Block.timestamp,
-            Transaction
-        ).join(
-            Block.transactionreferences
-        ).join(
-            BlockTransaction.transaction
-        ).join(
-            Transaction.coindays_destroyed,
-            isouter=True
-        ).join(
-            Transaction.coinbaseinfo,
-            isouter=True
-        ).filter(
-            Block.height != None,
-            CoinDaysDestroyed.transaction_id == None,
-            CoinbaseInfo.transaction_id == None,
-            Block.id >= self.coindays_destroyed_calc_last_block_id
-        ).order_by(
-            Block.id.asc()
-        ).limit(amount_at_once).all()
-
-        if len(results) == 0:
-            try:
-                self.coindays_destroyed_calc_last_block_id = self.db.session.query(Block.id).order_by(Block.id.desc()).first()[0] + 1
-            except TypeError:
-                pass
+        last_block_id = self.db.session.query(sqlfunc.max(Block.id)).scalar()
+        if last_block_id is None or self.coindays_destroyed_calc_last_block_id > last_block_id:
             return False
 
-        for _, block_timestamp, tx in results:
-            tx_timestamp = tx.firstseen if tx.firstseen != None else block_timestamp
+        first_block_id = self.coindays_destroyed_calc_last_block_id
+        end_block_id = min(first_block_id + blocks_at_once, last_block_id + 1)
 
-            inputs = self.db.session.query(
-                TransactionOutput.amount,
-                Block.timestamp
-            ).join(
-                TransactionInput.input
-            ).join(
-                TransactionOutput.transaction
-            ).join(
-                Transaction.confirmation
-            ).join(
-                BlockTransaction.block
-            ).filter(
-                TransactionInput.transaction_id == tx.id
-            ).all()
-
-            coindays_destroyed = sum([
-                float(amount) * ((tx_timestamp - orig_timestamp).total_seconds() / 86400 if orig_timestamp < tx_timestamp else 0)
-                    for amount, orig_timestamp
-                    in inputs
-            ])
-
-            log_tx_event(hexlify(tx.txid), 'Coindays', inputs=len(inputs), coins=sum([input[0] for input in inputs]), coindays_destroyed=coindays_destroyed, date=tx_timestamp.strftime('%Y-%m-%d %H:%M:%S'))
-
-            model = CoinDaysDestroyed()
-            model.transaction_id = tx.id
-            model.coindays = coindays_destroyed
-            model.timestamp = tx_timestamp
-
-            self.db.session.add(model)
-
-        log_event('Commit', '%d' % len(results), 'destroyed coin-days entries')
+        start_time = time()
+        added = self.db.add_coindays_destroyed(first_block_id, end_block_id)
         self.db.session.commit()
+        log_event('Commit', '%d' % added, 'destroyed coin-days entries', {'blocks': '%d-%d' % (first_block_id, end_block_id - 1), 'time': '%d msec' % int((time() - start_time) * 1000)})
 
-        self.coindays_destroyed_calc_last_block_id = max([result[0] for result in results])
+        self.coindays_destroyed_calc_last_block_id = end_block_id
         return True
 
     def check_mempool_for_doublespends(self):
@@ -282,189 +307,178 @@ class Context(Configuration):
         self.db.session.commit()
         return True
 
-    def migrate_old_data(self):
-        if self.migration_type == 'init':
-            self.migration_type = 'mutations'
-            self.migration_last_id = 0
-
-        if self.migration_type == 'mutations':
-            if self.migration_update_tx_mutations():
-                return True
-            self.migration_type = 'address_script'
-            self.migration_last_id = 0
-
-        if self.migration_type == 'address_script':
-            if self.migration_update_add_address_script():
-                return True
-            self.migration_type = 'block_totalfee'
-            self.migration_last_id = 0
-
-        if self.migration_type == 'block_totalfee':
-            if self.migration_update_block_totalfee():
-                return True
-            self.migration_type = 'coinbase_newcoins'
-            self.migration_last_id = 0
-
-        if self.migration_type == 'coinbase_newcoins':
-            if self.migration_update_coinbase_newcoins():
-                return True
-            self.migration_type = None
-            self.migration_last_id = 0
-        return False
-
-    def migration_update_tx_mutations(self):
-        transaction = self.db.session.query(
-            Transaction
-        ).join(
-            Transaction.address_mutations,
-            isouter=True
-        ).filter(
-            Transaction.id > self.migration_last_id,
-            Mutation.id == None
-        ).first()
-
-        if transaction == None:
-            return False
-
-        self.migration_last_id = transaction.id
-
-        self.db.add_tx_mutations_info(transaction)
-        self.db.session.flush()
-        return True
-
-    def migration_update_add_address_script(self):
-        address = self.db.session.query(
-            Address
-        ).filter(
-            Address.id > self.migration_last_id,
-            Address.type_id.in_([ 0, 1 ]),
-            Address.raw == None
-        ).first()
-
-        if address == None:
-            return False
+    def exclusive(self, operation):
+        def run():
+            with self.import_lock.hold(self.db):
+                return operation()
+        return run
 
-        self.migration_last_id = address.id
-
-        log_event('Import', 'scp', address.address)
-
-        daemon = self.daemon()
-        script = daemon.validateaddress(address.address)['scriptPubKey']
-        script = daemon.decodescript(script)['asm']
-
-        address.raw = script
-        self.db.session.add(address)
-        self.db.session.flush()
-        return True
-
-    def migration_update_block_totalfee(self):
-        block = self.db.session.query(Block).filter(Block.totalfee == None).filter(Block.id > self.migration_last_id).first()
-
-        if block == None:
-            return False
-
-        self.migration_last_id = block.id
-
-        log_block_event(hexlify(block.hash), 'Migrate')
-        block.totalfee = sum([ tx.fee for tx in block.transactions ])
-        self.db.session.add(block)
-        self.db.session.flush()
-        return True
-
-    def migration_update_coinbase_newcoins(self):
-        cb = self.db.session.query(CoinbaseInfo).filter(CoinbaseInfo.newcoins == None).filter(CoinbaseInfo.block_id > self.migration_last_id).first()
-
-        if cb == None:
-            return False
-
-        self.migration_last_id = cb.block_id
-
-        log_event('Migrate', 'cb', hexlify(cb.transaction.txid))
-        cb.newcoins = cb.transaction.totalvalue - cb.block.totalfee
-        self.db.session.add(cb)
-        self.db.session.flush()
-        return True
+    def migrate_old_data(self):
+        return self.migrations.step()
 
     def get_transaction(self, txid):
-        return self.daemon().load_transaction(txid)
-
-
-def do_until_timeout(operation, timeout):
-    if operation():
-        while time() < timeout:
-            if not operation():
-                break
-        return True
-    return False
+        return load_transaction(self.batch_rpc, txid)
 
+    def get_transactions(self, txids):
+        return load_transactions(self.batch_rpc, txids, batch_size=self.RPC_BATCH_SIZE)
 
-def do_in_loop(operation, before_sleep=None, after_first_run=None, interval=1):
-    working = False
-    first_run = True
-    while True:
-        if working is None:
-            working = True
-        elif working is False:
-            working = None
 
-        if operation():
-            continue
-
-        if working and before_sleep is not None:
-            before_sleep()
+def indexer(context):
+    context.db.sync_txid_index()
 
-        working = False
+    log('\nChecking database state...\n')
+    context.verify_state(full=argv_option('--verify') == 'full')
 
-        if first_run:
-            if after_first_run is not None:
-                after_first_run()
-            first_run = False
+    context.db.load_utxo_cache()
 
-        sleep(interval)
+    # Keeps the mempool current while blocks are being caught up with
+    context.mempool_worker = MempoolWorker(context, context.import_lock, BlockParser(context.db.coin), interval=context.MEMPOOL_POLL_INTERVAL)
+    if context.notifications is not None:
+        context.notifications.start()
+    context.mempool_worker.start()
 
+    log('\nPerforming initial sync...\n')
+    context.sync_blocks(initial=True)
 
-def indexer(context):
-    def main_loop():
+    scheduler = Scheduler(
+        idle_wait_min=context.IDLE_WAIT_MIN,
+        idle_wait_max=context.IDLE_WAIT_MAX,
+        stats_interval=context.SCHEDULER_STATS_INTERVAL
+    )
+    scheduler.reporters = [ context.rpc.log_stats, context.batch_rpc.log_stats ]
+    if context.notifications is not None:
+        scheduler.wait = context.notifications.wait
+        scheduler.preempt = context.notifications.pending
+
+    def poll_chaintip():
         context.db.reset_session()
+        context.check_notifications()
+        return context.sync_blocks()
+
+    # Block ingestion runs on every pass, housekeeping gets time sliced in
+    # priority order and yields as soon as a block is announced. Mempool
+    # ingestion runs in its own worker.
+    scheduler.add('chaintip', poll_chaintip, 0)
+    scheduler.add('doublespends', context.exclusive(context.check_mempool_for_doublespends), 1)
+    scheduler.add('balances', context.exclusive(context.update_dirty_balances), 10, budget=3, max_backoff=1)
+    scheduler.add('coindays', context.exclusive(context.update_coindays_destroyed), 11, budget=3, max_backoff=30)
+    scheduler.add('migrations', context.exclusive(context.migrate_old_data), 12, budget=3, max_backoff=60)
 
-        context.query_mempool()
-        if context.sync_blocks():
-            return True
-
-        if context.check_mempool_for_doublespends():
-            return True
+    log('\nSwitching to live tracking of mempool and chaintip.\n')
+    scheduler.run(before_sleep=lambda: log_event('Synced', 'chn', ''), after_first_run=lambda: make_pidfile(__main__))
+
+
+def bulkload(context):
+    loader = BulkLoader(context, insert_rows=context.BULK_INSERT_ROWS)
+    try:
+        loader.setup()
+
+        chaintip = context.db.chaintip()
+        first_height = chaintip.height + 1 if chaintip is not None else 0
+        last_height = context.daemon().get_current_height() - context.BULK_LOAD_TIP_DISTANCE
+
+        # Decoding is CPU bound, worker processes scale past what prefetch threads can do
+        if context.BULK_LOAD_PROCESSES > 1:
+            loader.load_parallel(
+                first_height,
+                last_height,
+                processes=context.BULK_LOAD_PROCESSES,
+                chunk_size=context.BULK_LOAD_CHUNK_SIZE,
+                batch_size=context.RPC_BATCH_SIZE
+            )
+        else:
+            loader.load(
+                first_height,
+                last_height,
+                prefetch_depth=context.PREFETCH_DEPTH,
+                prefetch_threads=context.PREFETCH_THREADS,
+                batch_size=context.RPC_BATCH_SIZE
+            )
+        loader.postpass()
+    finally:
+        loader.close()
+
+    log('\nBulk load complete, continuing with regular sync.\n')
+    indexer(context)
+
+
+def import_blockfiles(context):
+    context.db.sync_txid_index()
+
+    directory = argv_option('--import-blockfiles')
+    importer = BlockFileImporter(
+        context.db,
+        directory if directory is not True else context.BLOCKFILES_DIR,
+        tip_distance=context.BLOCKFILES_TIP_DISTANCE,
+        daemon=context.daemon()
+    )
+    importer.run()
+
+    log('\nBlock file import complete, continuing with regular sync.\n')
+    indexer(context)
+
+
+def rebuild_txid_index(context):
+    if context.db.txid_index is None:
+        raise Exception('No txid index configured')
+
+    log('\nRebuilding txid index...\n')
+    context.db.txid_index.rebuild(context.db.session)
+
+
+def benchmark_input_resolution(context, sizes=(1, 100, 5000)):
+    db = context.db
+    log('\nBenchmarking input resolution...\n')
+
+    for size in sizes:
+        # The most recent outputs stand in for the inputs of a transaction
+        outpoints = db.session.query(
+            Transaction.txid,
+            TransactionOutput.index
+        ).select_from(
+            TransactionOutput
+        ).join(
+            Transaction
+        ).order_by(
+            TransactionOutput.id.desc()
+        ).limit(size).all()
+        inputs = [ {'_txid': txid, 'vout': index, '_vout': index, '_txo': hexlify(txid).decode('ascii') + '_' + str(index)} for txid, index in outpoints ]
 
-        timeout = time() + 3
+        timings = {}
+        for method, join_threshold in [ ('predicates', len(inputs) + 1), ('join', 0) ]:
+            start_time = time()
+            resolved = db.lookup_input_utxos_slow(inputs, join_threshold=join_threshold)
+            timings[method] = '%d msec' % int((time() - start_time) * 1000)
+            timings[method + ' resolved'] = len(resolved)
+        log_event('Bench', 'txi', '%d inputs' % len(inputs), timings)
 
-        if do_until_timeout(context.update_single_balance, timeout):
-            return True
+    db.session.rollback()
 
-        if do_until_timeout(context.update_coindays_destroyed, timeout):
-            return True
 
-        # Data migration is done in bulk (with large commits!)
-        if do_until_timeout(context.migrate_old_data, timeout):
-            context.db.session.commit()
+def argv_option(name):
+    for arg in argv[1:]:
+        if arg == name:
             return True
-        return False
-
-    log('\nChecking database state...\n')
-    context.verify_state()
-
-    log('\nPerforming initial sync...\n')
-    context.sync_blocks(initial=True)
-
-    log('\nSwitching to live tracking of mempool and chaintip.\n')
-    do_in_loop(operation=main_loop, before_sleep=lambda: log_event('Synced', 'chn', ''), after_first_run=lambda: make_pidfile(__main__))
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return None
 
 
 def main(func, db_timeout=30):
     with Context(db_timeout) as c:
         try:
+            c.db.upgrade_schema()
             func(c)
         except KeyboardInterrupt:
             return
 
 
 if __name__ == '__main__':
-    main(indexer)
+    if argv_option('--rebuild-txid-index') is not None:
+        main(rebuild_txid_index)
+    elif argv_option('--benchmark-inputs') is not None:
+        main(benchmark_input_resolution)
+    elif argv_option('--import-blockfiles') is not None:
+        main(import_blockfiles)
+    else:
+        main(bulkload if '--bulk-load' in argv else indexer)
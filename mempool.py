@@ -0,0 +1,236 @@
+import struct
+import threading
+
+from contextlib import contextmanager
+
+from logger import log_event, log_tx_event
+
+
+class ImportLock(object):
+    # Serializes writes of the block importer and the mempool worker:
+    #  - every write transaction runs with the lock held and is committed
+    #    (or rolled back) before it is released,
+    #  - after acquiring it the session is reset, so reads see everything
+    #    the other side committed,
+    #  - waiters are served first come first served, so the block importer
+    #    yielding between commits lets a waiting mempool worker in.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+
+    def acquire(self, db):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while self.serving != ticket:
+                self.condition.wait()
+        db.reset_session()
+
+    def release(self):
+        with self.condition:
+            self.serving += 1
+            self.condition.notify_all()
+
+    def waiting(self):
+        with self.condition:
+            return self.next_ticket - self.serving > 1
+
+    def yield_to_waiters(self, db):
+        if self.waiting():
+            self.release()
+            self.acquire(db)
+
+    @contextmanager
+    def hold(self, db):
+        self.acquire(db)
+        try:
+            yield
+        except BaseException:
+            # Nothing of a failed write may outlive the lock
+            db.reset_session()
+            raise
+        finally:
+            self.release()
+
+
+class MempoolWorker(object):
+    def __init__(self, context, import_lock, parser, interval=1):
+        self.context = context
+        self.import_lock = import_lock
+        self.parser = parser
+        self.interval = interval
+        self.notifications = context.notifications
+
+        # Own caches: rollbacks here must not touch the block importer's
+        # uncommitted UTXO cache journal (the cache is shared per process).
+        self.db = context.db.new_session(shared_caches=False)
+
+        self.mempool_txids = None
+        self.poll = True
+
+        # Transactions spending outputs of blocks that were not imported yet
+        self.deferred = {}
+
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # Returns once the worker is out of the database, the caller goes on
+        # closing the session, caches and txid index.
+        self.stopped = True
+        self.wakeup.set()
+        if self.notifications is not None:
+            self.notifications.tx_wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                busy = self.step()
+            except Exception as e:
+                log_event('Failed', 'mem', 'mempool', {'reason': type(e).__name__})
+                self.poll = True
+                busy = False
+
+            if busy:
+                continue
+            if self.notifications is not None:
+                self.notifications.wait_transactions(self.interval)
+            else:
+                self.wakeup.wait(self.interval)
+
+    def step(self):
+        if self.notifications is not None:
+            self.notifications.acknowledge_transactions()
+            self.poll = self.poll or self.notifications.resync_due(b'rawtx')
+
+        # Start out from what the database considers to be in the mempool, so
+        # transactions dropped while the indexer was down get evicted too.
+        if self.mempool_txids is None:
+            with self.import_lock.hold(self.db):
+                self.mempool_txids = self.db.mempool_txids()
+
+        if self.poll:
+            return self.sync_mempool()
+        return self.import_notified_transactions()
+
+    def sync_mempool(self):
+        self.poll = self.notifications is None
+        if self.notifications is not None:
+            self.notifications.take_transactions()
+
+        daemon = self.context.daemon()
+        current_txids = daemon.getrawmempool()
+        # Read after the mempool, so blocks that took transactions out of it are counted
+        daemon_height = daemon.get_current_height()
+        current = set(current_txids)
+        added = [ txid for txid in current_txids if txid not in self.mempool_txids ]
+        removed = list(self.mempool_txids - current)
+
+        self.deferred = dict([ (txid, txinfo) for txid, txinfo in self.deferred.items() if txid in current ])
+        missing = [ txid for txid in added if txid not in self.deferred ]
+        transactions = self.context.get_transactions(missing) if len(missing) > 0 else {}
+        transactions.update(self.deferred)
+
+        # Fetched before taking the lock, block import only waits for the database writes
+        with self.import_lock.hold(self.db):
+            imported = self.import_transactions(added, transactions)
+
+            # Evicted earlier but relayed again
+            if len(imported) > 0:
+                self.db.set_evicted(imported, evicted=False)
+
+            # Transactions confirmed in blocks that were not imported yet left
+            # the mempool as well, hold off evicting until the indexer caught up.
+            indexer_height = self.db.committed_chaintip_height()
+            if indexer_height is None or indexer_height < daemon_height:
+                postponed = set(removed)
+                removed = []
+            else:
+                postponed = set()
+
+            if len(removed) > 0:
+                log_event('Evicted', 'tx', '%d transactions' % len(removed))
+                self.db.set_evicted(removed)
+
+        self.mempool_txids = (current | postponed) - set(self.deferred.keys())
+        return len(imported) > 0 or len(removed) > 0
+
+    def import_notified_transactions(self):
+        txids = []
+        transactions = dict(self.deferred)
+        for rawtx in self.notifications.take_transactions():
+            try:
+                txinfo, _ = self.parser.parse_transaction(bytearray(rawtx), 0)
+            except (struct.error, IndexError, ValueError):
+                log_event('Invalid', 'zmq', 'rawtx')
+                self.poll = True
+                continue
+
+            # Coinbases are announced when their block connects, those are handled by the block import
+            if 'coinbase' in txinfo['vin'][0] or txinfo['txid'] in self.mempool_txids or txinfo['txid'] in transactions:
+                continue
+            txids.append(txinfo['txid'])
+            transactions[txinfo['txid']] = txinfo
+
+        txids = list(self.deferred.keys()) + txids
+        if len(txids) == 0:
+            return False
+
+        with self.import_lock.hold(self.db):
+            imported = self.import_transactions(txids, transactions)
+
+        self.mempool_txids.update(imported)
+        return len(imported) > 0
+
+    def import_transactions(self, txids, transactions):
+        ready, deferred = self.order_by_dependencies(txids, transactions)
+
+        # Known ones (relayed again, confirmed meanwhile) are skipped, the rest
+        # goes in with one multi-row INSERT per table and a single commit.
+        known = self.db.transaction_internal_ids(ready)
+        new = [ (txid, transactions[txid]) for txid in ready if txid not in known ]
+        if len(new) > 0:
+            self.db.import_transactions(new)
+            log_event('Commit', 'mem', '%d transactions' % len(new))
+            self.db.session.commit()
+
+        for txid in ready:
+            self.deferred.pop(txid, None)
+
+        for txid in deferred:
+            if txid not in self.deferred:
+                log_tx_event(txid, 'Deferred', reason='unknown inputs')
+            self.deferred[txid] = transactions[txid]
+        return ready
+
+    def order_by_dependencies(self, txids, transactions):
+        # Parents are imported before their children. Transactions spending
+        # outputs that are neither in the database nor in this batch (the
+        # block importer is still catching up) are deferred.
+        pending = [ txid for txid in txids if txid in transactions ]
+        known = set(self.db.transaction_internal_ids(list(set([
+            txin['txid'] for txid in pending for txin in transactions[txid]['vin'] if 'coinbase' not in txin
+        ]))).keys())
+        ready = []
+        progress = True
+        while progress and len(pending) > 0:
+            progress = False
+            deferred = []
+            for txid in pending:
+                parents = [ txin['txid'] for txin in transactions[txid]['vin'] if 'coinbase' not in txin ]
+                if all([ parent in known for parent in parents ]):
+                    known.add(txid)
+                    ready.append(txid)
+                    progress = True
+                else:
+                    deferred.append(txid)
+            pending = deferred
+        return ready, pending
@@ -0,0 +1,245 @@
+from abc import ABCMeta, abstractmethod
+from binascii import hexlify
+from time import time
+
+from coinsupport.addresscodecs import decode_any_address
+
+from logger import log_event
+
+
+# Python 2 and 3 compatible abstract base
+ABC = ABCMeta('ABC', (object,), {})
+
+
+class Migration(ABC):
+    # Rows of `table` are migrated in batches of `key` ranges, MigrationRunner
+    # records the last migrated key in the `migration` table under `name`.
+    name = None
+    table = None
+    key = 'id'
+    batch_size = 10000
+
+    def __init__(self, context):
+        self.context = context
+
+    @abstractmethod
+    def run_batch(self, session, first_id, end_id):
+        # Migrates keys first_id <= key < end_id and returns the number of
+        # changed rows. The runner commits it together with the checkpoint.
+        pass
+
+
+class TransactionMutations(Migration):
+    name = 'mutations'
+    table = 'transaction'
+    batch_size = 5000
+
+    def run_batch(self, session, first_id, end_id):
+        return session.execute('''
+            INSERT INTO `mutation` (`transaction`, `address`, `amount`)
+                SELECT `changes`.`transaction`, `changes`.`address`, SUM(`changes`.`amount`) FROM (
+                    SELECT `txout`.`transaction`, `txout`.`address`, `txout`.`amount` FROM `txout`
+                        WHERE `txout`.`transaction` >= :first_id AND `txout`.`transaction` < :end_id
+                UNION ALL
+                    SELECT `txin`.`transaction`, `txout`.`address`, '0' - `txout`.`amount` FROM `txin`
+                        JOIN `txout` ON `txin`.`input` = `txout`.`id`
+                    WHERE `txin`.`transaction` >= :first_id AND `txin`.`transaction` < :end_id
+                ) `changes`
+                    LEFT JOIN `mutation` ON `changes`.`transaction` = `mutation`.`transaction`
+                WHERE `mutation`.`id` IS NULL
+                    GROUP BY `changes`.`transaction`, `changes`.`address`;
+        ''', {
+            'first_id': first_id,
+            'end_id': end_id
+        }).rowcount
+
+
+class AddressScripts(Migration):
+    name = 'address_script'
+    table = 'address'
+
+    def script_asm(self, address):
+        coin = self.context.db.coin
+        try:
+            addr_type, version, hash = decode_any_address(address.encode('utf-8'), bech32_prefix=coin['bech32_prefix'])
+        except (ValueError, TypeError):
+            return None
+
+        hash = hexlify(hash).decode('ascii')
+        if addr_type == 'bech32':
+            return '%d %s' % (version, hash)
+        if version == coin['address_version']:
+            return 'OP_DUP OP_HASH160 %s OP_EQUALVERIFY OP_CHECKSIG' % hash
+        if version == coin['p2sh_address_version']:
+            return 'OP_HASH160 %s OP_EQUAL' % hash
+        return None
+
+    def daemon_script_asm(self, address):
+        daemon = self.context.daemon()
+        return daemon.decodescript(daemon.validateaddress(address)['scriptPubKey'])['asm']
+
+    def run_batch(self, session, first_id, end_id):
+        addresses = session.execute('''
+            SELECT `id`, `address` FROM `address`
+                WHERE `id` >= :first_id AND `id` < :end_id
+                    AND `type` IN (0, 1)
+                    AND `raw` IS NULL;
+        ''', {
+            'first_id': first_id,
+            'end_id': end_id
+        }).fetchall()
+
+        # Scripts of standard addresses are derived locally, only unusual versions need the daemon
+        updates = []
+        for address_id, address in addresses:
+            script = self.script_asm(address)
+            updates.append({'id': address_id, 'raw': script if script is not None else self.daemon_script_asm(address)})
+
+        if len(updates) > 0:
+            session.execute('UPDATE `address` SET `raw` = :raw WHERE `id` = :id;', updates)
+        return len(updates)
+
+
+class BlockTotalFees(Migration):
+    name = 'block_totalfee'
+    table = 'block'
+
+    def run_batch(self, session, first_id, end_id):
+        return session.execute('''
+            UPDATE `block`
+                LEFT JOIN (
+                    SELECT `blocktx`.`block`, SUM(`transaction`.`fee`) AS `totalfee` FROM `blocktx`
+                        JOIN `transaction` ON `blocktx`.`transaction` = `transaction`.`id`
+                    WHERE `blocktx`.`block` >= :first_id AND `blocktx`.`block` < :end_id
+                        GROUP BY `blocktx`.`block`
+                ) `fees` ON `block`.`id` = `fees`.`block`
+            SET `block`.`totalfee` = COALESCE(`fees`.`totalfee`, 0.0)
+                WHERE `block`.`id` >= :first_id AND `block`.`id` < :end_id
+                    AND `block`.`totalfee` IS NULL;
+        ''', {
+            'first_id': first_id,
+            'end_id': end_id
+        }).rowcount
+
+
+class CoinbaseNewCoins(Migration):
+    name = 'coinbase_newcoins'
+    table = 'coinbase'
+    key = 'block'
+
+    def run_batch(self, session, first_id, end_id):
+        return session.execute('''
+            UPDATE `coinbase`
+                JOIN `transaction` ON `coinbase`.`transaction` = `transaction`.`id`
+                JOIN `block` ON `coinbase`.`block` = `block`.`id`
+            SET `coinbase`.`newcoins` = `transaction`.`totalvalue` - `block`.`totalfee`
+                WHERE `coinbase`.`block` >= :first_id AND `coinbase`.`block` < :end_id
+                    AND `coinbase`.`newcoins` IS NULL;
+        ''', {
+            'first_id': first_id,
+            'end_id': end_id
+        }).rowcount
+
+
+class BlockSummaries(Migration):
+    name = 'block_summary'
+    table = 'block'
+
+    def run_batch(self, session, first_id, end_id):
+        return session.execute('''
+            UPDATE `block`
+                LEFT JOIN (
+                    SELECT `blocktx`.`block`, COUNT(*) AS `txcount`, SUM(IF(ISNULL(`coinbase`.`transaction`), `transaction`.`totalvalue`, 0.0)) AS `transacted` FROM `blocktx`
+                        JOIN `transaction` ON `blocktx`.`transaction` = `transaction`.`id`
+                        LEFT JOIN `coinbase` ON `transaction`.`id` = `coinbase`.`transaction`
+                    WHERE `blocktx`.`block` >= :first_id AND `blocktx`.`block` < :end_id
+                        GROUP BY `blocktx`.`block`
+                ) `txs` ON `block`.`id` = `txs`.`block`
+                LEFT JOIN (
+                    SELECT `blocktx`.`block`, COUNT(*) AS `inputcount` FROM `blocktx`
+                        JOIN `txin` ON `blocktx`.`transaction` = `txin`.`transaction`
+                    WHERE `blocktx`.`block` >= :first_id AND `blocktx`.`block` < :end_id
+                        GROUP BY `blocktx`.`block`
+                ) `inputs` ON `block`.`id` = `inputs`.`block`
+                LEFT JOIN (
+                    SELECT `blocktx`.`block`, COUNT(*) AS `outputcount` FROM `blocktx`
+                        JOIN `txout` ON `blocktx`.`transaction` = `txout`.`transaction`
+                    WHERE `blocktx`.`block` >= :first_id AND `blocktx`.`block` < :end_id
+                        GROUP BY `blocktx`.`block`
+                ) `outputs` ON `block`.`id` = `outputs`.`block`
+            SET `block`.`txcount` = COALESCE(`txs`.`txcount`, 0),
+                `block`.`inputcount` = COALESCE(`inputs`.`inputcount`, 0),
+                `block`.`outputcount` = COALESCE(`outputs`.`outputcount`, 0),
+                `block`.`transacted` = COALESCE(`txs`.`transacted`, 0.0)
+                WHERE `block`.`id` >= :first_id AND `block`.`id` < :end_id
+                    AND `block`.`txcount` IS NULL;
+        ''', {
+            'first_id': first_id,
+            'end_id': end_id
+        }).rowcount
+
+
+MIGRATIONS = [
+    TransactionMutations,
+    AddressScripts,
+    BlockTotalFees,
+    CoinbaseNewCoins,
+    BlockSummaries
+]
+
+
+class MigrationRunner(object):
+    def __init__(self, context, migrations=MIGRATIONS):
+        self.context = context
+        self.migrations = [ migration(context) for migration in migrations ]
+        self.started = {}
+
+    def checkpoint(self, session, migration):
+        row = session.execute('SELECT `lastid`, `done` FROM `migration` WHERE `name` = :name;', {'name': migration.name}).first()
+        if row is None:
+            session.execute('INSERT INTO `migration` (`name`, `lastid`, `done`) VALUES (:name, \'-1\', \'0\');', {'name': migration.name})
+            return -1, False
+        return row[0], bool(row[1])
+
+    def step(self):
+        session = self.context.db.session
+
+        for migration in self.migrations:
+            last_id, done = self.checkpoint(session, migration)
+            if done:
+                continue
+
+            max_id = session.execute('SELECT MAX(`%s`) FROM `%s`;' % (migration.key, migration.table), {}).scalar()
+            if max_id is None or last_id >= max_id:
+                session.execute('UPDATE `migration` SET `done` = \'1\' WHERE `name` = :name;', {'name': migration.name})
+                session.commit()
+                log_event('Done', 'mig', migration.name)
+                continue
+
+            start_time = time()
+            end_id = min(last_id + 1 + migration.batch_size, max_id + 1)
+            changed = migration.run_batch(session, last_id + 1, end_id)
+
+            # Checkpoint is committed together with the batch
+            session.execute('UPDATE `migration` SET `lastid` = :last_id WHERE `name` = :name;', {'name': migration.name, 'last_id': end_id - 1})
+            session.commit()
+
+            self.report(migration, last_id, end_id - 1, max_id, changed, time() - start_time)
+            return True
+        return False
+
+    def report(self, migration, previous_id, last_id, max_id, changed, elapsed):
+        if migration.name not in self.started:
+            self.started[migration.name] = (time() - elapsed, previous_id)
+        started_at, started_id = self.started[migration.name]
+
+        rate = (last_id - started_id) / max(time() - started_at, 0.001)
+        eta = (max_id - last_id) / rate if rate > 0 else 0
+
+        log_event('Migrate', 'mig', migration.name, {
+            'progress': '%.1f%%' % (100.0 * (last_id + 1) / (max_id + 1)),
+            'changed': changed,
+            'ids/s': '%.0f' % rate,
+            'eta': '%d:%02d:%02d' % (eta // 3600, (eta // 60) % 60, eta % 60),
+            'time': '%d msec' % int(elapsed * 1000)
+        })
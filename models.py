@@ -199,12 +199,16 @@ class Block(Base):
     firstseen = Column(DateTime)
     relayedby = Column(String(48))
     miner_id = Column('miner', Integer, ForeignKey('pool.id'), index=True)
+    txcount = Column(Integer)
+    inputcount = Column(Integer)
+    outputcount = Column(Integer)
+    transacted = Column(Float(asdecimal=True))
 
     miner = relationship('Pool')
     coinbaseinfo = relationship('CoinbaseInfo', back_populates='block', uselist=False)
     transactionreferences = relationship('BlockTransaction', back_populates='block', cascade='save-update, merge, delete')
 
-    API_DATA_FIELDS = [hash, height, size, timestamp, difficulty, firstseen, relayedby, 'Block.totaltransacted', 'Block.totalfees', 'Block.miningreward']
+    API_DATA_FIELDS = [hash, height, size, timestamp, difficulty, firstseen, relayedby, txcount, inputcount, outputcount, 'Block.totaltransacted', 'Block.totalfees', 'Block.miningreward']
     POSTPROCESS_RESOLVE_FOREIGN_KEYS = [miner, 'Block.transactions', 'Transaction.mutations', 'Transaction.inputs', 'Transaction.outputs']
 
     @property
@@ -235,7 +239,10 @@ class Block(Base):
 
     @property
     def totaltransacted(self):
-        return sum([ tx.totalvalue for tx in filter(lambda tx: not tx.coinbase, self.transactions) ])
+        # Summary of blocks not migrated yet (see migrations.BlockSummaries)
+        if self.transacted is None:
+            return sum([ tx.totalvalue for tx in filter(lambda tx: not tx.coinbase, self.transactions) ])
+        return self.transacted
 
 
 class BlockTransaction(Base):
@@ -249,6 +256,25 @@ class BlockTransaction(Base):
     block = relationship('Block', back_populates='transactionreferences')
 
 
+class BlockUndo(Base):
+    __tablename__ = 'blockundo'
+
+    block_id = Column('block', Integer, ForeignKey('block.id'), primary_key=True)
+    transactions = Column(Integer)
+    fees = Column(Float(asdecimal=True))
+    newcoins = Column(Float(asdecimal=True))
+
+
+class BlockUndoEntry(Base):
+    __tablename__ = 'blockundoentry'
+
+    id = Column(BigInteger, primary_key=True)
+    block_id = Column('block', Integer, ForeignKey('block.id'), index=True)
+    txout_id = Column('txout', BigInteger)
+    address_id = Column('address', Integer)
+    amount = Column(Float(asdecimal=True))
+
+
 class CachedValue(Base):
     __tablename__ = 'cache'
 
@@ -422,6 +448,7 @@ class Transaction(Base):
     relayedby = Column(String(48))
     confirmation_id = Column('confirmation', BigInteger, ForeignKey('blocktx.id'), unique=True)
     doublespends_id = Column('doublespends', BigInteger, ForeignKey('transaction.id'))
+    evicted = Column(Boolean, default=False)
     in_mempool = Column('mempool', Boolean)
 
     confirmation = relationship('BlockTransaction', foreign_keys=[confirmation_id])
@@ -0,0 +1,122 @@
+import struct
+import threading
+
+from time import time
+
+from logger import log_event
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+class NotificationListener(object):
+    TOPICS = [ b'hashblock', b'rawtx' ]
+
+    def __init__(self, url, resync_interval=60, max_queued=10000):
+        if zmq is None:
+            raise Exception('ZMQ notifications require pyzmq to be installed')
+
+        self.url = url
+        self.resync_interval = resync_interval
+        self.max_queued = max_queued
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.tx_wakeup = threading.Event()
+        self.block_pending = False
+        self.transactions = []
+        self.sequences = {}
+        self.next_resync = {}
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        log_event('Listen', 'zmq', self.url)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.tx_wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        for topic in self.TOPICS:
+            socket.setsockopt(zmq.SUBSCRIBE, topic)
+        socket.connect(self.url)
+
+        try:
+            while not self.stopped:
+                if socket.poll(1000) != 0:
+                    self.handle(socket.recv_multipart())
+        finally:
+            socket.close(linger=0)
+
+    def handle(self, message):
+        topic, body = message[0], message[1]
+        sequence = struct.unpack('<I', message[2])[0] if len(message) > 2 and len(message[2]) == 4 else None
+
+        with self.lock:
+            # Lost messages (publisher queue overflow, reconnect): fall back to polling once
+            last_sequence = self.sequences.get(topic)
+            if sequence is not None and last_sequence is not None and sequence != (last_sequence + 1) & 0xffffffff:
+                log_event('Missed', 'zmq', topic.decode('ascii'), {'messages': (sequence - last_sequence - 1) & 0xffffffff})
+                self.next_resync[topic] = 0
+            self.sequences[topic] = sequence
+
+            if topic == b'hashblock':
+                self.block_pending = True
+            elif topic == b'rawtx':
+                if len(self.transactions) >= self.max_queued:
+                    self.transactions = []
+                    self.next_resync[topic] = 0
+                else:
+                    self.transactions.append(bytes(body))
+
+        # Blocks wake up the main loop, transactions the mempool worker
+        if topic == b'hashblock':
+            self.wakeup.set()
+        else:
+            self.tx_wakeup.set()
+
+    def wait(self, timeout):
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def pending(self):
+        return self.wakeup.is_set()
+
+    def acknowledge(self):
+        self.wakeup.clear()
+
+    def wait_transactions(self, timeout):
+        self.tx_wakeup.wait(timeout)
+        self.tx_wakeup.clear()
+
+    def acknowledge_transactions(self):
+        self.tx_wakeup.clear()
+
+    def resync_due(self, topic):
+        with self.lock:
+            if time() < self.next_resync.get(topic, 0):
+                return False
+            self.next_resync[topic] = time() + self.resync_interval
+            return True
+
+    def take_block(self):
+        with self.lock:
+            block_pending = self.block_pending
+            self.block_pending = False
+            return block_pending
+
+    def take_transactions(self):
+        with self.lock:
+            transactions = self.transactions
+            self.transactions = []
+            return transactions
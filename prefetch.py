@@ -0,0 +1,132 @@
+import threading
+
+from logger import log_event
+
+
+# Single transactions are resolved with the same call as batches, so the
+# fallback returns txinfo of the same shape (and number types).
+def load_transaction(rpc, txid):
+    return rpc.getrawtransaction(txid, 1)
+
+
+def load_transactions(rpc, txids, batch_size=500):
+    results = {}
+    for start in range(0, len(txids), batch_size):
+        for txinfo in rpc.batch_([ ['getrawtransaction', txid, 1] for txid in txids[start:start+batch_size] ]):
+            results[txinfo['txid']] = txinfo
+    return results
+
+
+def fetch_block(rpc, height, batch_size=500):
+    blockhash = rpc.getblockhash(height)
+    blockinfo = rpc.getblock(blockhash)
+
+    # Genesis block transactions are never imported
+    txids = blockinfo['tx'] if height > 0 else []
+
+    return PrefetchedBlock(height, blockhash, blockinfo, load_transactions(rpc, txids, batch_size=batch_size))
+
+
+class PrefetchedBlock(object):
+    def __init__(self, height, blockhash, blockinfo, transactions):
+        self.height = height
+        self.hash = blockhash
+        self.blockinfo = blockinfo
+        self.transactions = transactions
+
+    def tx_resolver(self, fallback):
+        def resolve(txid):
+            if txid in self.transactions:
+                return self.transactions[txid]
+            return fallback(txid)
+        return resolve
+
+
+class BlockPrefetcher(object):
+    def __init__(self, rpc, first_height, last_height, depth=16, threads=4, batch_size=500):
+        self.rpc = rpc
+        self.batch_size = batch_size
+        self.next_height = first_height
+        self.next_fetch_height = first_height
+        self.last_height = last_height
+        self.depth = depth
+
+        # Bounded reorder buffer: workers may run at most `depth` blocks
+        # ahead of the consumer, results are handed out in height order.
+        self.slots = threading.Semaphore(depth)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.results = {}
+        self.stopped = False
+
+        self.workers = [ threading.Thread(target=self.worker) for _ in range(min(threads, last_height - first_height + 1)) ]
+        for worker in self.workers:
+            worker.daemon = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __iter__(self):
+        while self.next_height <= self.last_height:
+            block = self.get()
+            if block is None:
+                return
+            yield block
+
+    def start(self):
+        log_event('Prefetch', 'blk', '%d-%d' % (self.next_height, self.last_height), {'depth': self.depth, 'threads': len(self.workers)})
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.results = {}
+            self.ready.notify_all()
+
+        # Unblock any worker waiting for a free slot
+        for _ in self.workers:
+            self.slots.release()
+
+    def get(self):
+        with self.lock:
+            height = self.next_height
+            while height not in self.results and not self.stopped:
+                self.ready.wait(1.0)
+            if self.stopped:
+                return None
+            result = self.results.pop(height)
+            self.next_height += 1
+
+        self.slots.release()
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def worker(self):
+        while True:
+            self.slots.acquire()
+            with self.lock:
+                if self.stopped or self.next_fetch_height > self.last_height:
+                    return
+                height = self.next_fetch_height
+                self.next_fetch_height += 1
+
+            try:
+                result = self.fetch(self.rpc, height)
+            except Exception as e:
+                result = e
+
+            with self.lock:
+                if self.stopped:
+                    return
+                self.results[height] = result
+                self.ready.notify_all()
+
+    def fetch(self, rpc, height):
+        return fetch_block(rpc, height, batch_size=self.batch_size)
@@ -0,0 +1,139 @@
+import socket
+import threading
+
+from sys import version_info
+from time import sleep, time
+
+from logger import log_event
+
+
+if version_info[0] > 2:
+    import http.client as httplib
+    import queue
+else:
+    import httplib
+    import Queue as queue
+
+
+# Transport failures: the connection is dropped and the call retried. Errors
+# returned by the daemon itself are raised right away.
+CONNECTION_ERRORS = (socket.error, httplib.HTTPException, IOError)
+
+# Upper bounds of the latency histogram buckets, in msec
+LATENCY_BUCKETS = [ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000 ]
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self.counts = [ 0 ] * (len(LATENCY_BUCKETS) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def add(self, elapsed, failed=False):
+        msec = elapsed * 1000
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and msec > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.calls += 1
+        self.total_time += elapsed
+        if failed:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        threshold = self.calls * fraction
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return '<=%d msec' % LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else '>%d msec' % LATENCY_BUCKETS[-1]
+        return None
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg': '%.1f msec' % (self.total_time * 1000 / max(self.calls, 1)),
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99)
+        }
+
+
+class RpcClient(object):
+    # Pool of persistent (keep-alive) daemon connections, shared between
+    # threads. Connections are not checked before use, a connection is only
+    # replaced once a call over it actually failed.
+    def __init__(self, factory, connections=4, retries=3, backoff=0.5):
+        self.factory = factory
+        self.retries = retries
+        self.backoff = backoff
+
+        self.idle = queue.LifoQueue()
+        self.slots = threading.Semaphore(connections)
+
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.factory()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, connection):
+        if connection is not None:
+            self.idle.put(connection)
+        self.slots.release()
+
+    def call(self, method, *args):
+        attempt = 0
+        while True:
+            connection = self.acquire()
+            start_time = time()
+            try:
+                result = getattr(connection, method)(*args)
+            except CONNECTION_ERRORS as e:
+                self.record(method, time() - start_time, failed=True)
+                self.release(None)
+
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log_event('Retry', 'rpc', method, {'attempt': attempt, 'reason': type(e).__name__})
+                sleep(self.backoff * (2 ** (attempt - 1)))
+                continue
+            except Exception:
+                self.record(method, time() - start_time, failed=True)
+                self.release(connection)
+                raise
+
+            self.record(method, time() - start_time)
+            self.release(connection)
+            return result
+
+    def record(self, method, elapsed, failed=False):
+        with self.lock:
+            if method not in self.histograms:
+                self.histograms[method] = LatencyHistogram()
+            self.histograms[method].add(elapsed, failed=failed)
+
+    def stats(self):
+        with self.lock:
+            return dict([ (method, histogram.stats()) for method, histogram in self.histograms.items() ])
+
+    def log_stats(self):
+        for method, stats in sorted(self.stats().items()):
+            log_event('Stats', 'rpc', method, stats)
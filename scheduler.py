@@ -0,0 +1,153 @@
+from time import sleep, time
+
+from logger import log_event
+
+
+class Task(object):
+    def __init__(self, name, operation, priority, budget=None, max_backoff=0):
+        self.name = name
+        self.operation = operation
+        self.priority = priority
+
+        # Tasks without a budget are ingestion: they run once on every pass.
+        # Tasks with a budget are housekeeping, repeated for at most that
+        # many seconds as long as no ingestion work is waiting.
+        self.budget = budget
+
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self.next_run = 0
+
+        self.runs = 0
+        self.busy_runs = 0
+        self.slices = 0
+        self.preempted = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def due(self, now):
+        return now >= self.next_run
+
+    def run(self, min_backoff):
+        start_time = time()
+        busy = bool(self.operation())
+        elapsed = time() - start_time
+
+        self.runs += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+        # Idle tasks are polled less and less often, up to max_backoff
+        if busy:
+            self.busy_runs += 1
+            self.backoff = 0
+        else:
+            self.backoff = min(max(self.backoff * 2, min_backoff), self.max_backoff)
+        self.next_run = time() + self.backoff
+        return busy
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'busy': self.busy_runs,
+            'slices': self.slices,
+            'preempted': self.preempted,
+            'total': '%.1f sec' % self.total_time,
+            'avg': '%d msec' % int(self.total_time * 1000 / max(self.runs, 1)),
+            'max': '%d msec' % int(self.max_time * 1000),
+            'backoff': '%.2f sec' % self.backoff
+        }
+
+
+class Scheduler(object):
+    def __init__(self, wait=sleep, preempt=None, idle_wait_min=0.05, idle_wait_max=1.0, stats_interval=300):
+        self.tasks = []
+        self.wait = wait
+
+        # Without a preempt callback (no push notifications) the daemon has to
+        # be polled, housekeeping then yields at the idle_wait_max poll interval.
+        self.preempt = preempt
+        self.idle_wait_min = idle_wait_min
+        self.idle_wait_max = idle_wait_max
+        self.next_poll = 0
+
+        self.stats_interval = stats_interval
+        self.next_stats = time() + stats_interval
+        self.reporters = []
+
+    def add(self, name, operation, priority, budget=None, max_backoff=0):
+        self.tasks.append(Task(name, operation, priority, budget=budget, max_backoff=max_backoff))
+        self.tasks.sort(key=lambda task: task.priority)
+
+    def ingestion_due(self):
+        if self.preempt is not None:
+            return self.preempt()
+        return time() >= self.next_poll
+
+    def run_pass(self):
+        self.next_poll = time() + self.idle_wait_max
+
+        for task in self.tasks:
+            if task.budget is None:
+                if task.run(self.idle_wait_min):
+                    return True
+                continue
+
+            if task.due(time()) and self.run_slice(task):
+                return True
+        return False
+
+    def run_slice(self, task):
+        if not task.run(self.idle_wait_min):
+            return False
+
+        task.slices += 1
+        deadline = time() + task.budget
+        while time() < deadline:
+            if self.ingestion_due():
+                task.preempted += 1
+                break
+            if not task.run(self.idle_wait_min):
+                break
+        return True
+
+    def idle_time(self, idle_wait):
+        now = time()
+        next_run = min([ task.next_run for task in self.tasks if task.budget is not None ] or [ now + idle_wait ])
+        return max(min(idle_wait, next_run - now), 0)
+
+    def stats(self):
+        return dict([ (task.name, task.stats()) for task in self.tasks ])
+
+    def log_stats(self):
+        for task in self.tasks:
+            log_event('Stats', 'sch', task.name, task.stats())
+        for reporter in self.reporters:
+            reporter()
+
+    def run(self, before_sleep=None, after_first_run=None):
+        idle_wait = self.idle_wait_min
+        working = False
+        first_run = True
+
+        while True:
+            if time() >= self.next_stats:
+                self.log_stats()
+                self.next_stats = time() + self.stats_interval
+
+            if self.run_pass():
+                working = True
+                idle_wait = self.idle_wait_min
+                continue
+
+            if working and before_sleep is not None:
+                before_sleep()
+            working = False
+
+            if first_run:
+                if after_first_run is not None:
+                    after_first_run()
+                first_run = False
+
+            self.wait(self.idle_time(idle_wait))
+            idle_wait = min(idle_wait * 2, self.idle_wait_max)
@@ -0,0 +1,15 @@
+import sys
+import types
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Deployments copy config.sample.py to config.py, fall back to the sample
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    with open(path.join(ROOT, 'config.sample.py')) as f:
+        exec(f.read(), config.__dict__)
+    sys.modules['config'] = config
@@ -0,0 +1,119 @@
+import unittest
+
+from binascii import hexlify
+from cachetools import LFUCache
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from backfill import Backfill
+from database import DatabaseSession
+from models import Block
+
+
+def blockhash(height, fork=False):
+    return bytes(bytearray([ height % 256, height // 256 ] + [ 0xf0 if fork else 0x0f ] * 30))
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.invalidated = False
+
+    def invalidate(self, commit=False):
+        self.invalidated = True
+
+
+class FakeDatabase(object):
+    def __init__(self, heights, fork_heights=()):
+        self.blocks = dict([ (height, blockhash(height, fork=height in fork_heights)) for height in heights ])
+        self.cache = FakeCache()
+
+    def reset_session(self):
+        pass
+
+    def block_hashes(self, heights=None, range=None):
+        return dict([ (height, self.blocks[height]) for height in heights if height in self.blocks ])
+
+
+class FakeRpc(object):
+    # Blocks on the fork have a parent on the fork
+    def __init__(self, db):
+        self.db = db
+
+    def getblockheader(self, hexhash):
+        height, known = [ (height, known) for height, known in self.db.blocks.items() if hexlify(known).decode('ascii') == hexhash ][0]
+        return {'previousblockhash': hexlify(blockhash(height - 1, fork=known != blockhash(height))).decode('ascii')}
+
+
+class FakeContext(object):
+    def __init__(self, db, rpc):
+        self.db = db
+        self.batch_rpc = rpc
+
+
+def backfill(db, rpc, ranges, chunk_size=10):
+    backfill = Backfill(FakeContext(db, rpc), ranges, chunk_size=chunk_size)
+    for chunk in backfill.chunks:
+        chunk.first_prevhash = blockhash(chunk.first_height - 1) if chunk.first_height > 0 else None
+        chunk.last_hash = blockhash(chunk.last_height)
+    return backfill
+
+
+class LinkTest(unittest.TestCase):
+    def test_links(self):
+        db = FakeDatabase(list(range(0, 10)) + list(range(30, 40)))
+        backfill(db, FakeRpc(db), [ (10, 29) ]).link()
+        self.assertTrue(db.cache.invalidated)
+
+    def test_open_ended(self):
+        db = FakeDatabase(range(0, 10))
+        backfill(db, FakeRpc(db), [ (10, 29) ]).link()
+        self.assertTrue(db.cache.invalidated)
+
+    def test_mismatch_below(self):
+        # The block below the range is from another chain than the chunk's parent
+        db = FakeDatabase(list(range(0, 10)) + list(range(30, 40)), fork_heights=[ 9 ])
+        self.assertRaises(Exception, backfill(db, FakeRpc(db), [ (10, 29) ]).link)
+        self.assertFalse(db.cache.invalidated)
+
+    def test_mismatch_above(self):
+        # The block above the range builds on another block than the chunk's last
+        db = FakeDatabase(list(range(0, 10)) + list(range(30, 40)), fork_heights=[ 30 ])
+        self.assertRaises(Exception, backfill(db, FakeRpc(db), [ (10, 29) ]).link)
+        self.assertFalse(db.cache.invalidated)
+
+
+class MissingBlockRangesTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Block.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.db = DatabaseSession(self.session, address_cache=LFUCache(maxsize=16), txid_cache=None)
+
+    def add_blocks(self, heights):
+        for height in heights:
+            self.session.execute('INSERT INTO `block` (`id`, `hash`, `height`) VALUES (:id, :hash, :height);', {
+                'id': height + 1,
+                'hash': blockhash(height),
+                'height': height
+            })
+
+    def test_gaps(self):
+        self.add_blocks([ 0, 5, 6, 10 ])
+        self.assertEqual(self.db.missing_block_ranges(12), [ (1, 4), (7, 9), (11, 12) ])
+
+    def test_capped_at_max_height(self):
+        self.add_blocks([ 0, 5, 6, 10 ])
+        self.assertEqual(self.db.missing_block_ranges(8), [ (1, 4), (7, 8) ])
+
+    def test_without_genesis(self):
+        self.add_blocks([ 5, 6 ])
+        self.assertEqual(self.db.missing_block_ranges(6), [ (1, 4) ])
+
+    def test_complete(self):
+        self.add_blocks(range(0, 11))
+        self.assertEqual(self.db.missing_block_ranges(10), [])
+
+    def test_orphaned_blocks_are_ignored(self):
+        self.add_blocks([ 0, 1, 2 ])
+        self.session.execute('INSERT INTO `block` (`id`, `hash`, `height`) VALUES (100, :hash, NULL);', {'hash': b'\xee' * 32})
+        self.assertEqual(self.db.missing_block_ranges(4), [ (3, 4) ])
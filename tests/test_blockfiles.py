@@ -0,0 +1,155 @@
+import unittest
+
+from binascii import hexlify, unhexlify
+from os import path
+
+from blockfiles import BlockFileImporter, BlockFileIndex, BlockParser, _ripemd160, bits_to_work, classify_script, hash160, hexstr
+
+
+# blk00000.dat holds, in file order: the bitcoin genesis block, fork block b1,
+# a1, a zero/garbage gap, an orphan with an unknown parent, b2, a2, a
+# duplicate of a1, b3 and trailing zero padding. Chain a (genesis, a1, a2)
+# uses the genesis nBits, fork b (b1, b2, b3) is longer but has regtest
+# difficulty.
+FIXTURE_DIR = path.join(path.dirname(path.abspath(__file__)), 'blockfiles')
+
+GENESIS_HASH = '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
+GENESIS_TXID = '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+GENESIS_PUBKEY = unhexlify('04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f')
+A1_HASH = '8d6ebb65755f6d9c54b2ec53e89855e833061ad0ebe9c10d23c429ef111ca8fe'
+A2_HASH = 'bf778cf6ba72202ebe7c9212627d1d4b1bea5332b44e4f643beca418b873da04'
+A2_SPEND_TXID = 'dcb5c6c18a3c1d7af5b4206ab0a7e6863410ff029f9f666a4ba595a112b4b723'
+A2_SEGWIT_TXID = 'b57d89c53ce57e2b750aa73bf12acee3701592ad53a2332c1a95ee421773eefa'
+
+
+class Parser(BlockParser):
+    def encode_destination(self, kind, hash):
+        return '%s:%s' % (kind, hexstr(hash))
+
+
+class FakeDaemon(object):
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def getblockhash(self, height):
+        return self.hashes[height]
+
+
+class FakeDatabase(object):
+    coin = {}
+
+    def __init__(self):
+        self.imported = []
+
+    def chaintip(self):
+        return None
+
+    def import_blockinfo(self, blockinfo, tx_resolver=None, commit=True):
+        self.imported.append(blockinfo['hash'])
+
+
+class HashTest(unittest.TestCase):
+    def test_ripemd160_vectors(self):
+        vectors = [
+            (b'', '9c1185a5c5e9fc54612808977ee8f548b2258d31'),
+            (b'a', '0bdc9d2d256b3ee9daae347be6f4dc835a467ffe'),
+            (b'abc', '8eb208f7e05d987a9b044a8e98c6b087f15a0bfc'),
+            (b'message digest', '5d0689ef49d2fae572b881b123a85ffa21595f36'),
+            (b'1234567890' * 8, '9b752e45573d4b39f4dbd3323cab82bf63326bfb'),
+        ]
+        for data, digest in vectors:
+            self.assertEqual(hexstr(_ripemd160(data)), digest)
+
+    def test_hash160(self):
+        self.assertEqual(hexstr(hash160(GENESIS_PUBKEY)), '62e907b15cbf27d5425399ebf6f0fb50ebb88f18')
+
+    def test_bits_to_work(self):
+        self.assertEqual(bits_to_work(0x1d00ffff), 0x100010001)
+        self.assertEqual(bits_to_work(0x207fffff), 2)
+        self.assertEqual(bits_to_work(0x1d800000), 0)
+
+
+class ClassifyScriptTest(unittest.TestCase):
+    def classify(self, script):
+        return classify_script(bytearray(unhexlify(script)))
+
+    def test_standard_types(self):
+        self.assertEqual(self.classify('76a914' + '11' * 20 + '88ac'), ('pubkeyhash', [ ('p2pkh', bytearray(b'\x11' * 20)) ]))
+        self.assertEqual(self.classify('a914' + '33' * 20 + '87'), ('scripthash', [ ('p2sh', bytearray(b'\x33' * 20)) ]))
+        self.assertEqual(self.classify('0014' + '22' * 20), ('witness_v0_keyhash', [ ('witness', bytearray(b'\x22' * 20)) ]))
+        self.assertEqual(self.classify('0020' + '44' * 32), ('witness_v0_scripthash', [ ('witness', bytearray(b'\x44' * 32)) ]))
+        self.assertEqual(self.classify('5120' + '55' * 32), ('witness_unknown', []))
+        self.assertEqual(self.classify('6a04deadbeef'), ('nulldata', []))
+
+    def test_pubkey(self):
+        script_type, destinations = self.classify('41' + hexstr(GENESIS_PUBKEY) + 'ac')
+        self.assertEqual(script_type, 'pubkey')
+        self.assertEqual(hexstr(destinations[0][1]), '62e907b15cbf27d5425399ebf6f0fb50ebb88f18')
+
+    def test_multisig(self):
+        pubkey = '21' + '02' + '66' * 32
+        script_type, destinations = self.classify('51' + pubkey + pubkey + '52ae')
+        self.assertEqual(script_type, 'multisig')
+        self.assertEqual(len(destinations), 2)
+
+    def test_nonstandard(self):
+        self.assertEqual(self.classify('4c'), ('nonstandard', []))
+        self.assertEqual(self.classify('05aabb'), ('nonstandard', []))
+        self.assertEqual(self.classify('76a914' + '11' * 20 + '88'), ('nonstandard', []))
+
+
+class BlockFileIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = BlockFileIndex(FIXTURE_DIR)
+        self.index.scan()
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_scan_skips_gaps_and_duplicates(self):
+        self.assertEqual(len(self.index.offsets), 7)
+
+    def test_build_chain_follows_chainwork(self):
+        self.assertEqual(self.index.height, 2)
+        self.assertEqual([ hexstr(self.index.blockhash(height)) for height in range(3) ], [ GENESIS_HASH, A1_HASH, A2_HASH ])
+
+    def test_parse_genesis(self):
+        blockinfo, transactions = Parser({}).parse_block(self.index.read_block(0), 0)
+        self.assertEqual(blockinfo['hash'], GENESIS_HASH)
+        self.assertEqual(blockinfo['previousblockhash'], '00' * 32)
+        self.assertEqual(blockinfo['time'], 1231006505)
+        self.assertEqual(blockinfo['difficulty'], 1.0)
+        self.assertEqual(blockinfo['tx'], [ GENESIS_TXID ])
+
+        tx = transactions[GENESIS_TXID]
+        self.assertEqual(tx['size'], 204)
+        self.assertIn('coinbase', tx['vin'][0])
+        self.assertEqual(str(tx['vout'][0]['value']), '50')
+        self.assertEqual(tx['vout'][0]['scriptPubKey']['type'], 'pubkey')
+        self.assertEqual(tx['vout'][0]['scriptPubKey']['addresses'], [ 'p2pkh:62e907b15cbf27d5425399ebf6f0fb50ebb88f18' ])
+
+    def test_parse_spends(self):
+        blockinfo, transactions = Parser({}).parse_block(self.index.read_block(2), 2)
+        self.assertEqual(blockinfo['previousblockhash'], A1_HASH)
+        self.assertEqual(blockinfo['tx'][1:], [ A2_SPEND_TXID, A2_SEGWIT_TXID ])
+
+        segwit = transactions[A2_SEGWIT_TXID]
+        self.assertEqual(segwit['vin'], [ {'txid': A2_SPEND_TXID, 'vout': 0, 'sequence': 0xffffffff} ])
+        self.assertEqual(segwit['vout'][0]['scriptPubKey']['type'], 'scripthash')
+        self.assertEqual(segwit['vout'][0]['scriptPubKey']['addresses'], [ 'p2sh:' + '33' * 20 ])
+        self.assertEqual(segwit['size'], 93)
+
+
+class BlockFileImporterTest(unittest.TestCase):
+    def test_imports_up_to_tip_distance(self):
+        db = FakeDatabase()
+        importer = BlockFileImporter(db, FIXTURE_DIR, tip_distance=1, daemon=FakeDaemon([ GENESIS_HASH, A1_HASH ]))
+        importer.parser = Parser({})
+        importer.run()
+        self.assertEqual(db.imported, [ GENESIS_HASH, A1_HASH ])
+
+    def test_aborts_on_daemon_mismatch(self):
+        db = FakeDatabase()
+        importer = BlockFileImporter(db, FIXTURE_DIR, tip_distance=1, daemon=FakeDaemon([ GENESIS_HASH, 'ff' * 32 ]))
+        self.assertRaises(Exception, importer.run)
+        self.assertEqual(db.imported, [])
@@ -0,0 +1,136 @@
+import unittest
+
+from decimal import Decimal
+
+from bulkload import ID_TABLES, STAGING_TABLE, BlockRows, BulkLoader
+from models import Address, Block, BlockTransaction, CoinbaseInfo, Transaction, TransactionOutput
+
+
+def txid(n):
+    return '%064x' % n
+
+
+def output(n, value, address=None, data=None):
+    if address is not None:
+        script = {'asm': 'OP_DUP OP_HASH160 %s OP_EQUALVERIFY OP_CHECKSIG' % address, 'type': 'pubkeyhash', 'addresses': [ address ]}
+    else:
+        script = {'asm': 'OP_RETURN %s' % data, 'type': 'nulldata'}
+    return {'n': n, 'value': Decimal(value), 'scriptPubKey': script}
+
+
+def block(height, transactions):
+    blockinfo = {
+        'height': height,
+        'hash': '%064x' % (0xb10c0000 + height),
+        'tx': [ tx['txid'] for tx in transactions ],
+        'size': 1000,
+        'time': 1500000000 + height,
+        'difficulty': 1.0
+    }
+    return blockinfo, { tx['txid']: tx for tx in transactions }
+
+
+def coinbase(n, address):
+    return {'txid': txid(n), 'size': 100, 'vin': [ {'coinbase': '0102'} ], 'vout': [ output(0, '50', address=address) ]}
+
+
+def spend(n, prevouts, outputs):
+    return {'txid': txid(n), 'size': 200, 'vin': [ {'txid': txid(prev), 'vout': vout} for prev, vout in prevouts ], 'vout': outputs}
+
+
+# Addresses are reused within and across the chunks
+BLOCKS = [
+    block(0, []),
+    block(1, [ coinbase(1, 'addrA') ]),
+    block(2, [ coinbase(2, 'addrB'), spend(3, [ (1, 0) ], [ output(0, '20', address='addrA'), output(1, '30', address='addrC') ]) ]),
+    block(3, [ coinbase(4, 'addrD'), spend(5, [ (3, 0), (3, 1) ], [ output(0, '49', address='addrB'), output(1, '0', data='cafe') ]) ]),
+    block(4, [ coinbase(6, 'addrC'), spend(7, [ (2, 0) ], [ output(0, '50', address='addrE'), output(1, '0', data='beef') ]) ])
+]
+
+
+class FakeDatabase(object):
+    session = None
+
+
+class FakeContext(object):
+    db = FakeDatabase()
+
+
+def load_chunk(blocks):
+    rows = BlockRows()
+    for blockinfo, transactions in blocks:
+        rows.load_block(blockinfo, transactions)
+    return blocks[0][0]['height'], blocks[-1][0]['height'], blocks[-1][0]['hash'], rows.rows, rows.next_ids, rows.blocks_loaded, rows.txs_loaded
+
+
+class TakeChunkTest(unittest.TestCase):
+    def loader(self, next_ids=None, addresses=None):
+        loader = BulkLoader(FakeContext(), insert_rows=1000000)
+        loader.next_ids = dict(next_ids if next_ids is not None else [ (table, 0) for table in ID_TABLES ])
+        loader.addresses = dict(addresses or {})
+        return loader
+
+    def sequential(self, next_ids=None, addresses=None):
+        rows = BlockRows(next_ids=dict(next_ids if next_ids is not None else [ (table, 0) for table in ID_TABLES ]), addresses=dict(addresses or {}))
+        for blockinfo, transactions in BLOCKS:
+            rows.load_block(blockinfo, transactions)
+        return rows
+
+    def assertSameRows(self, loader, rows):
+        self.assertEqual(sorted(loader.rows.keys()), sorted(rows.rows.keys()))
+        for table in rows.rows.keys():
+            key = lambda row: (row.get('id'), row.get('block'))
+            self.assertEqual(sorted(loader.rows[table], key=key), sorted(rows.rows[table], key=key), table)
+        self.assertEqual(loader.next_ids, rows.next_ids)
+        self.assertEqual(loader.addresses, rows.addresses)
+
+    def test_chunks_match_sequential_load(self):
+        loader = self.loader()
+        for chunk in [ BLOCKS[:3], BLOCKS[3:4], BLOCKS[4:] ]:
+            loader.take_chunk(load_chunk(chunk), 0, 0)
+
+        self.assertSameRows(loader, self.sequential())
+        self.assertEqual(loader.blocks_loaded, 5)
+        self.assertEqual(loader.txs_loaded, 7)
+
+    def test_resume_on_top_of_existing_rows(self):
+        next_ids = dict([ (table, 1000 * (n + 1)) for n, table in enumerate(ID_TABLES) ])
+        addresses = {'addrA': 7, 'addrD': 8}
+
+        loader = self.loader(next_ids=next_ids, addresses=addresses)
+        for chunk in [ BLOCKS[1:3], BLOCKS[3:] ]:
+            loader.take_chunk(load_chunk(chunk), 0, 0)
+
+        rows = BlockRows(next_ids=dict(next_ids), addresses=dict(addresses))
+        for blockinfo, transactions in BLOCKS[1:]:
+            rows.load_block(blockinfo, transactions)
+        self.assertSameRows(loader, rows)
+
+        # Known addresses are referenced, not inserted again
+        self.assertNotIn('addrA', [ row['address'] for row in loader.rows[Address.__tablename__] ])
+        outputs = dict([ ((row['transaction'], row['index']), row['address']) for row in loader.rows[TransactionOutput.__tablename__] ])
+        tx_ids = dict([ (row['txid'], row['id']) for row in loader.rows[Transaction.__tablename__] ])
+        self.assertEqual(outputs[(tx_ids[bytes(bytearray([0] * 31 + [1]))], 0)], 7)
+
+    def test_genesis_keeps_id_zero(self):
+        loader = self.loader()
+        loader.take_chunk(load_chunk(BLOCKS[:1]), 0, 0)
+        loader.take_chunk(load_chunk(BLOCKS[1:2]), 0, 0)
+        self.assertEqual(sorted([ row['id'] for row in loader.rows[Block.__tablename__] ]), [ 0, 1 ])
+
+    def test_references_are_rebased(self):
+        loader = self.loader()
+        loader.take_chunk(load_chunk(BLOCKS[:3]), 0, 0)
+        loader.take_chunk(load_chunk(BLOCKS[3:]), 0, 0)
+
+        blocks = dict([ (row['id'], row['height']) for row in loader.rows[Block.__tablename__] ])
+        blocktxs = dict([ (row['id'], row) for row in loader.rows[BlockTransaction.__tablename__] ])
+        txs = dict([ (row['id'], row) for row in loader.rows[Transaction.__tablename__] ])
+        for tx in txs.values():
+            self.assertEqual(blocktxs[tx['confirmation']]['transaction'], tx['id'])
+        for coinbase_row in loader.rows[CoinbaseInfo.__tablename__]:
+            self.assertIn(coinbase_row['block'], blocks)
+            self.assertIn(coinbase_row['transaction'], txs)
+        for txin in loader.rows[STAGING_TABLE]:
+            self.assertIn(txin['transaction'], txs)
+        self.assertEqual(sorted([ row['id'] for row in loader.rows[STAGING_TABLE] ]), [ 1, 2, 3, 4 ])
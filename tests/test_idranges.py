@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+from idranges import IdRanges
+
+
+class FakeSequence(object):
+    # Stands in for the `idsequence` table shared by all processes
+    def __init__(self, max_ids=None):
+        self.lock = threading.Lock()
+        self.next_ids = dict(max_ids or {})
+        self.fetches = []
+
+
+class SequenceIdRanges(IdRanges):
+    def __init__(self, sequence, reserve=1000):
+        super(SequenceIdRanges, self).__init__(None, reserve=reserve)
+        self.sequence = sequence
+
+    def fetch(self, table, count):
+        with self.sequence.lock:
+            next_id = self.sequence.next_ids.get(table, 1)
+            self.sequence.next_ids[table] = next_id + count
+            self.sequence.fetches.append((table, count))
+        return next_id, next_id + count
+
+
+class IdRangesTest(unittest.TestCase):
+    def test_consecutive(self):
+        sequence = FakeSequence({'txout': 101})
+        ranges = SequenceIdRanges(sequence, reserve=10)
+        self.assertEqual(ranges.allocate('txout', 3), 101)
+        self.assertEqual(ranges.allocate('txout'), 104)
+        self.assertEqual(ranges.allocate('txout', 6), 105)
+        self.assertEqual(sequence.fetches, [ ('txout', 10) ])
+
+        # Not enough left in the reserved range, the rest of it is skipped
+        self.assertEqual(ranges.allocate('txout', 2), 111)
+        self.assertEqual(sequence.fetches, [ ('txout', 10), ('txout', 10) ])
+
+    def test_large_allocation(self):
+        sequence = FakeSequence()
+        ranges = SequenceIdRanges(sequence, reserve=10)
+        self.assertEqual(ranges.allocate('txin', 25), 1)
+        self.assertEqual(ranges.allocate('txin'), 26)
+        self.assertEqual(sequence.fetches, [ ('txin', 25), ('txin', 10) ])
+
+    def test_tables_are_separate(self):
+        ranges = SequenceIdRanges(FakeSequence(), reserve=10)
+        self.assertEqual(ranges.allocate('transaction'), 1)
+        self.assertEqual(ranges.allocate('address'), 1)
+        self.assertEqual(ranges.allocate('transaction'), 2)
+
+    def test_concurrent_allocations_do_not_overlap(self):
+        sequence = FakeSequence()
+        # Two processes, each with threads allocating from their own ranges
+        processes = [ SequenceIdRanges(sequence, reserve=7), SequenceIdRanges(sequence, reserve=7) ]
+        allocated = []
+        allocated_lock = threading.Lock()
+
+        def worker(ranges, count):
+            ids = []
+            for _ in range(200):
+                first_id = ranges.allocate('txout', count)
+                ids.extend(range(first_id, first_id + count))
+            with allocated_lock:
+                allocated.extend(ids)
+
+        threads = [ threading.Thread(target=worker, args=(processes[n % 2], n % 3 + 1)) for n in range(6) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(allocated), 200 * (1 + 2 + 3) * 2)
+        self.assertEqual(len(set(allocated)), len(allocated))
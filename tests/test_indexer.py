@@ -0,0 +1,147 @@
+import unittest
+
+from binascii import hexlify
+
+from indexer import Context
+
+
+def blockhash(height, fork=None):
+    return (b'%08d' % height) + (b'fork' if fork is not None and height > fork else b'main') + b'\0' * 20
+
+
+class FakeDaemon(object):
+    def __init__(self, height):
+        self.height = height
+        self.calls = []
+
+    def get_current_height(self):
+        return self.height
+
+    def getblockhash(self, height):
+        self.calls.append(height)
+        return hexlify(blockhash(height)).decode('ascii')
+
+
+class FakeBlock(object):
+    def __init__(self, height):
+        self.height = height
+
+
+class FakeDatabase(object):
+    def __init__(self, heights, fork=None):
+        self.blocks = { height: blockhash(height, fork) for height in heights }
+
+    def chaintip(self):
+        return FakeBlock(max(self.blocks.keys())) if len(self.blocks) > 0 else None
+
+    def highest_block_hash(self, max_height):
+        heights = [ height for height in self.blocks.keys() if height <= max_height ]
+        return (max(heights), self.blocks[max(heights)]) if len(heights) > 0 else None
+
+    def block_hashes(self, heights=None, range=None):
+        return { height: blockhash for height, blockhash in self.blocks.items() if range[0] <= height < range[1] }
+
+
+class FakeContext(object):
+    def __init__(self, db, daemon):
+        self.db = db
+        self.rpc = daemon
+
+    def daemon(self):
+        return self.rpc
+
+
+def find_common_ancestor(heights, chain_height, fork=None):
+    context = FakeContext(FakeDatabase(heights, fork=fork), FakeDaemon(chain_height))
+    return Context.__dict__['find_common_ancestor'](context)
+
+
+class FindCommonAncestorTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(find_common_ancestor([], 10), (-1, -1, 10))
+
+    def test_in_sync(self):
+        self.assertEqual(find_common_ancestor(range(0, 301), 310), (300, 300, 310))
+
+    def test_fork(self):
+        self.assertEqual(find_common_ancestor(range(0, 301), 310, fork=150), (150, 300, 310))
+        self.assertEqual(find_common_ancestor(range(0, 301), 310, fork=299), (299, 300, 310))
+        self.assertEqual(find_common_ancestor(range(0, 301), 310, fork=0), (0, 300, 310))
+
+    def test_gap_without_fork(self):
+        heights = list(range(0, 101)) + list(range(201, 301))
+        self.assertEqual(find_common_ancestor(heights, 310), (300, 300, 310))
+
+    def test_fork_above_gap(self):
+        heights = list(range(0, 101)) + list(range(201, 301))
+        self.assertEqual(find_common_ancestor(heights, 310, fork=250), (250, 300, 310))
+
+    def test_fork_below_gap(self):
+        # Every indexed block above the gap is on the fork, the last common
+        # indexed block is below the gap
+        heights = list(range(0, 101)) + list(range(201, 301))
+        self.assertEqual(find_common_ancestor(heights, 310, fork=150), (100, 300, 310))
+
+    def test_daemon_behind(self):
+        self.assertEqual(find_common_ancestor(range(0, 301), 280), (280, 300, 280))
+
+
+class FakeVerifyDatabase(object):
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.calls = []
+        self.session = self
+
+    def verification_checkpoint(self):
+        return self.checkpoint
+
+    def set_verification_checkpoint(self, clean):
+        self.calls.append(('checkpoint', clean))
+
+    def remove_blocks_without_coinbase(self, since_block_id):
+        self.calls.append(('coinbase', since_block_id))
+
+    def verify_confirmed_transactions_state(self, since_block_id):
+        self.calls.append(('confirmed', since_block_id))
+
+    def verify_unconfirmed_transactions_state(self, since_block_id):
+        self.calls.append(('unconfirmed', since_block_id))
+
+    def commit(self):
+        self.calls.append(('commit', None))
+
+
+def verify_state(checkpoint, full=False):
+    context = FakeContext(FakeVerifyDatabase(checkpoint), None)
+    context.verified = False
+    Context.__dict__['verify_state'](context, full=full)
+    return context
+
+
+class VerifyStateTest(unittest.TestCase):
+    def expected_calls(self, since_block_id):
+        return [
+            ('coinbase', since_block_id),
+            ('confirmed', since_block_id),
+            ('unconfirmed', since_block_id),
+            ('commit', None),
+            ('checkpoint', False)
+        ]
+
+    def test_since_checkpoint(self):
+        context = verify_state((1234, True))
+        self.assertEqual(context.db.calls, self.expected_calls(1234))
+        self.assertTrue(context.verified)
+
+    def test_since_unclean_checkpoint(self):
+        # Blocks before the checkpoint were verified on the previous startup
+        context = verify_state((1234, False))
+        self.assertEqual(context.db.calls, self.expected_calls(1234))
+
+    def test_without_checkpoint(self):
+        context = verify_state((None, False))
+        self.assertEqual(context.db.calls, self.expected_calls(-1))
+
+    def test_full(self):
+        context = verify_state((1234, True), full=True)
+        self.assertEqual(context.db.calls, self.expected_calls(-1))
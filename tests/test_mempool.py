@@ -0,0 +1,209 @@
+import threading
+import unittest
+
+from time import sleep
+
+from mempool import ImportLock, MempoolWorker
+
+
+class FakeDaemon(object):
+    def __init__(self, mempool, height):
+        self.mempool = mempool
+        self.height = height
+
+    def getrawmempool(self):
+        return list(self.mempool)
+
+    def get_current_height(self):
+        return self.height
+
+
+class FakeDatabase(object):
+    def __init__(self, mempool, height):
+        self.mempool = set(mempool)
+        self.height = height
+        self.evicted = set()
+        self.imported = []
+        self.batches = []
+        self.lookups = 0
+        self.session = self
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def new_session(self, shared_caches=True):
+        return self
+
+    def reset_session(self):
+        pass
+
+    def mempool_txids(self):
+        return set(self.mempool)
+
+    def committed_chaintip_height(self):
+        return self.height
+
+    def transaction_internal_ids(self, txids):
+        self.lookups += 1
+        return dict([ (txid, 1) for txid in txids if txid in self.mempool or txid in self.imported ])
+
+    def import_transactions(self, transactions):
+        self.imported += [ txid for txid, txinfo in transactions ]
+        self.batches.append([ txid for txid, txinfo in transactions ])
+
+    def set_evicted(self, txids, evicted=True):
+        if evicted:
+            self.evicted.update(txids)
+        else:
+            self.evicted.difference_update(txids)
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.resets = 0
+
+    def reset_session(self):
+        self.resets += 1
+
+
+def wait_for(condition):
+    while not condition():
+        sleep(0.001)
+
+
+def wait_for_waiters(lock, count):
+    while True:
+        with lock.condition:
+            if lock.next_ticket - lock.serving > count:
+                return
+        sleep(0.001)
+
+
+class ImportLockTest(unittest.TestCase):
+    def test_first_come_first_served(self):
+        lock = ImportLock()
+        db = FakeSession()
+        order = []
+
+        def worker(name):
+            with lock.hold(db):
+                order.append(name)
+
+        lock.acquire(db)
+        threads = []
+        for name in range(5):
+            thread = threading.Thread(target=worker, args=(name,))
+            thread.start()
+            threads.append(thread)
+            wait_for_waiters(lock, name + 1)
+        lock.release()
+
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, list(range(5)))
+        self.assertEqual(db.resets, 6)
+
+    def test_yield_to_waiters(self):
+        lock = ImportLock()
+        db = FakeSession()
+        order = []
+
+        def worker():
+            with lock.hold(db):
+                order.append('worker')
+
+        lock.acquire(db)
+        lock.yield_to_waiters(db)
+        self.assertFalse(lock.waiting())
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        wait_for_waiters(lock, 1)
+        self.assertTrue(lock.waiting())
+
+        order.append('importer')
+        lock.yield_to_waiters(db)
+        order.append('importer')
+        lock.release()
+        thread.join()
+        self.assertEqual(order, [ 'importer', 'worker', 'importer' ])
+
+    def test_hold_rolls_back_on_error(self):
+        lock = ImportLock()
+        db = FakeSession()
+
+        def failing():
+            with lock.hold(db):
+                raise ValueError()
+        self.assertRaises(ValueError, failing)
+        self.assertEqual(db.resets, 2)
+
+        # Released, the next holder gets in
+        with lock.hold(db):
+            pass
+        self.assertEqual(db.resets, 3)
+
+
+class FakeContext(object):
+    notifications = None
+    transactions = {}
+
+    def __init__(self, db, daemon):
+        self.db = db
+        self.rpc = daemon
+
+    def daemon(self):
+        return self.rpc
+
+    def get_transactions(self, txids):
+        return { txid: self.transactions.get(txid, {'txid': txid, 'vin': [ {'coinbase': ''} ]}) for txid in txids }
+
+
+class MempoolWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDatabase([ 'a', 'b', 'c' ], 100)
+        self.daemon = FakeDaemon([ 'a', 'b', 'c' ], 100)
+        self.worker = MempoolWorker(FakeContext(self.db, self.daemon), ImportLock(), None)
+
+    def test_imports_and_evicts(self):
+        self.daemon.mempool = [ 'a', 'd' ]
+        self.worker.step()
+        self.assertEqual(self.db.imported, [ 'd' ])
+        self.assertEqual(self.db.evicted, set([ 'b', 'c' ]))
+        self.assertEqual(self.worker.mempool_txids, set([ 'a', 'd' ]))
+
+    def test_imports_in_one_batch(self):
+        # e spends d, f spends an output of a block that is not imported yet
+        self.daemon.mempool = [ 'a', 'b', 'c', 'e', 'd', 'f' ]
+        self.worker.context.transactions = {
+            'd': {'txid': 'd', 'vin': [ {'txid': 'a', 'vout': 0} ]},
+            'e': {'txid': 'e', 'vin': [ {'txid': 'd', 'vout': 0}, {'txid': 'b', 'vout': 1} ]},
+            'f': {'txid': 'f', 'vin': [ {'txid': 'x', 'vout': 0} ]}
+        }
+        self.worker.step()
+        self.assertEqual(self.db.batches, [ [ 'd', 'e' ] ])
+        self.assertEqual(self.db.commits, 1)
+        self.assertEqual(self.db.lookups, 2)
+        self.assertEqual(list(self.worker.deferred.keys()), [ 'f' ])
+
+    def test_stop_waits_for_worker(self):
+        self.worker.interval = 3600
+        self.worker.start()
+        wait_for(lambda: self.worker.mempool_txids is not None)
+        self.worker.stop()
+        self.assertFalse(self.worker.thread.is_alive())
+
+    def test_no_eviction_while_catching_up(self):
+        # b and c were mined in a block the indexer has not imported yet
+        self.daemon.mempool = [ 'a' ]
+        self.daemon.height = 101
+        self.worker.step()
+        self.assertEqual(self.db.evicted, set())
+        self.assertEqual(self.worker.mempool_txids, set([ 'a', 'b', 'c' ]))
+
+        # Once caught up whatever is still unconfirmed gets evicted
+        self.db.height = 101
+        self.worker.step()
+        self.assertEqual(self.db.evicted, set([ 'b', 'c' ]))
+        self.assertEqual(self.worker.mempool_txids, set([ 'a' ]))
@@ -0,0 +1,91 @@
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from migrations import Migration, MigrationRunner
+
+
+class MarkItems(Migration):
+    name = 'mark_items'
+    table = 'item'
+    batch_size = 10
+
+    def __init__(self, context):
+        super(MarkItems, self).__init__(context)
+        self.batches = []
+        self.fail_at = None
+
+    def run_batch(self, session, first_id, end_id):
+        self.batches.append((first_id, end_id))
+        changed = session.execute('UPDATE `item` SET `marked` = `marked` + 1 WHERE `id` >= :first_id AND `id` < :end_id;', {
+            'first_id': first_id,
+            'end_id': end_id
+        }).rowcount
+        if first_id == self.fail_at:
+            raise Exception('Interrupted')
+        return changed
+
+
+class FakeDatabase(object):
+    def __init__(self, session):
+        self.session = session
+
+
+class FakeContext(object):
+    def __init__(self, session):
+        self.db = FakeDatabase(session)
+
+
+class MigrationRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE `migration` (`name` VARCHAR(32) PRIMARY KEY, `lastid` BIGINT NOT NULL, `done` TINYINT NOT NULL);')
+        self.engine.execute('CREATE TABLE `item` (`id` INTEGER PRIMARY KEY, `marked` INTEGER NOT NULL);')
+        for item_id in range(25):
+            self.engine.execute('INSERT INTO `item` (`id`, `marked`) VALUES (%d, 0);' % item_id)
+
+    def runner(self):
+        return MigrationRunner(FakeContext(sessionmaker(bind=self.engine)()), migrations=[ MarkItems ])
+
+    def checkpoint(self):
+        return tuple(self.engine.execute('SELECT `lastid`, `done` FROM `migration` WHERE `name` = \'mark_items\';').first())
+
+    def marked(self):
+        return [ marked for (marked,) in self.engine.execute('SELECT `marked` FROM `item` ORDER BY `id`;') ]
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, Migration, None)
+
+    def test_runs_in_batches(self):
+        runner = self.runner()
+        while runner.step():
+            pass
+        self.assertEqual(runner.migrations[0].batches, [ (0, 10), (10, 20), (20, 25) ])
+        self.assertEqual(self.checkpoint(), (24, 1))
+        self.assertEqual(self.marked(), [ 1 ] * 25)
+
+    def test_resumes_from_checkpoint(self):
+        runner = self.runner()
+        runner.migrations[0].fail_at = 10
+        self.assertTrue(runner.step())
+        self.assertRaises(Exception, runner.step)
+        runner.context.db.session.rollback()
+        self.assertEqual(self.checkpoint(), (9, 0))
+
+        # A fresh runner continues after the last committed batch
+        runner = self.runner()
+        while runner.step():
+            pass
+        self.assertEqual(runner.migrations[0].batches, [ (10, 20), (20, 25) ])
+        self.assertEqual(self.checkpoint(), (24, 1))
+        self.assertEqual(self.marked(), [ 1 ] * 25)
+
+    def test_done_is_skipped(self):
+        runner = self.runner()
+        while runner.step():
+            pass
+
+        runner = self.runner()
+        self.assertFalse(runner.step())
+        self.assertEqual(runner.migrations[0].batches, [])
@@ -0,0 +1,87 @@
+import struct
+import unittest
+
+from time import sleep, time
+
+from notifications import NotificationListener, zmq
+
+
+def wait_until(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            return False
+        sleep(0.01)
+    return True
+
+
+@unittest.skipIf(zmq is None, 'pyzmq not installed')
+class NotificationListenerTest(unittest.TestCase):
+    def setUp(self):
+        self.publisher = zmq.Context.instance().socket(zmq.PUB)
+        port = self.publisher.bind_to_random_port('tcp://127.0.0.1')
+        self.listener = NotificationListener('tcp://127.0.0.1:%d' % port, resync_interval=3600)
+        self.listener.start()
+
+        # Subscriptions reach the publisher asynchronously, publish unsequenced
+        # blocks until one gets through
+        def subscribed():
+            self.publisher.send_multipart([ b'hashblock', b'\0' * 32 ])
+            return self.listener.pending()
+        self.assertTrue(wait_until(subscribed))
+
+        # Messages arrive in order, once this one is in all warmup blocks are
+        self.publisher.send_multipart([ b'rawtx', b'sync' ])
+        self.assertTrue(wait_until(lambda: b'sync' in self.listener.transactions))
+        self.listener.take_block()
+        self.listener.take_transactions()
+        self.listener.acknowledge()
+        self.listener.acknowledge_transactions()
+
+    def tearDown(self):
+        self.listener.stop()
+        self.assertFalse(self.listener.thread.is_alive())
+        self.publisher.close(linger=0)
+
+    def publish(self, topic, body, sequence):
+        self.publisher.send_multipart([ topic, body, struct.pack('<I', sequence) ])
+
+    def test_block_wakeup(self):
+        self.publish(b'hashblock', b'\1' * 32, 0)
+        self.assertTrue(wait_until(self.listener.pending))
+        self.assertTrue(self.listener.take_block())
+        self.assertFalse(self.listener.take_block())
+        self.assertFalse(self.listener.tx_wakeup.is_set())
+
+    def test_transaction_wakeup(self):
+        self.publish(b'rawtx', b'tx1', 0)
+        self.publish(b'rawtx', b'tx2', 1)
+        self.assertTrue(wait_until(lambda: len(self.listener.transactions) == 2))
+        self.listener.wait_transactions(1)
+        self.assertEqual(self.listener.take_transactions(), [ b'tx1', b'tx2' ])
+        self.assertEqual(self.listener.take_transactions(), [])
+        self.assertFalse(self.listener.pending())
+
+    def test_sequence_gap(self):
+        self.assertTrue(self.listener.resync_due(b'hashblock'))
+        self.assertTrue(self.listener.resync_due(b'rawtx'))
+
+        self.publish(b'hashblock', b'\1' * 32, 7)
+        self.publish(b'hashblock', b'\2' * 32, 8)
+        self.publish(b'rawtx', b'tx1', 3)
+        self.assertTrue(wait_until(lambda: self.listener.sequences.get(b'rawtx') == 3))
+        self.assertFalse(self.listener.resync_due(b'hashblock'))
+        self.assertFalse(self.listener.resync_due(b'rawtx'))
+
+        self.publish(b'hashblock', b'\4' * 32, 10)
+        self.assertTrue(wait_until(lambda: self.listener.sequences.get(b'hashblock') == 10))
+        self.assertTrue(self.listener.resync_due(b'hashblock'))
+        self.assertFalse(self.listener.resync_due(b'hashblock'))
+        self.assertFalse(self.listener.resync_due(b'rawtx'))
+
+    def test_sequence_wraparound(self):
+        self.assertTrue(self.listener.resync_due(b'hashblock'))
+        self.publish(b'hashblock', b'\1' * 32, 0xffffffff)
+        self.publish(b'hashblock', b'\2' * 32, 0)
+        self.assertTrue(wait_until(lambda: self.listener.sequences.get(b'hashblock') == 0))
+        self.assertFalse(self.listener.resync_due(b'hashblock'))
@@ -0,0 +1,118 @@
+import threading
+import unittest
+
+from decimal import Decimal
+from time import sleep
+
+from prefetch import BlockPrefetcher, fetch_block, load_transaction, load_transactions
+
+
+def blockhash(height):
+    return '%064x' % (height + 1)
+
+
+def txid(height, index):
+    return '%060x%04x' % (height, index)
+
+
+def rawtransaction(txid):
+    return {
+        'txid': txid,
+        'size': 250,
+        'vin': [ {'txid': '00' * 32, 'vout': 0} ],
+        'vout': [ {'n': 0, 'value': Decimal('1.5'), 'scriptPubKey': {'asm': 'OP_RETURN 00'}} ]
+    }
+
+
+class FakeRpc(object):
+    def __init__(self, txs_per_block=3, gates=None, failing=()):
+        self.gates = gates or {}
+        self.failing = failing
+        self.completed = []
+        self.batches = []
+        self.lock = threading.Lock()
+        self.txs_per_block = txs_per_block
+
+    def getblockhash(self, height):
+        if height in self.gates:
+            self.gates[height].wait(10.0)
+        return blockhash(height)
+
+    def getblock(self, blockhash):
+        height = int(blockhash, 16) - 1
+        if height in self.failing:
+            raise ValueError(blockhash)
+        with self.lock:
+            self.completed.append(height)
+        return {'hash': blockhash, 'height': height, 'tx': [ txid(height, index) for index in range(self.txs_per_block) ]}
+
+    def getrawtransaction(self, txid, verbose):
+        return rawtransaction(txid)
+
+    def batch_(self, calls):
+        self.batches.append(len(calls))
+        return [ getattr(self, call[0])(*call[1:]) for call in calls ]
+
+
+class LoadTransactionsTest(unittest.TestCase):
+    def test_batches(self):
+        rpc = FakeRpc()
+        txids = [ txid(1, index) for index in range(5) ]
+        self.assertEqual(sorted(load_transactions(rpc, txids, batch_size=2).keys()), sorted(txids))
+        self.assertEqual(rpc.batches, [ 2, 2, 1 ])
+
+    def test_fallback_matches_batch(self):
+        rpc = FakeRpc()
+        block = fetch_block(rpc, 1)
+        resolve = block.tx_resolver(lambda txid: load_transaction(rpc, txid))
+
+        # Prefetched and resolved one by one (not prefetched) alike
+        for index in range(rpc.txs_per_block + 1):
+            self.assertEqual(resolve(txid(1, index)), load_transactions(rpc, [ txid(1, index) ])[txid(1, index)])
+        self.assertEqual(rpc.batches, [ 3, 1, 1, 1, 1 ])
+
+    def test_genesis(self):
+        rpc = FakeRpc()
+        self.assertEqual(fetch_block(rpc, 0).transactions, {})
+        self.assertEqual(rpc.batches, [])
+
+
+class BlockPrefetcherTest(unittest.TestCase):
+    def test_in_order(self):
+        gate = threading.Event()
+        rpc = FakeRpc(gates={ 1: gate })
+        heights = []
+        with BlockPrefetcher(rpc, 1, 8, depth=4, threads=4, batch_size=2) as prefetcher:
+            # Blocks after the first one complete while it is still pending
+            for _ in range(100):
+                with rpc.lock:
+                    if set([ 2, 3, 4 ]) <= set(rpc.completed):
+                        break
+                sleep(0.05)
+            gate.set()
+
+            for block in prefetcher:
+                heights.append(block.height)
+                self.assertEqual(block.hash, blockhash(block.height))
+                self.assertEqual(sorted(block.transactions.keys()), sorted(block.blockinfo['tx']))
+
+        self.assertEqual(heights, list(range(1, 9)))
+        self.assertNotEqual(rpc.completed[0], 1)
+
+    def test_bounded_depth(self):
+        gate = threading.Event()
+        rpc = FakeRpc(gates={ 1: gate })
+        with BlockPrefetcher(rpc, 1, 20, depth=4, threads=4) as prefetcher:
+            sleep(0.3)
+            # The pending block holds one of the slots
+            with rpc.lock:
+                self.assertEqual(sorted(rpc.completed), [ 2, 3, 4 ])
+            gate.set()
+            self.assertEqual([ block.height for block in prefetcher ], list(range(1, 21)))
+
+    def test_error(self):
+        rpc = FakeRpc(failing=[ 3 ])
+        with BlockPrefetcher(rpc, 1, 5, threads=2) as prefetcher:
+            # Errors are raised in order, after the blocks before them
+            self.assertEqual([ prefetcher.get().height for _ in range(2) ], [ 1, 2 ])
+            self.assertRaises(ValueError, prefetcher.get)
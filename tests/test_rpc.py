@@ -0,0 +1,130 @@
+import socket
+import unittest
+
+import rpc
+
+from rpc import LatencyHistogram, RpcClient
+
+
+class DaemonError(Exception):
+    pass
+
+
+class FakeConnection(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def getblockcount(self):
+        self.calls += 1
+        failure = self.failures.pop(0) if len(self.failures) > 0 else None
+        if failure is not None:
+            raise failure
+        return 100
+
+
+class RpcClientTest(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.sleep = rpc.sleep
+        rpc.sleep = self.sleeps.append
+
+        self.failures = []
+        self.connections = []
+
+    def tearDown(self):
+        rpc.sleep = self.sleep
+
+    def factory(self):
+        connection = FakeConnection(self.failures)
+        self.connections.append(connection)
+        return connection
+
+    def client(self, connections=2, retries=3):
+        return RpcClient(self.factory, connections=connections, retries=retries, backoff=0.5)
+
+    def test_reuses_connections(self):
+        client = self.client()
+        self.assertEqual(client.getblockcount(), 100)
+        self.assertEqual(client.getblockcount(), 100)
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].calls, 2)
+
+    def test_retries_with_backoff(self):
+        self.failures.extend([ socket.error(), socket.timeout(), None ])
+        client = self.client()
+        self.assertEqual(client.getblockcount(), 100)
+
+        # Failed connections are replaced, not reused
+        self.assertEqual(len(self.connections), 3)
+        self.assertEqual(self.sleeps, [ 0.5, 1.0 ])
+
+    def test_gives_up_after_retries(self):
+        self.failures.extend([ socket.error() ] * 3)
+        client = self.client(connections=1, retries=2)
+        self.assertRaises(socket.error, client.getblockcount)
+        self.assertEqual(self.sleeps, [ 0.5, 1.0 ])
+
+        # The connection slot was released
+        self.assertEqual(client.getblockcount(), 100)
+
+    def test_daemon_errors_are_not_retried(self):
+        self.failures.append(DaemonError())
+        client = self.client(connections=1)
+        self.assertRaises(DaemonError, client.getblockcount)
+        self.assertEqual(self.sleeps, [])
+
+        # The connection itself is fine and kept
+        self.assertEqual(client.getblockcount(), 100)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_factory_errors_release_the_slot(self):
+        def factory():
+            raise socket.error()
+        client = RpcClient(factory, connections=1)
+        self.assertRaises(socket.error, client.getblockcount)
+        self.assertTrue(client.slots.acquire(False))
+
+    def test_records_latency(self):
+        self.failures.extend([ socket.error(), DaemonError() ])
+        client = self.client()
+        self.assertRaises(DaemonError, client.getblockcount)
+        client.getblockcount()
+
+        stats = client.stats()['getblockcount']
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['errors'], 2)
+
+    def test_private_attributes(self):
+        self.assertRaises(AttributeError, getattr, self.client(), '__deepcopy__')
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        histogram = LatencyHistogram()
+        for elapsed in [ 0.0005, 0.001, 0.003, 0.003, 0.150, 10.0 ]:
+            histogram.add(elapsed)
+        self.assertEqual(histogram.counts[:4], [ 2, 0, 2, 0 ])
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(sum(histogram.counts), 6)
+
+    def test_stats(self):
+        histogram = LatencyHistogram()
+        for _ in range(98):
+            histogram.add(0.004)
+        histogram.add(0.080, failed=True)
+        histogram.add(6.0)
+
+        stats = histogram.stats()
+        self.assertEqual(stats['calls'], 100)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['p50'], '<=5 msec')
+        self.assertEqual(stats['p90'], '<=5 msec')
+        self.assertEqual(stats['p99'], '<=100 msec')
+        self.assertEqual(histogram.percentile(1.0), '>5000 msec')
+        self.assertEqual(stats['avg'], '%.1f msec' % ((98 * 4 + 80 + 6000) / 100.0))
+
+    def test_empty(self):
+        stats = LatencyHistogram().stats()
+        self.assertEqual(stats['calls'], 0)
+        self.assertEqual(stats['avg'], '0.0 msec')
@@ -0,0 +1,125 @@
+import shutil
+import tempfile
+import unittest
+
+from os import path
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import DatabaseIO
+from txidindex import TxidIndex
+
+
+def txid(n):
+    return bytes(bytearray([ n % 256, n // 256 ] + [ 0x5a ] * 30))
+
+
+class FakeDatabase(object):
+    def __init__(self, session, txid_index):
+        self.session = session
+        self.txid_index = txid_index
+
+
+class TxidIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = path.join(self.directory, 'txidindex.dat')
+
+        self.session = sessionmaker(bind=create_engine('sqlite://'))()
+        self.session.execute('CREATE TABLE `transaction` (`id` INTEGER PRIMARY KEY, `txid` BLOB NOT NULL);')
+        for tx_id in range(1, 51):
+            self.session.execute('INSERT INTO `transaction` (`id`, `txid`) VALUES (:id, :txid);', {'id': tx_id, 'txid': txid(tx_id)})
+        self.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def crash(self, index):
+        # Drop the mapping without the clean close
+        index.map.flush()
+        index.map.close()
+        index.file.close()
+
+    def sync(self, index):
+        DatabaseIO.__dict__['sync_txid_index'](FakeDatabase(self.session, index))
+
+    def test_lookup(self):
+        index = TxidIndex(self.filename)
+        index.update({ txid(n): n for n in range(1, 11) })
+        index[txid(11)] = 11
+        self.assertEqual(index.get(txid(5)), 5)
+        self.assertEqual(index[txid(11)], 11)
+        self.assertIsNone(index.get(txid(12)))
+        self.assertNotIn(txid(12), index)
+        self.assertRaises(KeyError, index.__getitem__, txid(12))
+        self.assertEqual(index.currsize, 11)
+        index.close()
+
+    def test_grow(self):
+        TxidIndex.__dict__['create'](None, self.filename, 8)
+        index = TxidIndex(self.filename)
+        index.update({ txid(n): n for n in range(1, 51) })
+        self.assertEqual(index.capacity, 128)
+        self.assertEqual([ index.get(txid(n)) for n in range(1, 51) ], list(range(1, 51)))
+        index.close()
+
+    def test_clean_reopen(self):
+        index = TxidIndex(self.filename)
+        index.update({ txid(n): n for n in range(1, 11) })
+        index.close()
+
+        index = TxidIndex(self.filename)
+        self.assertTrue(index.was_clean)
+        self.assertEqual(index.synced_id, 10)
+
+        # Catches up on transactions added since
+        self.sync(index)
+        self.assertEqual(index.currsize, 50)
+        self.assertEqual(index.get(txid(50)), 50)
+        index.close()
+
+    def test_rebuild_after_dirty(self):
+        index = TxidIndex(self.filename)
+        index.update({ txid(n): n for n in range(1, 11) })
+        # Written to the index but rolled back in the database
+        index.update({ txid(100): 100 })
+        self.crash(index)
+
+        index = TxidIndex(self.filename)
+        self.assertFalse(index.was_clean)
+        self.sync(index)
+        self.assertEqual(index.currsize, 50)
+        self.assertEqual(index.synced_id, 50)
+        self.assertIsNone(index.get(txid(100)))
+        self.assertEqual([ index.get(txid(n)) for n in range(1, 51) ], list(range(1, 51)))
+        index.close()
+
+        self.assertTrue(TxidIndex(self.filename).was_clean)
+
+    def test_rebuild_when_ahead_of_database(self):
+        index = TxidIndex(self.filename)
+        index.update({ txid(100): 100 })
+        index.close()
+
+        index = TxidIndex(self.filename)
+        self.sync(index)
+        self.assertEqual(index.currsize, 50)
+        self.assertIsNone(index.get(txid(100)))
+        index.close()
+
+    def test_writer(self):
+        index = TxidIndex(self.filename)
+        writer = index.writer(self.session)
+
+        self.session.execute('SELECT 1;')
+        writer[txid(1)] = 1
+        self.assertEqual(writer.get(txid(1)), 1)
+        self.assertIsNone(index.get(txid(1)))
+        self.session.rollback()
+        self.assertIsNone(writer.get(txid(1)))
+
+        self.session.execute('SELECT 1;')
+        writer[txid(2)] = 2
+        self.session.commit()
+        self.assertEqual(index.get(txid(2)), 2)
+        index.close()
@@ -0,0 +1,178 @@
+import unittest
+
+from decimal import Decimal
+from cachetools import LFUCache
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import DatabaseSession
+from models import Block, BlockTransaction, BlockUndo, CachedValue, TransactionInput
+
+
+def blockhash(height):
+    return bytes(bytearray([ height % 256, height // 256 ] + [ 0x0f ] * 30))
+
+
+class FakeBlock(object):
+    def __init__(self, id, totalfee):
+        self.id = id
+        self.totalfee = totalfee
+
+
+class UndoTestCase(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        for table in [ Block, BlockTransaction, BlockUndo, CachedValue, TransactionInput ]:
+            table.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.execute('CREATE TABLE `blockundoentry` (`id` INTEGER PRIMARY KEY, `block` INTEGER, `txout` INTEGER, `address` INTEGER, `amount` NUMERIC);')
+        self.session.execute('INSERT INTO `cache` (`id`, `valid`, `value`) VALUES (0, 1, 0.0);')
+        self.db = DatabaseSession(self.session, address_cache=LFUCache(maxsize=16), txid_cache=None)
+
+    def add_blocks(self, heights, journalled=()):
+        for height in heights:
+            self.session.execute('INSERT INTO `block` (`id`, `hash`, `height`) VALUES (:id, :hash, :height);', {
+                'id': height + 1,
+                'hash': blockhash(height),
+                'height': height
+            })
+            if height in journalled:
+                self.session.execute('INSERT INTO `blockundo` (`block`, `transactions`, `fees`, `newcoins`) VALUES (:id, 0, 0.0, 0.0);', {'id': height + 1})
+                self.session.execute('INSERT INTO `blockundoentry` (`block`, `address`, `amount`) VALUES (:id, 1, 1.0);', {'id': height + 1})
+
+    def journalled_blocks(self):
+        return sorted([ block_id for (block_id,) in self.session.execute('SELECT DISTINCT `block` FROM `blockundoentry`;').fetchall() ])
+
+    def heights(self):
+        return sorted([ height for (height,) in self.session.execute('SELECT `height` FROM `block` WHERE `height` IS NOT NULL;').fetchall() ])
+
+    def record_statements(self):
+        statements = []
+        self.session.execute = lambda statement, params={}: statements.append((' '.join(str(statement).split()), params))
+        return statements
+
+
+class AddBlockUndoTest(UndoTestCase):
+    def test_journal(self):
+        self.add_blocks([ 0 ])
+        self.session.execute('INSERT INTO `blocktx` (`id`, `transaction`, `block`) VALUES (1, 10, 1), (2, 11, 1);')
+        self.session.execute('INSERT INTO `txin` (`id`, `transaction`, `index`, `input`) VALUES (1, 11, 0, 100), (2, 11, 1, 101), (3, 12, 0, 102);')
+
+        self.db.undo_balances = { 1: Decimal('5.0'), 2: Decimal('-3.0'), 3: Decimal('1.0') }
+        self.db.undo_dirty = set([ 3, 4 ])
+        self.db.add_block_undo(FakeBlock(1, Decimal('0.5')), 2, Decimal('12.5'))
+        self.session.flush()
+
+        undo = self.session.query(BlockUndo).one()
+        self.assertEqual((undo.block_id, undo.transactions, undo.fees, undo.newcoins), (1, 2, Decimal('0.5'), Decimal('12.5')))
+
+        # Spent outputs of the block's inputs only
+        spent = self.session.execute('SELECT `txout` FROM `blockundoentry` WHERE `txout` IS NOT NULL ORDER BY `txout`;').fetchall()
+        self.assertEqual([ txout_id for (txout_id,) in spent ], [ 100, 101 ])
+
+        # Disconnecting subtracts the recorded deltas, addresses without a
+        # known delta are recorded as NULL and marked dirty instead
+        entries = self.session.execute('SELECT `address`, `amount` FROM `blockundoentry` WHERE `address` IS NOT NULL ORDER BY `address`;').fetchall()
+        self.assertEqual([ (address_id, None if amount is None else Decimal(str(amount))) for address_id, amount in entries ], [
+            (1, Decimal('5.0')),
+            (2, Decimal('-3.0')),
+            (3, None),
+            (4, None)
+        ])
+
+        self.assertEqual(self.db.undo_balances, {})
+        self.assertEqual(self.db.undo_dirty, set())
+
+    def test_empty_journal(self):
+        self.add_blocks([ 0 ])
+        self.db.add_block_undo(FakeBlock(1, Decimal('0.0')), 0, Decimal('12.5'))
+        self.session.flush()
+        self.assertEqual(self.journalled_blocks(), [])
+        self.assertEqual(self.session.query(BlockUndo).count(), 1)
+
+
+class PruneBlockUndoTest(UndoTestCase):
+    def test_bounds(self):
+        statements = self.record_statements()
+        self.db.prune_block_undo(150)
+
+        # Entries go first, they are found through `blockundo`
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0][0].startswith('DELETE `blockundoentry` FROM `blockundo`'))
+        self.assertTrue(statements[1][0].startswith('DELETE `blockundo` FROM `blockundo`'))
+
+        # The journal at the bound itself is kept
+        for statement, params in statements:
+            self.assertIn('`block`.`height` < :height', statement)
+            self.assertEqual(params, {'height': 150})
+
+
+class DisconnectBlocksTest(UndoTestCase):
+    def test_nothing_to_disconnect(self):
+        statements = self.record_statements()
+        self.db.disconnect_blocks([])
+        self.assertEqual(statements, [])
+
+    def test_statements(self):
+        statements = self.record_statements()
+        self.db.disconnect_blocks([ 3, '2', 1 ])
+
+        for statement, params in statements:
+            self.assertIn('IN (3, 2, 1)', statement)
+
+        # Balances revert by the summed deltas of all blocks, unless any of
+        # them is unknown
+        self.assertIn('SUM(`amount`) AS `delta`', statements[0][0])
+        self.assertIn('`address`.`balance` - `undo`.`delta`', statements[0][0])
+        self.assertIn('`undo`.`unknown` = 1, 1', statements[0][0])
+
+        # Journals are only dropped after everything was reverted
+        self.assertEqual([ statement.split(' WHERE ')[0] for statement, params in statements[-3:] ], [
+            'DELETE FROM `blockundoentry`',
+            'DELETE FROM `blockundo`',
+            'UPDATE `block` SET `height` = NULL'
+        ])
+
+    def test_invalid_block_ids(self):
+        self.record_statements()
+        self.assertRaises(ValueError, self.db.disconnect_blocks, [ '1); DROP TABLE `block`; --' ])
+
+
+class OrphanBlocksTest(UndoTestCase):
+    def setUp(self):
+        super(OrphanBlocksTest, self).setUp()
+        self.disconnected = []
+        self.db.disconnect_blocks = lambda block_ids: self.disconnected.append(block_ids)
+
+    def test_journalled(self):
+        self.add_blocks(range(0, 10), journalled=range(5, 10))
+        self.db.orphan_blocks(5)
+        self.assertEqual(self.disconnected, [ [ 10, 9, 8, 7, 6 ] ])
+
+    def test_unjournalled(self):
+        self.add_blocks(range(0, 10))
+        self.db.orphan_blocks(5)
+        self.assertEqual(self.disconnected, [])
+        self.assertEqual(self.heights(), list(range(0, 5)))
+
+    def test_mixed(self):
+        # A single block without a journal takes every block to the slow
+        # path, journals of the others are dropped with them
+        self.add_blocks(range(0, 10), journalled=[ 3, 4, 6, 7, 8, 9 ])
+        self.db.orphan_blocks(5)
+        self.assertEqual(self.disconnected, [])
+        self.assertEqual(self.heights(), list(range(0, 5)))
+        self.assertEqual(self.journalled_blocks(), [ 4, 5 ])
+        self.assertEqual(self.session.query(BlockUndo.block_id).count(), 2)
+        self.assertFalse(self.session.query(CachedValue).one().valid)
+
+    def test_slow_path_matches_orphan_block(self):
+        self.add_blocks(range(0, 10), journalled=range(6, 10))
+        self.db.orphan_blocks(5)
+        orphaned = self.heights()
+
+        self.setUp()
+        self.add_blocks(range(0, 10))
+        for height in range(9, 4, -1):
+            self.db.orphan_block(height)
+        self.assertEqual(self.heights(), orphaned)
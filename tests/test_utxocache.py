@@ -0,0 +1,120 @@
+import shutil
+import tempfile
+import unittest
+
+from cachetools import LFUCache
+from decimal import Decimal
+from os import path
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import DatabaseSession
+from utxocache import UtxoCache
+
+
+TXID_A = b'\xaa' * 32
+TXID_B = b'\xbb' * 32
+CHAINTIP = b'\x11' * 32
+
+
+class UtxoCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = UtxoCache()
+
+    def test_add_pop(self):
+        self.cache.add(TXID_A, 0, 10, Decimal('1.5'))
+        self.cache.add(TXID_A, 1, 11, Decimal('0.00000001'))
+        self.assertEqual(self.cache.pop(TXID_A, 1), (11, Decimal('0.00000001')))
+        self.assertEqual(self.cache.pop(TXID_A, 1), None)
+        self.assertEqual(self.cache.pop(TXID_B, 0), None)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_rollback(self):
+        self.cache.add(TXID_A, 0, 10, Decimal('1'))
+        self.cache.commit()
+
+        self.cache.pop(TXID_A, 0)
+        self.cache.add(TXID_B, 0, 12, Decimal('2'))
+        self.cache.pop(TXID_B, 0)
+        self.cache.add(TXID_B, 1, 13, Decimal('3'))
+        self.cache.rollback()
+
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.pop(TXID_A, 0), (10, Decimal('1')))
+
+    def test_commit(self):
+        self.cache.add(TXID_A, 0, 10, Decimal('1'))
+        self.cache.commit()
+        self.cache.rollback()
+        self.assertEqual(len(self.cache), 1)
+
+    def test_evicts_oldest(self):
+        cache = UtxoCache(memory=2 * UtxoCache.ENTRY_OVERHEAD)
+        cache.add(TXID_A, 0, 10, Decimal('1'))
+        cache.add(TXID_A, 1, 11, Decimal('1'))
+        cache.add(TXID_A, 2, 12, Decimal('1'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.pop(TXID_A, 0), None)
+        self.assertEqual(cache.pop(TXID_A, 2), (12, Decimal('1')))
+
+
+class UtxoCacheSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = UtxoCache()
+        self.session = sessionmaker(bind=create_engine('sqlite://'))()
+        self.db = DatabaseSession(self.session, address_cache=LFUCache(maxsize=16), txid_cache=None, utxo_cache=self.cache)
+
+    def test_follows_session(self):
+        self.session.execute('SELECT 1;')
+        self.cache.add(TXID_A, 0, 10, Decimal('1'))
+        self.session.commit()
+
+        self.session.execute('SELECT 1;')
+        self.cache.pop(TXID_A, 0)
+        self.cache.add(TXID_B, 0, 11, Decimal('1'))
+        self.session.rollback()
+
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.pop(TXID_A, 0), (10, Decimal('1')))
+
+
+class UtxoCacheSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = path.join(self.directory, 'utxocache.dat')
+
+        self.cache = UtxoCache()
+        for index in range(100):
+            self.cache.add(TXID_A, index, 1000 + index, Decimal(index) / 100)
+        self.cache.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        self.cache.save(self.filename, CHAINTIP)
+        self.assertFalse(path.exists(self.filename + '.tmp'))
+
+        loaded = UtxoCache()
+        loaded.add(TXID_B, 0, 1, Decimal('1'))
+        self.assertTrue(loaded.load(self.filename, CHAINTIP))
+        self.assertEqual(len(loaded), 100)
+        self.assertEqual(loaded.pop(TXID_B, 0), None)
+        for index in range(100):
+            self.assertEqual(loaded.pop(TXID_A, index), (1000 + index, Decimal(index) / 100))
+
+    def test_other_chaintip(self):
+        self.cache.save(self.filename, CHAINTIP)
+        loaded = UtxoCache()
+        self.assertFalse(loaded.load(self.filename, b'\x22' * 32))
+        self.assertEqual(len(loaded), 0)
+
+    def test_missing(self):
+        self.assertFalse(UtxoCache().load(self.filename, CHAINTIP))
+
+    def test_load_trims_to_size(self):
+        self.cache.save(self.filename, CHAINTIP)
+        loaded = UtxoCache(memory=10 * UtxoCache.ENTRY_OVERHEAD)
+        self.assertTrue(loaded.load(self.filename, CHAINTIP))
+        self.assertEqual(len(loaded), 10)
+        self.assertEqual(loaded.pop(TXID_A, 99), (1099, Decimal('0.99')))
@@ -0,0 +1,220 @@
+import mmap
+import os
+import struct
+import threading
+
+from time import time
+
+from sqlalchemy import event
+
+from logger import log_event
+
+
+INDEX_MAGIC = b'TXIDIDX1'
+INDEX_HEADER = struct.Struct('<8sQQQQ')
+SLOT = struct.Struct('<32sQ')
+SLOT_KEY = struct.Struct('<Q')
+
+INITIAL_CAPACITY = 1 << 20
+MAX_LOAD = 0.7
+
+CLEAN = 1
+DIRTY = 0
+
+
+class TxidIndex(object):
+    # Open addressing hash table in a memory mapped file, mapping the
+    # 32 byte txid to the internal transaction id. Txids are uniformly
+    # distributed already, their first 8 bytes are used as slot hash.
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.file = None
+        self.map = None
+        self.capacity = 0
+        self.count = 0
+        self.synced_id = 0
+        self.was_clean = False
+
+        if os.path.exists(filename):
+            self.open()
+        else:
+            self.create(filename, INITIAL_CAPACITY)
+            self.open()
+
+    def create(self, filename, capacity):
+        with open(filename, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, capacity, 0, 0, CLEAN))
+            f.truncate(INDEX_HEADER.size + capacity * SLOT.size)
+
+    def open(self):
+        self.file = open(self.filename, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        magic, self.capacity, self.count, self.synced_id, clean = INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC or len(self.map) != INDEX_HEADER.size + self.capacity * SLOT.size:
+            raise Exception('Txid index %s is corrupt, rebuild it with --rebuild-txid-index' % self.filename)
+        self.was_clean = clean == CLEAN
+
+        # Marked clean again on close, an index left dirty by a crash is rebuilt
+        self.write_header(DIRTY)
+
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            self.write_header(CLEAN)
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map = None
+            self.file = None
+
+    def write_header(self, clean):
+        INDEX_HEADER.pack_into(self.map, 0, INDEX_MAGIC, self.capacity, self.count, self.synced_id, clean)
+
+    @property
+    def currsize(self):
+        return self.count
+
+    def slot(self, txid):
+        mask = self.capacity - 1
+        index = SLOT_KEY.unpack_from(txid, 0)[0] & mask
+        while True:
+            offset = INDEX_HEADER.size + index * SLOT.size
+            key, value = SLOT.unpack_from(self.map, offset)
+            if value == 0 or key == txid:
+                return offset, value
+            index = (index + 1) & mask
+
+    def get(self, txid, default=None):
+        with self.lock:
+            offset, value = self.slot(txid)
+            return value - 1 if value != 0 else default
+
+    def __contains__(self, txid):
+        return self.get(txid) is not None
+
+    def __getitem__(self, txid):
+        tx_id = self.get(txid)
+        if tx_id is None:
+            raise KeyError(txid)
+        return tx_id
+
+    def __setitem__(self, txid, tx_id):
+        self.update({txid: tx_id})
+
+    def update(self, entries):
+        with self.lock:
+            if self.count + len(entries) > self.capacity * MAX_LOAD:
+                self.grow(self.count + len(entries))
+
+            for txid, tx_id in entries.items():
+                offset, value = self.slot(txid)
+                if value == 0:
+                    self.count += 1
+                # Stored off by one, a zero value marks an empty slot
+                SLOT.pack_into(self.map, offset, txid, tx_id + 1)
+                if tx_id > self.synced_id:
+                    self.synced_id = tx_id
+            self.write_header(DIRTY)
+
+    def grow(self, required):
+        capacity = self.capacity
+        while required > capacity * MAX_LOAD:
+            capacity *= 2
+
+        start_time = time()
+        tempfile = self.filename + '.tmp'
+        self.create(tempfile, capacity)
+
+        old_map, old_file = self.map, self.file
+        self.file = open(tempfile, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.capacity = capacity
+        self.count = 0
+
+        for offset in range(INDEX_HEADER.size, len(old_map), SLOT.size):
+            txid, value = SLOT.unpack_from(old_map, offset)
+            if value != 0:
+                new_offset, _ = self.slot(txid)
+                SLOT.pack_into(self.map, new_offset, txid, value)
+                self.count += 1
+        self.write_header(DIRTY)
+
+        old_map.close()
+        old_file.close()
+        os.rename(tempfile, self.filename)
+        log_event('Resized', 'idx', 'txid', {'capacity': capacity, 'entries': self.count, 'time': '%.1f sec' % (time() - start_time)})
+
+    def catch_up(self, session, chunk_size=100000):
+        start_time = time()
+        added = 0
+        while True:
+            rows = session.execute('''
+                SELECT `id`, `txid` FROM `transaction`
+                    WHERE `id` > :synced_id
+                    ORDER BY `id`
+                    LIMIT :limit;
+            ''', {
+                'synced_id': self.synced_id,
+                'limit': chunk_size
+            }).fetchall()
+            if len(rows) == 0:
+                break
+            self.update({ bytes(row.txid): row.id for row in rows })
+            added += len(rows)
+        session.commit()
+
+        log_event('Synced', 'idx', 'txid', {'added': added, 'entries': self.count, 'time': '%.1f sec' % (time() - start_time)})
+
+    def rebuild(self, session):
+        with self.lock:
+            self.map.close()
+            self.file.close()
+            self.create(self.filename, INITIAL_CAPACITY)
+            self.open()
+            self.catch_up(session)
+
+    def writer(self, session):
+        return TxidIndexWriter(self, session)
+
+
+class TxidIndexWriter(object):
+    # Per session view on the shared index: entries added in a transaction
+    # are only written to the index once the database commit succeeded.
+    def __init__(self, index, session):
+        self.index = index
+        self.pending = {}
+
+        event.listen(session, 'after_commit', lambda session: self.commit())
+        event.listen(session, 'after_rollback', lambda session: self.rollback())
+
+    @property
+    def currsize(self):
+        return self.index.currsize
+
+    def commit(self):
+        if len(self.pending) > 0:
+            self.index.update(self.pending)
+            self.pending = {}
+
+    def rollback(self):
+        self.pending = {}
+
+    def get(self, txid, default=None):
+        if txid in self.pending:
+            return self.pending[txid]
+        return self.index.get(txid, default)
+
+    def __contains__(self, txid):
+        return self.get(txid) is not None
+
+    def __getitem__(self, txid):
+        tx_id = self.get(txid)
+        if tx_id is None:
+            raise KeyError(txid)
+        return tx_id
+
+    def __setitem__(self, txid, tx_id):
+        self.pending[txid] = tx_id
@@ -0,0 +1,124 @@
+import os
+import struct
+
+from binascii import hexlify
+from collections import OrderedDict
+from itertools import islice
+from decimal import Decimal
+from time import time
+
+from logger import log_event
+
+
+COIN = Decimal(100000000)
+
+SNAPSHOT_MAGIC = b'UTXOSNP1'
+SNAPSHOT_HEADER = struct.Struct('<8s32sQ')
+
+OUTPOINT_INDEX = struct.Struct('<I')
+VALUE = struct.Struct('<QQ')
+ENTRY_SIZE = 32 + OUTPOINT_INDEX.size + VALUE.size
+
+
+def outpoint(txid, index):
+    return txid + OUTPOINT_INDEX.pack(index)
+
+
+class UtxoCache(object):
+    # Approximate cost of one entry: key and value objects plus dict and
+    # ordering overhead.
+    ENTRY_OVERHEAD = 288
+
+    def __init__(self, memory=256*1024*1024):
+        self.maxsize = max(memory // self.ENTRY_OVERHEAD, 1)
+
+        # Insertion ordered: outputs are evicted oldest first, as freshly
+        # created outputs are the ones most likely to be spent soon.
+        self.entries = OrderedDict()
+
+        # Changes since the last commit, undone if the transaction is rolled back
+        self.journal = []
+
+    @property
+    def currsize(self):
+        return len(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, txid, index, txout_id, amount):
+        key = outpoint(txid, index)
+        self.entries[key] = VALUE.pack(txout_id, int((Decimal(amount) * COIN).to_integral_value()))
+        self.journal.append((key, None))
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, txid, index):
+        key = outpoint(txid, index)
+        value = self.entries.pop(key, None)
+        if value is None:
+            return None
+        self.journal.append((key, value))
+
+        txout_id, amount = VALUE.unpack(value)
+        return txout_id, Decimal(amount) / COIN
+
+    def commit(self):
+        self.journal = []
+
+    def rollback(self):
+        for key, value in reversed(self.journal):
+            if value is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = value
+        self.journal = []
+
+    def clear(self):
+        self.entries.clear()
+        self.journal = []
+
+    def save(self, filename, chaintip_hash):
+        start_time = time()
+        tempfile = filename + '.tmp'
+
+        with open(tempfile, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, chaintip_hash, len(self.entries)))
+            items = iter(self.entries.items())
+            while True:
+                chunk = [ key + value for key, value in islice(items, 65536) ]
+                if len(chunk) == 0:
+                    break
+                f.write(b''.join(chunk))
+
+        os.rename(tempfile, filename)
+        log_event('Saved', 'utx', hexlify(chaintip_hash), {'entries': len(self.entries), 'time': '%d msec' % int((time() - start_time) * 1000)})
+
+    def load(self, filename, chaintip_hash):
+        if not os.path.exists(filename):
+            return False
+
+        start_time = time()
+        with open(filename, 'rb') as f:
+            magic, snapshot_hash, count = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+
+            # Only valid for the chaintip it was taken at, the outputs created
+            # by blocks imported after that would be missing.
+            if magic != SNAPSHOT_MAGIC or snapshot_hash != chaintip_hash:
+                log_event('Discard', 'utx', hexlify(snapshot_hash), {'chaintip': hexlify(chaintip_hash)})
+                return False
+
+            self.clear()
+            while True:
+                data = f.read(ENTRY_SIZE * 65536)
+                if len(data) == 0:
+                    break
+                for offset in range(0, len(data), ENTRY_SIZE):
+                    self.entries[data[offset:offset+36]] = data[offset+36:offset+ENTRY_SIZE]
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+        log_event('Loaded', 'utx', hexlify(chaintip_hash), {'entries': len(self.entries), 'time': '%d msec' % int((time() - start_time) * 1000)})
+        return True